@@ -0,0 +1,123 @@
+"""
+Shared helpers for the benchmark scripts.
+
+Every benchmark runs the app against a throwaway working directory, so the
+real `database.db`, `uploads/` and `logs/` are never touched. In-process
+benchmarks must call `prepare_workdir()` *before* importing anything from
+`app`, because the app reads `config.toml` from the current directory at
+import time; HTTP benchmarks start a uvicorn child process with `serve()`.
+"""
+
+import base64
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+private_key = Ed25519PrivateKey.from_private_bytes(b"benchmark_key_32_bytes_long_ok!!")
+public_key_b64 = base64.b64encode(private_key.public_key().public_bytes_raw()).decode()
+
+
+def prepare_workdir(replacements: dict[str, str] | None = None) -> Path:
+    """
+    Copy config.toml into a temp dir with a fresh SQLite database and rate
+    limiting effectively disabled, then chdir there.
+    `replacements` maps `key = value` lines to override (matched by key).
+    """
+    workdir = Path(tempfile.mkdtemp(prefix="benji-bench-"))
+    config = (REPO_ROOT / "config.toml").read_text()
+    overrides = {
+        "path": f'"sqlite:///{workdir / "bench.db"}"',
+        "requests_per_second": "1000000000",
+        "level": '"WARNING"',
+    }
+    overrides.update(replacements or {})
+    for key, value in overrides.items():
+        config = re.sub(
+            rf"^{re.escape(key)} = .*$", f"{key} = {value}", config, flags=re.MULTILINE
+        )
+    (workdir / "config.toml").write_text(config)
+    os.chdir(workdir)
+    sys.path.insert(0, str(REPO_ROOT / "src"))
+    return workdir
+
+
+@contextmanager
+def serve(workdir: Path, src: str | Path = REPO_ROOT / "src") -> Iterator[str]:
+    """Run `app.main:app` under uvicorn in a child process; yields its base URL."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    env = dict(os.environ, PYTHONPATH=str(src))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app",
+         "--port", str(port), "--log-level", "warning", "--no-access-log"],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("uvicorn failed to start") from None
+                time.sleep(0.1)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def signed(payload: dict, username: str) -> dict:
+    payload_json = json.dumps(payload, separators=(",", ":"))
+    signature = private_key.sign(payload_json.encode())
+    return {
+        "payload": payload_json,
+        "signature": base64.b64encode(signature).decode(),
+        "username": username,
+    }
+
+
+def as_user(username: str) -> dict[str, str]:
+    """The header that charges a request to `username`; the app requires it."""
+    return {"X-Username": username}
+
+
+def b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def summarize(label: str, samples_s: list[float]) -> str:
+    ms = [s * 1000 for s in samples_s]
+    if not ms:
+        return f"{label:<28} n=0"
+    return (
+        f"{label:<28} n={len(ms):<6} mean={statistics.fmean(ms):8.2f}ms "
+        f"p50={percentile(ms, 50):8.2f}ms p99={percentile(ms, 99):8.2f}ms "
+        f"max={max(ms):8.2f}ms"
+    )
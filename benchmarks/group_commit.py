@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Write throughput with and without group commit, at 1, 10 and 100 writers.
+
+Each writer stores initial messages in a loop the way post_return_message
+does (count against the recipient's cap, insert, commit), either committing
+every write itself or through the group-commit writer. Runs in-process
+against a throwaway SQLite database with the given `synchronous` setting:
+FULL pays an fsync per commit, NORMAL (the default config) only at
+checkpoints.
+
+    python benchmarks/group_commit.py --synchronous FULL --duration 3
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from common import percentile, prepare_workdir
+
+
+async def run_writers(coalescer, recipient_id: int, writers: int, duration: float):
+    from sqlmodel.ext.asyncio.session import AsyncSession
+
+    from app.core.messages import reserve_message_slots
+    from app.models.schema import MessageStore
+    from app.shared.db import async_engine
+
+    async def store(session):
+        await session.exec(reserve_message_slots([recipient_id], cap=2**31))
+        session.add(MessageStore(
+            recipient_id=recipient_id,
+            sharer_id=recipient_id,
+            sharer_identity_key_public=os.urandom(32),
+            eph_key=os.urandom(32),
+            e_message=os.urandom(256),
+            otp_hash=os.urandom(32),
+            pq_ct=os.urandom(1088),
+            pq_otp_hash=os.urandom(32),
+        ))
+        await session.flush()
+
+    samples = []
+    deadline = time.perf_counter() + duration
+
+    async def writer():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            async with AsyncSession(async_engine, expire_on_commit=False) as session:
+                await coalescer.commit(session, store)
+            samples.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(writer() for _ in range(writers)))
+    return len(samples) / (time.perf_counter() - start), samples
+
+
+async def main(args):
+    prepare_workdir({"synchronous": f'"{args.synchronous}"'})
+    from sqlmodel.ext.asyncio.session import AsyncSession
+
+    from app.models.schema import MessageInventory, User
+    from app.shared.db import engine, run_migrations, write_engine
+    from app.shared.group_commit import WriteCoalescer
+
+    run_migrations(engine)
+    async with AsyncSession(write_engine, expire_on_commit=False) as session:
+        user = User(username="group_commit_bench", public_key=os.urandom(32))
+        session.add(user)
+        await session.flush()
+        assert user.id is not None
+        session.add(MessageInventory(user_id=user.id))
+        await session.commit()
+
+    print(f"synchronous={args.synchronous} duration={args.duration}s per run")
+    for writers in (1, 10, 100):
+        for label, enabled in (("commit per write", False), ("group commit", True)):
+            coalescer = WriteCoalescer(
+                write_engine,
+                enabled=enabled,
+                window=args.window,
+                max_batch=args.max_batch,
+            )
+            throughput, samples = await run_writers(
+                coalescer, user.id, writers, args.duration
+            )
+            await coalescer.close()
+            print(
+                f"writers={writers:<4} {label:<17} {throughput:8.0f} writes/s "
+                f"p50={percentile(samples, 50):7.2f}ms "
+                f"p99={percentile(samples, 99):7.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Group commit throughput")
+    parser.add_argument("--synchronous", default="FULL", choices=["NORMAL", "FULL"])
+    parser.add_argument("--duration", type=float, default=3)
+    parser.add_argument("--window", type=float, default=0.002)
+    parser.add_argument("--max-batch", type=int, default=64)
+    asyncio.run(main(parser.parse_args()))
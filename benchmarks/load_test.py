@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Mixed-traffic load test for the x3dh and files endpoints.
+
+Starts the app under uvicorn in a child process (fresh database, rate
+limiting off), then concurrent virtual clients hammer it over HTTP with a mix
+of prekey pushes, bundle fetches, message posts/grabs and file up/downloads.
+Latency percentiles are reported per endpoint.
+
+    python benchmarks/load_test.py --clients 50 --duration 10
+
+Pass --src to benchmark another checkout's `src` directory.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import uuid
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import httpx
+from common import (
+    REPO_ROOT,
+    as_user,
+    b64,
+    prepare_workdir,
+    public_key_b64,
+    serve,
+    signed,
+    summarize,
+)
+
+
+async def setup_users(c: httpx.AsyncClient, count: int) -> list[str]:
+    users = [f"load_{i}_{uuid.uuid4().hex[:6]}" for i in range(count)]
+    for user in users:
+        await c.post("/auth/register", json=signed(
+            {"username": user, "public_key": public_key_b64}, user
+        ), headers=as_user(user))
+        await c.post("/x3dh/signed_prekey_push", json=signed({
+            "username": user,
+            "signed_prekey_public": b64(os.urandom(32)),
+            "signed_prekey_signature": b64(os.urandom(64)),
+        }, user), headers=as_user(user))
+        await c.post("/x3dh/pq_signed_prekey_push", json=signed({
+            "username": user,
+            "pq_signed_prekey_public": b64(os.urandom(1184)),
+            "pq_signed_prekey_signature": b64(os.urandom(64)),
+        }, user), headers=as_user(user))
+    return users
+
+
+async def run(c: httpx.AsyncClient, args):
+    users = await setup_users(c, args.users)
+    files: list[tuple[str, str]] = []
+    latencies: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+
+    async def call(name, url, payload, user):
+        start = time.perf_counter()
+        response = await c.post(url, json=signed(payload, user), headers=as_user(user))
+        latencies[name].append(time.perf_counter() - start)
+        if response.status_code >= 500:
+            errors[name] += 1
+        return response
+
+    async def client_loop(deadline):
+        while time.perf_counter() < deadline:
+            user, other = random.sample(users, 2)
+            op = random.random()
+            if op < 0.15:
+                await call("otp_prekey_push", "/x3dh/otp_prekey_push", {
+                    "username": user,
+                    "pub_otps": [b64(os.urandom(32)) for _ in range(5)],
+                }, user)
+                await call("pq_otp_prekey_push", "/x3dh/pq_otp_prekey_push", {
+                    "username": user,
+                    "pub_pq_otps": [
+                        {
+                            "public_key": b64(os.urandom(1184)),
+                            "signature": b64(os.urandom(64)),
+                        }
+                        for _ in range(5)
+                    ],
+                }, user)
+            elif op < 0.40:
+                await call("prekey_bundle", "/x3dh/prekey_bundle", {
+                    "username": user, "target_username": other,
+                }, user)
+            elif op < 0.60:
+                await call("post_return_message", "/x3dh/post_return_message", {
+                    "sharer_username": user,
+                    "recipient_username": other,
+                    "sharer_identity_key_public": b64(os.urandom(32)),
+                    "sharer_ephemeral_key_public": b64(os.urandom(32)),
+                    "otp_hash": b64(os.urandom(32)),
+                    "encrypted_message": b64(os.urandom(128)),
+                    "kem_ciphertext": b64(os.urandom(1088)),
+                    "pq_otp_hash": b64(os.urandom(32)),
+                }, user)
+            elif op < 0.80:
+                response = await call(
+                    "grab_return_messages", "/x3dh/grab_return_messages",
+                    {"username": user}, user,
+                )
+                if response.status_code == 200 and (ids := [
+                    message["id"] for message in response.json().get("messages", [])
+                ]):
+                    await call("ack_return_messages", "/x3dh/ack_return_messages", {
+                        "username": user, "message_ids": ids,
+                    }, user)
+            elif op < 0.90 or not files:
+                file_uuid = str(uuid.uuid4())
+                response = await call("files_upload", "/files/upload", {
+                    "uuid": file_uuid,
+                    "username": user,
+                    "file_name": "bench.bin",
+                    "file_content_b64": b64(os.urandom(args.file_size)),
+                }, user)
+                if response.status_code == 200:
+                    files.append((file_uuid, user))
+            else:
+                file_uuid, owner = random.choice(files)
+                await call("files_download", "/files/download", {
+                    "uuid": file_uuid, "username": owner,
+                }, owner)
+
+    deadline = time.perf_counter() + args.duration
+    await asyncio.gather(*(client_loop(deadline) for _ in range(args.clients)))
+
+    everything = [s for samples in latencies.values() for s in samples]
+    print(f"src={args.src}")
+    print(f"clients={args.clients} duration={args.duration}s users={args.users}")
+    for name in sorted(latencies):
+        print(summarize(name, latencies[name]), f"5xx={errors[name]}")
+    print(summarize("ALL", everything))
+    print(f"throughput={len(everything) / args.duration:.1f} req/s")
+
+
+async def main(args):
+    workdir = prepare_workdir()
+    limits = httpx.Limits(max_connections=args.clients)
+    with serve(workdir, args.src) as base_url:
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as c:
+            await run(c, args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mixed-traffic load test")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--file-size", type=int, default=64 * 1024)
+    parser.add_argument("--src", default=str(REPO_ROOT / "src"))
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Time small x3dh requests and large downloads through the middleware stack.
+
+Registers one user, sends --requests prekey inventory requests one after
+another, then uploads a --file-mib file and downloads it --downloads times.
+Byte pacing is turned off so only the middleware's own cost is measured.
+Compare checkouts with --src, e.g. one from before the middleware became
+plain ASGI:
+
+    git worktree add /tmp/before <commit>
+    python benchmarks/middleware_overhead.py --src /tmp/before/src
+    python benchmarks/middleware_overhead.py
+"""
+
+import argparse
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import httpx
+from common import (
+    REPO_ROOT,
+    as_user,
+    b64,
+    prepare_workdir,
+    public_key_b64,
+    serve,
+    signed,
+    summarize,
+)
+
+USERNAME = "middleware_bench"
+
+
+def main(args):
+    workdir = prepare_workdir({"bytes_in_per_second": "0", "bytes_out_per_second": "0"})
+    print(f"src={args.src} requests={args.requests} file={args.file_mib} MiB")
+    with (
+        serve(workdir, args.src) as base_url,
+        httpx.Client(base_url=base_url, headers=as_user(USERNAME), timeout=300) as c,
+    ):
+        register = {"username": USERNAME, "public_key": public_key_b64}
+        c.post("/auth/register", json=signed(register, USERNAME)).raise_for_status()
+
+        inventory = signed({"username": USERNAME}, USERNAME)
+        samples = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            c.post("/x3dh/prekey_inventory", json=inventory).raise_for_status()
+            samples.append(time.perf_counter() - start)
+        print(summarize("x3dh prekey_inventory", samples))
+
+        file_uuid = str(uuid.uuid4())
+        content = os.urandom(args.file_mib * 1024 * 1024)
+        upload = {
+            "uuid": file_uuid,
+            "username": USERNAME,
+            "file_name": "bench.bin",
+            "file_content_b64": b64(content),
+        }
+        c.post("/files/upload", json=signed(upload, USERNAME)).raise_for_status()
+
+        download = signed({"uuid": file_uuid, "username": USERNAME}, USERNAME)
+        samples = []
+        for _ in range(args.downloads):
+            start = time.perf_counter()
+            with c.stream("POST", "/files/download", json=download) as response:
+                response.raise_for_status()
+                received = sum(len(chunk) for chunk in response.iter_raw())
+            samples.append(time.perf_counter() - start)
+            assert received == len(content)
+        mib_per_s = args.file_mib * len(samples) / sum(samples)
+        print(f"{summarize('file download', samples)} MiB/s={mib_per_s:8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Middleware overhead per request")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--file-mib", type=int, default=64)
+    parser.add_argument("--downloads", type=int, default=20)
+    parser.add_argument("--src", default=str(REPO_ROOT / "src"))
+    main(parser.parse_args())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Time pushing 10k classical and 10k PQ one-time prekeys over HTTP.
+
+Keys go out in batches of --batch per request, then the same keys are pushed
+a second time to measure the duplicate path. Pass --src to benchmark another
+checkout's `src` directory.
+
+    python benchmarks/otp_push.py --keys 10000 --batch 1000
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import httpx
+from common import (
+    REPO_ROOT,
+    as_user,
+    b64,
+    prepare_workdir,
+    public_key_b64,
+    serve,
+    signed,
+    summarize,
+)
+
+USERNAME = "otp_pusher"
+
+
+def otp_batches(keys: list[bytes], batch: int):
+    for start in range(0, len(keys), batch):
+        yield {
+            "username": USERNAME,
+            "pub_otps": [b64(key) for key in keys[start : start + batch]],
+        }
+
+
+def pq_otp_batches(keys: list[bytes], batch: int):
+    signature = b64(os.urandom(64))
+    for start in range(0, len(keys), batch):
+        yield {
+            "username": USERNAME,
+            "pub_pq_otps": [
+                {"public_key": b64(key), "signature": signature}
+                for key in keys[start : start + batch]
+            ],
+        }
+
+
+def push_all(c: httpx.Client, url: str, batches) -> tuple[float, list[float]]:
+    samples = []
+    start = time.perf_counter()
+    for payload in batches:
+        request_start = time.perf_counter()
+        response = c.post(url, json=signed(payload, USERNAME))
+        response.raise_for_status()
+        samples.append(time.perf_counter() - request_start)
+    return time.perf_counter() - start, samples
+
+
+def main(args):
+    workdir = prepare_workdir()
+    otps = [os.urandom(32) for _ in range(args.keys)]
+    pq_otps = [os.urandom(1184) for _ in range(args.keys)]
+
+    print(f"src={args.src} keys={args.keys} batch={args.batch}")
+    with serve(workdir, args.src) as base_url, httpx.Client(
+        base_url=base_url, headers=as_user(USERNAME), timeout=300
+    ) as c:
+        register = {"username": USERNAME, "public_key": public_key_b64}
+        c.post("/auth/register", json=signed(register, USERNAME)).raise_for_status()
+
+        for label, url, batches in [
+            ("otp", "/x3dh/otp_prekey_push", otp_batches),
+            ("pq otp", "/x3dh/pq_otp_prekey_push", pq_otp_batches),
+        ]:
+            keys = otps if label == "otp" else pq_otps
+            for run in ("new", "duplicate"):
+                total, samples = push_all(c, url, batches(keys, args.batch))
+                print(
+                    f"{summarize(f'{label} push ({run})', samples)} "
+                    f"total={total:6.2f}s keys/s={args.keys / total:9.0f}"
+                )
+
+    db_size = (workdir / "bench.db").stat().st_size / 1024
+    print(f"database file {db_size:.0f} KiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk OTP prekey pushes")
+    parser.add_argument("--keys", type=int, default=10_000)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--src", default=str(REPO_ROOT / "src"))
+    main(parser.parse_args())
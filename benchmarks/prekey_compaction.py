@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Measure the one-time prekey tables before and after deleting claimed keys.
+
+Builds a database at migration 0004, where claimed prekeys stay in the table
+flagged `used`, fills it with a mix of claimed and unclaimed keys and measures
+table sizes and the latency of picking the next key. Then migrates to head,
+which deletes the claimed rows, reclaims the space and measures again.
+
+    python benchmarks/prekey_compaction.py --users 500 --keys-per-user 100
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from common import percentile, prepare_workdir
+
+TABLES = ["otp", "pqonetimeprekey"]
+
+NEXT_KEY = {
+    "used flag (0004)": "SELECT id FROM {table} WHERE user_id = ? AND used = 0 "
+    "ORDER BY id LIMIT 1",
+    "delete on claim (head)": "SELECT id FROM {table} WHERE user_id = ? "
+    "ORDER BY id LIMIT 1",
+}
+
+
+def populate(connection, args):
+    connection.executemany(
+        "INSERT INTO user (id, username, public_key) VALUES (?, ?, ?)",
+        [(i, f"user_{i:05d}", os.urandom(32)) for i in range(1, args.users + 1)],
+    )
+    # Claims take the oldest keys first, so the claimed ones come first
+    claimed = int(args.keys_per_user * args.claimed)
+    flags = [int(i < claimed) for i in range(args.keys_per_user)]
+    connection.executemany(
+        "INSERT INTO otp (user_id, otp_val, used) VALUES (?, ?, ?)",
+        [
+            (user_id, os.urandom(32), used)
+            for user_id in range(1, args.users + 1)
+            for used in flags
+        ],
+    )
+    connection.executemany(
+        "INSERT INTO pqonetimeprekey (user_id, pqotp, pqotp_sig, used) "
+        "VALUES (?, ?, ?, ?)",
+        [
+            (user_id, os.urandom(1184), os.urandom(64), used)
+            for user_id in range(1, args.users + 1)
+            for used in flags
+        ],
+    )
+    connection.commit()
+
+
+def table_sizes(connection) -> dict[str, int]:
+    """Bytes used by each prekey table together with its indexes."""
+    sizes = {}
+    for table in TABLES:
+        sizes[table] = connection.execute(
+            "SELECT sum(pgsize) FROM dbstat WHERE name = ? OR name IN "
+            "(SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?)",
+            (table, table),
+        ).fetchone()[0]
+    return sizes
+
+
+def time_next_key(connection, sql, args) -> dict[str, list[float]]:
+    results = {}
+    for table in TABLES:
+        statement = sql.format(table=table)
+        samples = []
+        for _ in range(args.iterations):
+            user_id = random.randint(1, args.users)
+            start = time.perf_counter()
+            connection.execute(statement, (user_id,)).fetchall()
+            samples.append((time.perf_counter() - start) * 1_000_000)
+        results[table] = samples
+    return results
+
+
+def report(label, sizes, file_size, timings):
+    print(f"== {label}")
+    for table, size in sizes.items():
+        print(f"  {table:<21} {size / 1024:9.0f} KiB")
+    print(f"  {'database file':<21} {file_size / 1024:9.0f} KiB")
+    for table, samples in timings.items():
+        print(
+            f"  next {table:<16} p50={percentile(samples, 50):6.1f}us "
+            f"p99={percentile(samples, 99):6.1f}us"
+        )
+
+
+def measure(db_path, label, args):
+    connection = sqlite3.connect(db_path)
+    sizes = table_sizes(connection)
+    timings = time_next_key(connection, NEXT_KEY[label], args)
+    connection.close()
+    report(label, sizes, Path(db_path).stat().st_size, timings)
+
+
+def main(args):
+    prepare_workdir()
+    from alembic import command
+    from sqlalchemy import create_engine
+
+    from app.shared.db import alembic_config
+
+    db_path = "prekeys.db"
+    engine = create_engine(f"sqlite:///{db_path}")
+    with engine.begin() as connection:
+        command.upgrade(alembic_config(connection), "0004")
+
+    connection = sqlite3.connect(db_path)
+    connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    connection.execute("VACUUM")
+    populate(connection, args)
+    connection.close()
+    measure(db_path, "used flag (0004)", args)
+
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        command.upgrade(alembic_config(connection), "head")
+    migration_s = time.perf_counter() - start
+
+    connection = sqlite3.connect(db_path, isolation_level=None)
+    free_pages = connection.execute("PRAGMA freelist_count").fetchone()[0]
+    start = time.perf_counter()
+    connection.executescript("PRAGMA incremental_vacuum(0)")
+    vacuum_s = time.perf_counter() - start
+    connection.close()
+    measure(db_path, "delete on claim (head)", args)
+
+    print(
+        f"users={args.users} keys_per_user={args.keys_per_user} "
+        f"claimed={args.claimed:.0%}"
+    )
+    print(f"migration 0004 -> head took {migration_s:.2f}s")
+    print(f"incremental vacuum freed {free_pages} pages in {vacuum_s:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Claimed prekey compaction")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--keys-per-user", type=int, default=100)
+    parser.add_argument("--claimed", type=float, default=0.9)
+    parser.add_argument("--iterations", type=int, default=20000)
+    main(parser.parse_args())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Hold thousands of idle push connections on one worker and time delivery.
+
+Opens --connections WebSockets spread over --users recipients, reports the
+server's resident memory before and after, then posts messages and times how
+long until every connection of the recipient has the event. Reads memory from
+/proc, so it runs on Linux only.
+
+    python benchmarks/push_connections.py --connections 2000 --users 100
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import httpx
+from common import (
+    REPO_ROOT,
+    as_user,
+    b64,
+    prepare_workdir,
+    public_key_b64,
+    serve,
+    signed,
+    summarize,
+)
+from websockets.asyncio.client import connect
+
+SHARER = "push_sharer"
+
+
+def server_rss_kib() -> int:
+    """Resident memory of the uvicorn child started by `serve`."""
+    proc = Path("/proc")
+    pid = str(os.getpid())
+    children = (proc / pid / "task" / pid / "children").read_text()
+    for line in (proc / children.split()[0] / "status").read_text().splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1])
+    raise RuntimeError("no VmRSS")
+
+
+def message(recipient: str, body: bytes) -> dict:
+    return {
+        "sharer_username": SHARER,
+        "recipient_username": recipient,
+        "sharer_identity_key_public": b64(os.urandom(32)),
+        "sharer_ephemeral_key_public": b64(os.urandom(32)),
+        "otp_hash": b64(os.urandom(32)),
+        "encrypted_message": b64(body),
+        "kem_ciphertext": b64(os.urandom(1088)),
+        "pq_otp_hash": b64(os.urandom(32)),
+    }
+
+
+async def subscribe(ws_url: str, username: str):
+    websocket = await connect(ws_url, max_queue=None)
+    await websocket.send(json.dumps(signed({"username": username}, username)))
+    assert json.loads(await websocket.recv())["type"] == "subscribed"
+    return websocket
+
+
+async def run(base_url: str, args):
+    recipients = [f"push_recipient_{i:04d}" for i in range(args.users)]
+    ws_url = base_url.replace("http", "ws", 1) + "/client_endpoint"
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as c:
+        for username in [SHARER, *recipients]:
+            register = {"username": username, "public_key": public_key_b64}
+            response = await c.post(
+                "/auth/register",
+                json=signed(register, username),
+                headers=as_user(username),
+            )
+            response.raise_for_status()
+
+        idle_rss = server_rss_kib()
+        start = time.perf_counter()
+        sockets: dict[str, list] = {username: [] for username in recipients}
+        for i in range(args.connections):
+            username = recipients[i % args.users]
+            sockets[username].append(await subscribe(ws_url, username))
+        connect_s = time.perf_counter() - start
+        await asyncio.sleep(1)
+        held_rss = server_rss_kib()
+
+        print(
+            f"{args.connections} connections opened in {connect_s:.2f}s; server RSS "
+            f"{idle_rss / 1024:.1f} -> {held_rss / 1024:.1f} MiB "
+            f"({(held_rss - idle_rss) / args.connections:.1f} KiB per connection)"
+        )
+
+        samples = []
+        for i in range(args.messages):
+            username = recipients[i % args.users]
+            start = time.perf_counter()
+            response = await c.post(
+                "/x3dh/post_return_message",
+                json=signed(message(username, os.urandom(64)), SHARER),
+                headers=as_user(SHARER),
+            )
+            response.raise_for_status()
+            await asyncio.gather(*(websocket.recv() for websocket in sockets[username]))
+            samples.append(time.perf_counter() - start)
+        print(summarize("post -> all pushed", samples))
+
+        for connections in sockets.values():
+            for websocket in connections:
+                await websocket.close()
+
+
+def main(args):
+    # Both ends of every connection live on this machine
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(hard, max(soft, args.connections * 2 + 1024))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+    workdir = prepare_workdir()
+    print(f"src={args.src} connections={args.connections} users={args.users}")
+    with serve(workdir, args.src) as base_url:
+        asyncio.run(run(base_url, args))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Idle push connections")
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--src", default=str(REPO_ROOT / "src"))
+    main(parser.parse_args())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Compare SQLite connection profiles under concurrent writers and readers.
+
+Each profile runs the same workload: writer processes append 1 KiB rows in
+small read-then-write transactions (like a message post), while reader
+processes run point lookups. Every connection gets its PRAGMAs from the app's
+own `apply_sqlite_profile`, so the numbers match what the server would see.
+
+    python benchmarks/sqlite_profiles.py --writers 4 --readers 4 --duration 5
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from common import percentile, prepare_workdir
+
+PROFILES = {
+    # No PRAGMAs at all: what `create_engine(path)` gave us before
+    "sqlite-defaults": None,
+    "wal+full": {
+        "journal_mode": "WAL", "synchronous": "FULL", "transaction_mode": "DEFERRED"
+    },
+    "wal+normal": {
+        "journal_mode": "WAL", "synchronous": "NORMAL", "transaction_mode": "DEFERRED"
+    },
+    # Whatever config.toml currently says
+    "configured": {},
+}
+
+
+def connect(db_path, profile_overrides):
+    """Returns the connection and the BEGIN statement its transactions use."""
+    from app.shared.config import SqliteProfile
+    from app.shared.db import apply_sqlite_profile, config
+
+    connection = sqlite3.connect(db_path, isolation_level=None)
+    if profile_overrides is None:
+        return connection, "BEGIN"
+    profile = SqliteProfile(**(config.database.sqlite.model_dump() | profile_overrides))
+    apply_sqlite_profile(connection, profile)
+    return connection, f"BEGIN {profile.transaction_mode}"
+
+
+def writer(db_path, profile, deadline, results):
+    connection, begin = connect(db_path, profile)
+    latencies, errors = [], 0
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            connection.execute(begin)
+            connection.execute(
+                "SELECT count(*) FROM bench WHERE owner = ?", (random.randrange(100),)
+            ).fetchone()
+            connection.execute(
+                "INSERT INTO bench (owner, body) VALUES (?, ?)",
+                (random.randrange(100), os.urandom(1024)),
+            )
+            connection.execute("COMMIT")
+            latencies.append(time.perf_counter() - start)
+        except sqlite3.OperationalError:
+            errors += 1
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+    results.put(("write", latencies, errors))
+
+
+def reader(db_path, profile, deadline, results):
+    connection, _ = connect(db_path, profile)
+    latencies, errors = [], 0
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            connection.execute(
+                "SELECT body FROM bench WHERE id = ?", (random.randrange(1, 5000),)
+            ).fetchone()
+            latencies.append(time.perf_counter() - start)
+        except sqlite3.OperationalError:
+            errors += 1
+    results.put(("read", latencies, errors))
+
+
+def run_profile(name, profile, args):
+    db_path = f"{name}.db"
+    setup, _ = connect(db_path, profile)
+    setup.execute(
+        "CREATE TABLE bench (id INTEGER PRIMARY KEY, owner INTEGER, body BLOB)"
+    )
+    setup.execute("CREATE INDEX ix_bench_owner ON bench (owner)")
+    setup.executemany(
+        "INSERT INTO bench (owner, body) VALUES (?, ?)",
+        [(i % 100, os.urandom(1024)) for i in range(5000)],
+    )
+    setup.close()
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    deadline = time.perf_counter() + args.duration
+    workers = [
+        context.Process(target=writer, args=(db_path, profile, deadline, results))
+        for _ in range(args.writers)
+    ] + [
+        context.Process(target=reader, args=(db_path, profile, deadline, results))
+        for _ in range(args.readers)
+    ]
+    for worker in workers:
+        worker.start()
+    collected = {"write": ([], 0), "read": ([], 0)}
+    for _ in workers:
+        kind, latencies, errors = results.get()
+        total, total_errors = collected[kind]
+        collected[kind] = (total + latencies, total_errors + errors)
+    for worker in workers:
+        worker.join()
+
+    for kind, (latencies, errors) in collected.items():
+        ms = [latency * 1000 for latency in latencies]
+        print(
+            f"{name:<16} {kind:<5} ops/s={len(ms) / args.duration:9.1f} "
+            f"p50={percentile(ms, 50):7.2f}ms p99={percentile(ms, 99):7.2f}ms "
+            f"locked={errors}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare SQLite profiles")
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--profile", choices=PROFILES, action="append")
+    args = parser.parse_args()
+
+    prepare_workdir()
+    for name in args.profile or PROFILES:
+        run_profile(name, PROFILES[name], args)
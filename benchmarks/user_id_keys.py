@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Measure the move from username foreign keys to integer user ids.
+
+Builds a database at migration 0002 (username keys), fills it, measures index
+sizes and the latency of the routers' hot lookups, then runs the online
+migration to head on the same data and measures again.
+
+    python benchmarks/user_id_keys.py --users 2000 --rows-per-user 40
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from common import percentile, prepare_workdir
+
+# name -> (username-keyed SQL, id-keyed SQL); both take (user key, file uuid)
+QUERIES = {
+    "otp claim": (
+        "SELECT id, otp_val FROM otp WHERE f_username = ? AND used = 0 LIMIT 1",
+        "SELECT id, otp_val FROM otp WHERE user_id = ? AND used = 0 LIMIT 1",
+    ),
+    "messages": (
+        "SELECT * FROM messagestore WHERE recipient_username = ?",
+        "SELECT messagestore.*, user.username FROM messagestore "
+        "JOIN user ON user.id = messagestore.sharer_id WHERE recipient_id = ?",
+    ),
+    "storage sum": (
+        "SELECT size FROM file WHERE owner_username = ?",
+        "SELECT size FROM file WHERE owner_id = ?",
+    ),
+    "share check": (
+        "SELECT id FROM fileshare WHERE file_uuid = ? AND recipient_username = ? "
+        "AND revoked = 0",
+        "SELECT id FROM fileshare WHERE file_uuid = ? AND recipient_id = ? "
+        "AND revoked = 0",
+    ),
+}
+
+
+def populate(connection, args):
+    usernames = [f"user_{i:05d}_{uuid.uuid4().hex[:12]}" for i in range(args.users)]
+    connection.executemany(
+        "INSERT INTO user (id, username, public_key) VALUES (?, ?, ?)",
+        [(i + 1, name, os.urandom(32)) for i, name in enumerate(usernames)],
+    )
+    rows = args.rows_per_user
+    connection.executemany(
+        "INSERT INTO otp (f_username, otp_val, used) VALUES (?, ?, ?)",
+        [(name, os.urandom(32), i % 2) for name in usernames for i in range(rows)],
+    )
+    connection.executemany(
+        "INSERT INTO messagestore (recipient_username, sharer_username, "
+        "sharer_identity_key_public, eph_key, e_message, otp_hash, pq_ct, "
+        "pq_otp_hash) VALUES (?, ?, x'00', x'00', x'00', x'00', x'00', x'00')",
+        [
+            (name, random.choice(usernames))
+            for name in usernames
+            for _ in range(rows // 4)
+        ],
+    )
+    files = [(str(uuid.uuid4()), name) for name in usernames for _ in range(rows // 8)]
+    connection.executemany(
+        "INSERT INTO file (uuid, file_name, size, date_created, owner_username) "
+        "VALUES (?, 'f', 1024, '2026-01-01 00:00:00', ?)",
+        files,
+    )
+    connection.executemany(
+        "INSERT INTO fileshare (file_uuid, owner_username, recipient_username, "
+        "shared_at, revoked) VALUES (?, ?, ?, '2026-01-01 00:00:00', 0)",
+        [(file_uuid, owner, random.choice(usernames)) for file_uuid, owner in files],
+    )
+    connection.commit()
+    return usernames, [file_uuid for file_uuid, _ in files]
+
+
+def index_sizes(connection) -> dict[str, int]:
+    connection.execute("VACUUM")
+    return dict(
+        connection.execute(
+            "SELECT name, sum(pgsize) FROM dbstat WHERE name LIKE 'ix_%' "
+            "GROUP BY name ORDER BY name"
+        ).fetchall()
+    )
+
+
+def time_queries(connection, keys, files, use_ids, args) -> dict[str, list[float]]:
+    results = {}
+    for name, statements in QUERIES.items():
+        sql = statements[use_ids]
+        samples = []
+        for _ in range(args.iterations):
+            key = random.choice(keys)
+            params = (random.choice(files), key) if name == "share check" else (key,)
+            start = time.perf_counter()
+            connection.execute(sql, params).fetchall()
+            samples.append((time.perf_counter() - start) * 1_000_000)
+        results[name] = samples
+    return results
+
+
+def report(label, sizes, timings):
+    print(f"== {label}")
+    for name, size in sizes.items():
+        print(f"  {name:<48} {size / 1024:9.0f} KiB")
+    print(f"  {'all indexes':<48} {sum(sizes.values()) / 1024:9.0f} KiB")
+    for name, samples in timings.items():
+        print(
+            f"  {name:<16} p50={percentile(samples, 50):7.1f}us "
+            f"p99={percentile(samples, 99):7.1f}us"
+        )
+
+
+def main(args):
+    prepare_workdir()
+    from alembic import command
+    from sqlalchemy import create_engine
+
+    from app.shared.db import alembic_config, apply_sqlite_profile, config
+
+    db_path = "keys.db"
+    engine = create_engine(f"sqlite:///{db_path}")
+    with engine.begin() as connection:
+        command.upgrade(alembic_config(connection), "0002")
+
+    connection = sqlite3.connect(db_path)
+    apply_sqlite_profile(connection, config.database.sqlite)
+    usernames, files = populate(connection, args)
+    before = index_sizes(connection), time_queries(
+        connection, usernames, files, use_ids=False, args=args
+    )
+    connection.close()
+
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        command.upgrade(alembic_config(connection), "head")
+    migration_s = time.perf_counter() - start
+
+    connection = sqlite3.connect(db_path)
+    apply_sqlite_profile(connection, config.database.sqlite)
+    user_ids = list(range(1, len(usernames) + 1))
+    after = index_sizes(connection), time_queries(
+        connection, user_ids, files, use_ids=True, args=args
+    )
+
+    print(f"users={args.users} rows_per_user={args.rows_per_user}")
+    report("username keys (0002)", *before)
+    report("user id keys (head)", *after)
+    print(f"migration 0002 -> head took {migration_s:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Username vs user id keys")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--rows-per-user", type=int, default=40)
+    parser.add_argument("--iterations", type=int, default=20000)
+    main(parser.parse_args())
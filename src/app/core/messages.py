@@ -0,0 +1,135 @@
+import asyncio
+from collections import Counter
+from collections.abc import Collection, Mapping
+from datetime import UTC, datetime, timedelta
+
+from sqlalchemy import case
+from sqlmodel import col, delete, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.models.schema import MessageInventory, MessageStore, User
+from app.shared import Logger, load_config
+from app.shared.db import write_engine
+
+logger = Logger(__name__).get_logger()
+
+config = load_config()
+
+
+def return_messages_page(recipient_id: int, after: int, limit: int):
+    """
+    The recipient's stored messages with ids above the cursor `after`, oldest
+    first, each with the sharer's username: rows of (MessageStore, str).
+    Served by the (recipient_id, id) index, so every page costs the same no
+    matter how deep into the backlog it is.
+    """
+    return (
+        select(MessageStore, User.username)
+        .join(User, col(User.id) == MessageStore.sharer_id)
+        .where(MessageStore.recipient_id == recipient_id, col(MessageStore.id) > after)
+        .order_by(col(MessageStore.id))
+        .limit(limit)
+    )
+
+
+def delete_acked_messages(recipient_id: int, message_ids: Collection[int]):
+    """
+    One DELETE for every acknowledged message. Ids that are not the
+    recipient's, or already gone, are ignored.
+    """
+    return (
+        delete(MessageStore)
+        .where(
+            col(MessageStore.recipient_id) == recipient_id,
+            col(MessageStore.id).in_(message_ids),
+        )
+        .returning(col(MessageStore.id))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def reserve_message_slots(
+    recipient_ids: Collection[int], cap: int = config.messages.max_per_recipient
+):
+    """
+    Count one more stored message for each recipient and return the ids of
+    those that had room; recipients already at `cap` are left out. Run it in
+    the transaction that stores the messages.
+    """
+    return (
+        update(MessageInventory)
+        .where(
+            col(MessageInventory.user_id).in_(recipient_ids),
+            col(MessageInventory.messages) < cap,
+        )
+        .values(messages=col(MessageInventory.messages) + 1)
+        .returning(col(MessageInventory.user_id))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def release_message_slots(removed: Mapping[int, int]):
+    """Subtract deleted messages from the counts: recipient id -> how many."""
+    return (
+        update(MessageInventory)
+        .where(col(MessageInventory.user_id).in_(removed))
+        .values(
+            messages=col(MessageInventory.messages)
+            - case(removed, value=col(MessageInventory.user_id))
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def delete_expired_messages(cutoff: datetime, limit: int):
+    """
+    Delete up to `limit` of the oldest messages posted before `cutoff`,
+    returning their recipient ids. Served by the created_at index.
+    """
+    expired = (
+        select(MessageStore.id)
+        .where(col(MessageStore.created_at) < cutoff)
+        .order_by(col(MessageStore.created_at))
+        .limit(limit)
+    )
+    return (
+        delete(MessageStore)
+        .where(col(MessageStore.id).in_(expired))
+        .returning(col(MessageStore.recipient_id))
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def expire_messages(
+    ttl: float = config.messages.ttl, batch: int = config.messages.expiry_batch
+) -> int:
+    """
+    Delete every message older than `ttl` seconds, `batch` rows per
+    transaction so requests get the write lock in between; returns how many.
+    """
+    cutoff = datetime.now(UTC) - timedelta(seconds=ttl)
+    expired = 0
+    while True:
+        async with AsyncSession(write_engine) as session:
+            recipients = (
+                await session.exec(delete_expired_messages(cutoff, batch))
+            ).scalars().all()
+            if recipients:
+                await session.exec(release_message_slots(Counter(recipients)))
+            await session.commit()
+        expired += len(recipients)
+        if len(recipients) < batch:
+            return expired
+        await asyncio.sleep(0)
+
+
+async def run_message_expiry(interval: float = config.messages.expiry_interval):
+    """Background task: delete expired messages every `interval` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            expired = await expire_messages()
+            if expired:
+                logger.info("Expired %s unacknowledged messages", expired)
+        except Exception as e:
+            logger.warning("Message expiry failed: %s", e)
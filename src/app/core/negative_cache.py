@@ -0,0 +1,272 @@
+import asyncio
+import hashlib
+import math
+from collections import OrderedDict
+from collections.abc import Iterable
+from time import monotonic
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Mapped
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.models.schema import File, User
+from app.shared import Logger, load_config
+from app.shared.db import async_engine
+
+logger = Logger(__name__).get_logger()
+
+config = load_config()
+
+# Keys read per query while a filter is rebuilt, each page in its own short
+# transaction so writers are not held up behind the scan
+LOAD_PAGE = 10_000
+
+
+class BloomFilter:
+    """
+    Set membership with no false negatives: `key in bloom` is False only for
+    keys never added. About `false_positive_rate` of the others still answer
+    True while no more than `capacity` keys have been added.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float):
+        self.capacity = max(capacity, 1)
+        self.size = math.ceil(
+            -self.capacity * math.log(false_positive_rate) / math.log(2) ** 2
+        )
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * step) % self.size for i in range(self.hashes))
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+class NegativeCache:
+    """
+    Answers "this key certainly does not exist" for one unique column, so
+    requests for unknown usernames or files skip the lookup and whatever
+    would follow it.
+
+    Two sources, either one is enough:
+    - a Bloom filter of every key in the table, rebuilt by `refresh` and
+      updated by an ORM insert hook. It is only trusted once loaded.
+    - recent misses the database confirmed, each for `miss_ttl` seconds.
+
+    Both live in the process, and other workers insert without telling it.
+    So at most every `max_staleness` seconds, an answer first reads the
+    table's highest id, one primary key lookup in `catch_up`. If it has
+    moved past the `mark` the cache last saw, the keys of the rows after the
+    mark are added to the filter, and the lookups resume being skipped.
+    Between those reads a key another worker has just inserted can still be
+    answered as absent, for up to `max_staleness` seconds.
+
+    A miss is recorded with the `generation` read before its lookup, so a
+    lookup that overlapped a catch-up does not outlive it.
+
+    Not seen until the next rebuild: on PostgreSQL, an insert that takes an
+    id below the mark but commits after a read has passed it; on SQLite,
+    a row that reuses the id of the newest row after that was deleted.
+    """
+
+    def __init__(  # noqa: PLR0913 # one per [database.negative_cache] setting
+        self,
+        name: str,
+        column: Mapped[str],
+        id_column: Mapped[int | None],
+        *,
+        capacity: int,
+        false_positive_rate: float,
+        miss_ttl: float,
+        miss_cache_size: int,
+        max_staleness: float,
+        enabled: bool = True,
+    ):
+        self.name = name
+        self.column = column
+        self.id_column = id_column
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.miss_ttl = miss_ttl
+        self.miss_cache_size = miss_cache_size
+        self.max_staleness = max_staleness
+        self.enabled = enabled
+        # Highest id the filter and misses account for, None before the first read
+        self.mark: int | None = None
+        self.generation = 0
+        self._caught_up_at = -math.inf
+        self._bloom: BloomFilter | None = None
+        self._misses: OrderedDict[str, float] = OrderedDict()
+        # Keys inserted while a rebuild is reading the table
+        self._added_during_load: list[str] | None = None
+
+    def _locally_absent(self, key: str) -> bool:
+        expires = self._misses.get(key)
+        if expires is not None:
+            if expires > monotonic():
+                return True
+            del self._misses[key]
+        return self._bloom is not None and key not in self._bloom
+
+    async def absent(self, session: AsyncSession, keys: Iterable[str]) -> set[str]:
+        """The `keys` certainly not in the table, with one query if any might be."""
+        if not self.enabled:
+            return set()
+        candidates = [key for key in keys if self._locally_absent(key)]
+        if candidates and monotonic() >= self._caught_up_at + self.max_staleness:
+            await self.catch_up(session)
+            candidates = [key for key in candidates if self._locally_absent(key)]
+        return set(candidates)
+
+    async def known_absent(self, session: AsyncSession, key: str) -> bool:
+        return bool(await self.absent(session, (key,)))
+
+    async def catch_up(self, session: AsyncSession):
+        """Account for the rows inserted since the mark, by any process."""
+        self._caught_up_at = monotonic()
+        mark = (await session.exec(select(func.max(self.id_column)))).one() or 0
+        if mark == self.mark:
+            return
+        generation = self.generation
+        if self.mark is not None and mark > self.mark:
+            inserted = (await session.exec(
+                select(self.column).where(self.id_column > self.mark)
+            )).all()
+            for key in inserted:
+                self.add(key)
+        else:
+            # First read, or the newest rows were deleted and their ids may
+            # be reused, so what was read under the old mark no longer holds
+            self._misses.clear()
+            if self.mark is not None:
+                self._bloom = None
+        # A catch-up that overlapped a rebuild or another catch-up keeps theirs
+        if generation == self.generation:
+            self.mark = mark
+            self.generation += 1
+
+    def miss(self, key: str, generation: int):
+        """
+        Remember that the database had no row for `key`, in a lookup started
+        at `generation`.
+        """
+        if not self.enabled or generation != self.generation:
+            return
+        self._misses[key] = monotonic() + self.miss_ttl
+        self._misses.move_to_end(key)
+        if len(self._misses) > self.miss_cache_size:
+            self._misses.popitem(last=False)
+
+    def add(self, key: str):
+        """
+        Forget that `key` is absent. Called at flush, before the insert
+        commits: if it rolls back, the key only costs a false positive.
+        """
+        self._misses.pop(key, None)
+        if self._bloom is not None:
+            self._bloom.add(key)
+        if self._added_during_load is not None:
+            self._added_during_load.append(key)
+
+    async def refresh(self):
+        """Rebuild the filter from the table, sized for twice its keys."""
+        self._added_during_load = []
+        try:
+            # Read before the keys, so a row inserted during the load moves it
+            async with AsyncSession(async_engine) as session:
+                mark = (await session.exec(select(func.max(self.id_column)))).one() or 0
+            keys = await self._load_keys()
+            bloom = BloomFilter(
+                max(self.capacity, 2 * len(keys)), self.false_positive_rate
+            )
+            for key in keys:
+                bloom.add(key)
+            for key in self._added_during_load:
+                bloom.add(key)
+        finally:
+            self._added_during_load = None
+        self._bloom = bloom
+        self.mark = mark
+        self.generation += 1
+        self._misses.clear()
+        self._caught_up_at = monotonic()
+        logger.debug("Loaded %d %s into the negative cache", bloom.count, self.name)
+
+    async def _load_keys(self) -> list[str]:
+        keys: list[str] = []
+        while True:
+            statement = select(self.column).order_by(self.column).limit(LOAD_PAGE)
+            if keys:
+                statement = statement.where(self.column > keys[-1])
+            async with AsyncSession(async_engine) as session:
+                page = (await session.exec(statement)).all()
+            keys.extend(page)
+            if len(page) < LOAD_PAGE:
+                return keys
+
+    def clear(self):
+        self._bloom = None
+        self._misses.clear()
+        self.mark = None
+        self.generation += 1
+        self._caught_up_at = -math.inf
+
+
+def negative_cache(
+    name: str, column: Mapped[str], id_column: Mapped[int | None]
+) -> NegativeCache:
+    settings = config.database.negative_cache
+    return NegativeCache(
+        name,
+        column,
+        id_column,
+        capacity=settings.bloom_capacity,
+        false_positive_rate=settings.false_positive_rate,
+        miss_ttl=settings.miss_ttl,
+        miss_cache_size=settings.miss_cache_size,
+        max_staleness=settings.max_staleness,
+        enabled=settings.enabled,
+    )
+
+
+missing_usernames = negative_cache("usernames", col(User.username), col(User.id))
+missing_files = negative_cache("file UUIDs", col(File.uuid), col(File.id))
+
+
+@event.listens_for(User, "after_insert")
+def _user_inserted(_mapper, _connection, user: User):
+    missing_usernames.add(user.username)
+
+
+@event.listens_for(File, "after_insert")
+def _file_inserted(_mapper, _connection, file: File):
+    missing_files.add(file.uuid)
+
+
+async def run_negative_cache_refresh(
+    interval: float = config.database.negative_cache.refresh_interval,
+):
+    """Background task: load the filters, then rebuild them every `interval` seconds."""
+    while True:
+        for cache in (missing_usernames, missing_files):
+            try:
+                await cache.refresh()
+            except Exception as e:
+                logger.warning("Negative cache refresh of %s failed: %s", cache.name, e)
+        await asyncio.sleep(interval)
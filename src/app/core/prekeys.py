@@ -0,0 +1,246 @@
+from base64 import b64encode
+from collections import OrderedDict
+from collections.abc import Collection
+from dataclasses import dataclass, field
+from time import monotonic
+
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Mapped
+from sqlmodel import col, delete, select, update
+from sqlmodel.sql.expression import SelectOfScalar
+
+from app.models.schema import (
+    Otp,
+    PQOneTimePrekey,
+    PQSignedPrekeyBundle,
+    PrekeyBundle,
+    PrekeyInventory,
+    User,
+)
+from app.shared import load_config
+from app.shared.db import is_sqlite
+
+config = load_config()
+
+PREKEYS_LOW_HEADER = "X-Prekeys-Low"
+
+type OneTimePrekey = Otp | PQOneTimePrekey
+
+
+def next_one_time_prekey[T: OneTimePrekey](
+    model: type[T], user_id: int | Mapped[int | None]
+) -> SelectOfScalar[T]:
+    """
+    Select the oldest one-time prekey of `user_id` and lock it for the rest of
+    the transaction.
+
+    SKIP LOCKED makes concurrent bundle fetches for the same user take
+    different rows instead of queueing behind the first fetcher's lock. The
+    LIMIT matters too: without it FOR UPDATE locks every key the user has.
+    SQLite has no row locks and drops the FOR UPDATE clause; its transactions
+    are serialised by BEGIN IMMEDIATE instead.
+
+    `user_id` may also be a column, e.g. `User.id` to pick one key per user
+    in a correlated subquery.
+    """
+    return (
+        select(model)
+        .where(model.user_id == user_id)
+        .order_by(col(model.id))
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+
+
+def claim_one_time_prekey[T: OneTimePrekey](model: type[T], user_id: int):
+    """
+    Delete one one-time prekey of `user_id` and return it, in a single
+    DELETE ... RETURNING statement.
+
+    The row is picked and removed by the same statement, so two claimers can
+    never both get it, and consumed keys do not pile up for later claims to
+    skip over.
+    """
+    picked = next_one_time_prekey(model, user_id).with_only_columns(col(model.id))
+    return (
+        delete(model)
+        .where(col(model.id) == picked.scalar_subquery())
+        .returning(model)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def claim_one_time_prekeys[T: OneTimePrekey](model: type[T], user_ids: Collection[int]):
+    """
+    Like `claim_one_time_prekey`, for many users in one statement: deletes and
+    returns the oldest key of each user in `user_ids` that has one.
+    """
+    # Correlate on user only; the DELETE is on the same table as the subquery
+    picked = (
+        next_one_time_prekey(model, col(User.id))
+        .with_only_columns(col(model.id))
+        .correlate(User)
+        .scalar_subquery()
+    )
+    return (
+        delete(model)
+        .where(col(model.id).in_(select(picked).where(col(User.id).in_(user_ids))))
+        .returning(model)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def insert_one_time_prekeys[T: OneTimePrekey](model: type[T], rows: list[dict]):
+    """
+    One multi-row INSERT of `rows` that skips keys the user already has and
+    returns the ids of the rows it stored.
+
+    The (user_id, key) unique indexes make the skip atomic, so two concurrent
+    pushes of the same key store it once.
+    """
+    insert = sqlite_insert if is_sqlite(config.database.path) else postgresql_insert
+    return (
+        insert(model)
+        .values(rows)
+        .on_conflict_do_nothing()
+        .returning(col(model.id))
+    )
+
+
+def adjust_inventory(
+    user_id: int | Collection[int], otps: int = 0, pq_otps: int = 0
+):
+    """
+    Add `otps` and `pq_otps` (negative for claims) to the remaining one-time
+    prekey counts of one or more users and return the new (otps, pq_otps).
+    """
+    user_ids = [user_id] if isinstance(user_id, int) else user_id
+    return (
+        update(PrekeyInventory)
+        .where(col(PrekeyInventory.user_id).in_(user_ids))
+        .values(
+            otps=col(PrekeyInventory.otps) + otps,
+            pq_otps=col(PrekeyInventory.pq_otps) + pq_otps,
+        )
+        .returning(col(PrekeyInventory.otps), col(PrekeyInventory.pq_otps))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def low_prekey_headers(
+    otps: int, pq_otps: int, low_watermark: int = config.prekeys.low_watermark
+) -> dict[str, str]:
+    """
+    `X-Prekeys-Low: otp=<n>, pq_otp=<n>` while either count is below the
+    watermark, telling the owner to push a fresh batch; no headers otherwise.
+    """
+    if min(otps, pq_otps) >= low_watermark:
+        return {}
+    return {PREKEYS_LOW_HEADER: f"otp={otps}, pq_otp={pq_otps}"}
+
+
+def static_bundle(usernames: Collection[str]):
+    """
+    The parts of the prekey bundles of `usernames` that only change on signed
+    prekey pushes, in one query: rows of
+    (User, PrekeyBundle | None, PQSignedPrekeyBundle | None).
+    """
+    return (
+        select(User, PrekeyBundle, PQSignedPrekeyBundle)
+        .outerjoin(PrekeyBundle, col(PrekeyBundle.user_id) == User.id)
+        .outerjoin(PQSignedPrekeyBundle, col(PQSignedPrekeyBundle.user_id) == User.id)
+        .where(col(User.username).in_(usernames))
+    )
+
+
+@dataclass(frozen=True)
+class StaticBundle:
+    """
+    The cached static part of a user's prekey bundle, as raw bytes for msgpack
+    responses and already base64-encoded for JSON ones. Keys are the
+    `PrekeyBundleResponse` field names.
+    """
+
+    user_id: int
+    raw: dict[str, bytes]
+    encoded: dict[str, str] = field(init=False)
+
+    def __post_init__(self):
+        encoded = {name: b64encode(value).decode() for name, value in self.raw.items()}
+        object.__setattr__(self, "encoded", encoded)
+
+    @classmethod
+    def from_rows(
+        cls, user: User, prekey: PrekeyBundle, pq_prekey: PQSignedPrekeyBundle
+    ) -> "StaticBundle":
+        assert user.id is not None
+        return cls(
+            user_id=user.id,
+            raw={
+                "identity_key": user.public_key,
+                "signed_prekey": prekey.prekey,
+                "signed_prekey_signature": prekey.sig_prekey,
+                "pq_signed_prekey": pq_prekey.pqspkb,
+                "pq_signed_prekey_signature": pq_prekey.pqspkb_sig,
+            },
+        )
+
+    def fields(self, as_json: bool) -> dict[str, str] | dict[str, bytes]:
+        return self.encoded if as_json else self.raw
+
+
+class StaticBundleCache:
+    """
+    Per-username LRU of `StaticBundle`s, so a bundle fetch only has to claim
+    the one-time prekeys.
+
+    The identity key never changes and the signed prekeys only change through
+    `signed_prekey_push` and `pq_signed_prekey_push`, which call `invalidate`.
+    Users without both signed prekeys are never cached. The cache is local to
+    the process, and a push handled by another worker cannot invalidate it,
+    so each bundle is only served for `ttl` seconds after it was read: a
+    rotation reaches every worker within that time.
+
+    A fetch that read the tables before a push committed must not cache what
+    it read after the push invalidated: `put` takes the `generation` seen
+    before the read and drops the bundle if any invalidation happened since.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0
+        # username -> (bundle, monotonic time it expires)
+        self._bundles: OrderedDict[str, tuple[StaticBundle, float]] = OrderedDict()
+
+    def get(self, username: str) -> StaticBundle | None:
+        entry = self._bundles.get(username)
+        if entry is None:
+            return None
+        bundle, expires = entry
+        if expires <= monotonic():
+            del self._bundles[username]
+            return None
+        self._bundles.move_to_end(username)
+        return bundle
+
+    def put(self, username: str, bundle: StaticBundle, generation: int):
+        if generation != self.generation or self.ttl <= 0:
+            return
+        self._bundles[username] = (bundle, monotonic() + self.ttl)
+        self._bundles.move_to_end(username)
+        if len(self._bundles) > self.max_size:
+            self._bundles.popitem(last=False)
+
+    def invalidate(self, username: str):
+        self.generation += 1
+        self._bundles.pop(username, None)
+
+    def clear(self):
+        self._bundles.clear()
+
+
+static_bundles = StaticBundleCache(
+    config.database.bundle_cache_size, config.database.bundle_cache_ttl
+)
@@ -0,0 +1,146 @@
+import asyncio
+import json
+from collections import Counter, defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+from app.shared import Logger, load_config
+
+logger = Logger(__name__).get_logger()
+
+config = load_config()
+
+# Events are JSON text, encoded once per publish rather than per connection
+SUBSCRIBED_EVENT = '{"type":"subscribed"}'
+RESYNC_EVENT = '{"type":"resync"}'
+
+
+def message_event(message: BaseModel) -> str:
+    payload = message.model_dump(mode="json", by_alias=True)
+    return json.dumps({"type": "message", "message": payload}, separators=(",", ":"))
+
+
+class Subscription:
+    """
+    One push connection's bounded queue of events for a user.
+
+    A connection that falls `max_size` events behind does not grow without
+    limit: its queue is replaced by a single resync event, and later events
+    are dropped until the connection takes it. The client then catches up
+    through grab_return_messages. Nothing is lost, since messages stay stored
+    until they are acknowledged.
+    """
+
+    def __init__(self, user_id: int, max_size: int):
+        self.user_id = user_id
+        self.overflowed = False
+        self._queue: asyncio.Queue[str] = asyncio.Queue(max_size)
+
+    def offer(self, event: str):
+        if self.overflowed:
+            return
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait(RESYNC_EVENT)
+
+    async def get(self) -> str:
+        event = await self._queue.get()
+        if event is RESYNC_EVENT:
+            self.overflowed = False
+        return event
+
+
+class MessageHub:
+    """
+    In-process pub/sub from post_return_message to the recipient's open push
+    connections and long-polling grabs. Publishing never blocks and never
+    awaits, so a slow connection cannot hold up the request that stored the
+    message.
+
+    An idle connection costs one small queue and its handler's coroutines, so
+    a worker can hold thousands. The hub only reaches connections in its own
+    process; clients on other workers see the message on their next
+    grab_return_messages.
+    """
+
+    def __init__(self, queue_size: int, max_parked: int, max_parked_per_user: int):
+        self.queue_size = queue_size
+        self.max_parked = max_parked
+        self.max_parked_per_user = max_parked_per_user
+        self._subscriptions: defaultdict[int, set[Subscription]] = defaultdict(set)
+        # One event per recipient with parked grabs, replaced after each wakeup
+        self._wakeups: dict[int, asyncio.Event] = {}
+        self._parked: Counter[int] = Counter()
+
+    def subscribe(self, user_id: int) -> Subscription:
+        subscription = Subscription(user_id, self.queue_size)
+        self._subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscriptions.get(subscription.user_id)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscriptions[subscription.user_id]
+
+    @contextmanager
+    def parked(self, user_id: int) -> Iterator[asyncio.Event]:
+        """
+        Reserve a long-poll slot for `user_id`, yielding the event the next
+        publish to them sets. Take it before checking for messages, so one
+        posted in between still wakes the waiter.
+        """
+        if self.waiting >= self.max_parked:
+            raise HTTPException(status_code=503, detail="Too many waiting requests")
+        if self._parked[user_id] >= self.max_parked_per_user:
+            raise HTTPException(
+                status_code=429, detail="Too many waiting requests for this user"
+            )
+
+        wakeup = self._wakeups.setdefault(user_id, asyncio.Event())
+        self._parked[user_id] += 1
+        try:
+            yield wakeup
+        finally:
+            self._parked[user_id] -= 1
+            if not self._parked[user_id]:
+                del self._parked[user_id]
+                if self._wakeups.get(user_id) is wakeup:
+                    del self._wakeups[user_id]
+
+    def publish(self, user_id: int, event: str) -> int:
+        """
+        Queue `event` for every connection of `user_id` and wake their parked
+        grabs; returns how many connections got it.
+        """
+        wakeup = self._wakeups.pop(user_id, None)
+        if wakeup is not None:
+            wakeup.set()
+        subscriptions = self._subscriptions.get(user_id, ())
+        for subscription in subscriptions:
+            subscription.offer(event)
+        return len(subscriptions)
+
+    @property
+    def connections(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    @property
+    def waiting(self) -> int:
+        return self._parked.total()
+
+
+messages_hub = MessageHub(
+    config.messages.push_queue_size,
+    max_parked=config.messages.max_parked,
+    max_parked_per_user=config.messages.max_parked_per_user,
+)
@@ -0,0 +1,361 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import struct
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+from fastapi.concurrency import run_in_threadpool
+
+from app.shared import Logger
+
+logger = Logger(__name__).get_logger()
+
+# Hits to write to a store: (key, window id) -> count
+type PendingHits = dict[tuple[str, int], int]
+# What a store holds for a key:
+# (window id, previous count, current count, blocked until)
+type StoredWindow = tuple[int, int, int, float]
+
+
+def add_hits(
+    window: int, previous: int, current: int, window_id: int, count: int
+) -> tuple[int, int, int]:
+    """The (window, previous, current) counts after `count` hits in `window_id`."""
+    if window_id == window:
+        return window, previous, current + count
+    if window_id == window + 1:
+        return window_id, current, count
+    if window_id > window + 1:
+        return window_id, 0, count
+    if window_id == window - 1:
+        return window, previous + count, current
+    return window, previous, current  # too old to count
+
+
+class SharedWindows(ABC):
+    """
+    Sliding-window counters shared by every worker through a store, so N
+    workers or nodes give a client one allowance rather than N.
+
+    A key may spend `limit` per `window` seconds, each request its cost,
+    counting the previous window's hits in proportion to how much of it
+    still overlaps, and is blocked for `block_for` seconds once it goes over.
+
+    Decisions never wait on the store. Hits are counted locally and `sync`
+    writes them in one atomic batch, reading back the totals from every
+    worker, so a client can overshoot by what it sends within one sync
+    interval. If the store cannot be reached, this fails open to counting
+    in the process alone until it is back.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        limit: int,
+        block_for: float,
+        max_keys: int,
+        window: float = 1.0,
+    ):
+        self.namespace = namespace
+        self.limit = limit
+        self.block_for = block_for
+        self.max_keys = max_keys
+        self.window = window
+        self.available = True
+        # Totals last read from the store:
+        # key -> [window id, previous, current, blocked until]
+        self._known: OrderedDict[str, list] = OrderedDict()
+        self._pending: PendingHits = {}
+        # Blocks to write to the store: key -> blocked until
+        self._blocks: dict[str, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._known)
+
+    def allow(self, key: str, now: float, cost: int = 1) -> bool:
+        window_id = int(now // self.window)
+        known = self._known.get(key)
+        if known is None:
+            known = self._known[key] = [window_id, 0, 0, 0.0]
+            if len(self._known) > self.max_keys:
+                self._known.popitem(last=False)
+        else:
+            self._known.move_to_end(key)
+
+        if now < known[3]:
+            return False
+
+        previous, current = self._counts(key, known, window_id)
+        overlap = 1 - (now / self.window - window_id)
+        if previous * overlap + current + cost > self.limit:
+            known[3] = self._blocks[key] = now + self.block_for
+            return False
+        self._pending[(key, window_id)] = self._pending.get((key, window_id), 0) + cost
+        return True
+
+    def _counts(self, key: str, known: list, window_id: int) -> tuple[int, int]:
+        """Hits in the previous and current window, including ours not yet written."""
+        _, previous, current = add_hits(known[0], known[1], known[2], window_id, 0)
+        previous += self._pending.get((key, window_id - 1), 0)
+        current += self._pending.get((key, window_id), 0)
+        return previous, current
+
+    async def sync(self):
+        if not self._pending and not self._blocks:
+            return
+        pending, self._pending = self._pending, {}
+        blocks, self._blocks = self._blocks, {}
+        try:
+            stored = await self._exchange(pending, blocks)
+        except Exception as e:
+            if self.available:
+                logger.warning(
+                    "Rate limit store for %s unavailable, limiting per process: %s",
+                    self.namespace,
+                    e,
+                )
+            self.available = False
+            self._count_locally(pending)
+            return
+
+        if not self.available:
+            logger.info("Rate limit store for %s is back", self.namespace)
+        self.available = True
+        for key, (window, previous, current, blocked_until) in stored.items():
+            known = self._known.get(key)
+            if known is not None:
+                known[:] = [window, previous, current, max(known[3], blocked_until)]
+
+    def _count_locally(self, pending: PendingHits):
+        for (key, window_id), count in sorted(
+            pending.items(), key=lambda item: item[0][1]
+        ):
+            known = self._known.get(key)
+            if known is not None:
+                known[:3] = add_hits(known[0], known[1], known[2], window_id, count)
+
+    @abstractmethod
+    async def _exchange(
+        self, pending: PendingHits, blocks: dict[str, float]
+    ) -> dict[str, StoredWindow]:
+        """Add the hits and blocks to the store and read back each touched key."""
+
+    def sweep(self, now: float) -> int:
+        """Forget keys whose windows have passed, oldest first; returns how many."""
+        window_id = int(now // self.window)
+        freed = 0
+        while self._known:
+            key, known = next(iter(self._known.items()))
+            if known[0] >= window_id - 1 or now < known[3]:
+                break
+            del self._known[key]
+            freed += 1
+        return freed
+
+    def store_key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+
+class SharedMemoryWindows(SharedWindows):
+    """
+    `SharedWindows` for the workers of one host, in a memory-mapped file.
+
+    The file is a fixed table of `slots` rows, so it never grows: a key's row
+    is found by linear probing from its hash, and when the probe finds no
+    room the row with the oldest window is taken over. Each sync takes an
+    exclusive `flock` on the file for the whole batch, which makes it atomic
+    between workers. The batch runs in a worker thread, so waiting for
+    another process's lock never stalls the event loop.
+    """
+
+    # Key hash, window id, previous count, current count, blocked until
+    ROW = struct.Struct("<QqIId")
+    PROBES = 8
+
+    def __init__(  # noqa: PLR0913 # the common settings, then this store's
+        self,
+        namespace: str,
+        limit: int,
+        block_for: float,
+        max_keys: int,
+        *,
+        path: str,
+        slots: int,
+    ):
+        super().__init__(namespace, limit, block_for, max_keys)
+        self.slots = slots
+        size = self.ROW.size * slots
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._file = Path(path).open("a+b")  # noqa: SIM115 # open for our lifetime
+        with self._locked():
+            if Path(path).stat().st_size < size:
+                self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def key_hash(key: str) -> int:
+        # Zero marks an empty row
+        return (
+            int.from_bytes(
+                hashlib.blake2b(key.encode(), digest_size=8).digest(), "little"
+            )
+            | 1
+        )
+
+    def _row(self, key_hash: int) -> int:
+        """Offset of the row for `key_hash`, claiming one if it has none."""
+        oldest_offset, oldest_window = -1, math.inf
+        for probe in range(self.PROBES):
+            offset = (key_hash + probe) % self.slots * self.ROW.size
+            row_hash, window, *_ = self.ROW.unpack_from(self._map, offset)
+            if row_hash == key_hash:
+                return offset
+            if row_hash == 0:
+                oldest_offset = offset
+                break
+            if window < oldest_window:
+                oldest_offset, oldest_window = offset, window
+        self.ROW.pack_into(self._map, oldest_offset, key_hash, 0, 0, 0, 0.0)
+        return oldest_offset
+
+    async def _exchange(
+        self, pending: PendingHits, blocks: dict[str, float]
+    ) -> dict[str, StoredWindow]:
+        return await run_in_threadpool(self._exchange_locked, pending, blocks)
+
+    def _exchange_locked(
+        self, pending: PendingHits, blocks: dict[str, float]
+    ) -> dict[str, StoredWindow]:
+        offsets: dict[str, int] = {}
+        with self._locked():
+            for (key, window_id), count in sorted(
+                pending.items(), key=lambda item: item[0][1]
+            ):
+                offset = offsets.get(key)
+                if offset is None:
+                    offset = offsets[key] = self._row(
+                        self.key_hash(self.store_key(key))
+                    )
+                key_hash, window, previous, current, blocked_until = (
+                    self.ROW.unpack_from(self._map, offset)
+                )
+                window, previous, current = add_hits(
+                    window, previous, current, window_id, count
+                )
+                self.ROW.pack_into(
+                    self._map,
+                    offset,
+                    key_hash,
+                    window,
+                    previous,
+                    current,
+                    blocked_until,
+                )
+            for key, until in blocks.items():
+                offset = offsets.get(key)
+                if offset is None:
+                    offset = offsets[key] = self._row(
+                        self.key_hash(self.store_key(key))
+                    )
+                key_hash, window, previous, current, blocked_until = (
+                    self.ROW.unpack_from(self._map, offset)
+                )
+                self.ROW.pack_into(
+                    self._map,
+                    offset,
+                    key_hash,
+                    window,
+                    previous,
+                    current,
+                    max(blocked_until, until),
+                )
+            stored: dict[str, StoredWindow] = {}
+            for key, offset in offsets.items():
+                _, window, previous, current, blocked_until = self.ROW.unpack_from(
+                    self._map, offset
+                )
+                stored[key] = (window, previous, current, blocked_until)
+            return stored
+
+
+class RedisWindows(SharedWindows):
+    """
+    `SharedWindows` for several hosts, in Redis or anything that speaks its
+    protocol. Each sync is one MULTI/EXEC round trip: INCRBY on a counter
+    per key and window (expiring after three windows), SET NX PX for new
+    blocks, then the two windows' counters and the block read back.
+    Needs the `redis` extra.
+    """
+
+    def __init__(  # noqa: PLR0913 # the common settings, then this store's
+        self,
+        namespace: str,
+        limit: int,
+        block_for: float,
+        max_keys: int,
+        *,
+        url: str,
+        timeout: float,
+    ):
+        super().__init__(namespace, limit, block_for, max_keys)
+        import redis.asyncio  # noqa: PLC0415 # optional dependency
+
+        self.client = redis.asyncio.from_url(
+            url, socket_timeout=timeout, socket_connect_timeout=timeout
+        )
+        self.block_ms = max(1, math.ceil(block_for * 1000))
+
+    def _counter(self, key: str, window_id: int) -> str:
+        return f"benji:rate:{self.store_key(key)}:{window_id}"
+
+    def _block(self, key: str) -> str:
+        return f"benji:rate:{self.store_key(key)}:blocked"
+
+    async def _exchange(
+        self, pending: PendingHits, blocks: dict[str, float]
+    ) -> dict[str, StoredWindow]:
+        expire_after = math.ceil(3 * self.window)
+        # Read back the latest window each key was hit in
+        latest: dict[str, int] = {}
+        for key, window_id in pending:
+            latest[key] = max(window_id, latest.get(key, window_id))
+        for key in blocks:
+            known = self._known.get(key)
+            latest.setdefault(key, known[0] if known else 0)
+
+        async with self.client.pipeline(transaction=True) as pipe:
+            for (key, window_id), count in pending.items():
+                pipe.incrby(self._counter(key, window_id), count)
+                pipe.expire(self._counter(key, window_id), expire_after)
+            for key, until in blocks.items():
+                pipe.set(self._block(key), until, px=self.block_ms, nx=True)
+            for key, window_id in latest.items():
+                pipe.get(self._counter(key, window_id - 1))
+                pipe.get(self._counter(key, window_id))
+                pipe.get(self._block(key))
+            replies = await pipe.execute()
+
+        reads = replies[len(replies) - 3 * len(latest) :]
+        stored: dict[str, StoredWindow] = {}
+        for index, (key, window_id) in enumerate(latest.items()):
+            previous, current, blocked_until = reads[3 * index : 3 * index + 3]
+            stored[key] = (
+                window_id,
+                int(previous or 0),
+                int(current or 0),
+                float(blocked_until or 0),
+            )
+        return stored
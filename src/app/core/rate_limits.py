@@ -0,0 +1,291 @@
+import asyncio
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Protocol
+
+from fastapi import HTTPException
+
+from app.core.rate_limit_stores import RedisWindows, SharedMemoryWindows
+from app.shared import Logger, load_config
+from app.shared.config import RateLimit
+
+logger = Logger(__name__).get_logger()
+
+config = load_config()
+config_rate_limit = config.network.rate_limit
+
+# Clients name the signing user here so the user's budget can be checked
+# before the body is read; SignedPayload.unwrap rejects a mismatch
+USERNAME_HEADER = "X-Username"
+
+
+class RateLimitStore(Protocol):
+    """
+    Per-key request budgets. `allow` decides at once, without I/O; a store
+    shared between processes writes what it counted in `sync`.
+    """
+
+    def __len__(self) -> int: ...
+
+    def allow(self, key: str, now: float, cost: int = 1) -> bool: ...
+
+    def sweep(self, now: float) -> int: ...
+
+    async def sync(self): ...
+
+
+class TokenBuckets:
+    """
+    One token bucket per key: `burst` tokens at once, refilled at `rate` per
+    second. `allow` spends `cost` tokens on a request, and a key that runs
+    dry is refused for `block_for` seconds. `delay` spends tokens on bytes
+    instead, going into debt rather than refusing, and says how long to
+    wait for the debt to be paid off.
+
+    The buckets live in preallocated arrays with room for `max_keys` keys, so
+    memory does not grow with the number of clients. Keys are kept in LRU
+    order; a new key past the cap takes the slot of the least recently used
+    one. `sweep` frees the slots of idle keys: a key whose bucket has refilled
+    and which is not blocked is exactly as a new key would be, so dropping it
+    loses nothing.
+    """
+
+    def __init__(self, rate: float, burst: float, block_for: float, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self.block_for = block_for
+        self.max_keys = max_keys
+        self._slots: OrderedDict[str, int] = OrderedDict()
+        self._free = list(range(max_keys - 1, -1, -1))
+        self._tokens = array("d", bytes(8 * max_keys))
+        self._updated = array("d", bytes(8 * max_keys))
+        self._blocked_until = array("d", bytes(8 * max_keys))
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def allow(self, key: str, now: float, cost: int = 1) -> bool:
+        slot = self._touch(key, now)
+        if now < self._blocked_until[slot]:
+            return False
+
+        tokens = self._refill(slot, now)
+        if tokens < cost:
+            self._tokens[slot] = tokens
+            self._blocked_until[slot] = now + self.block_for
+            return False
+        self._tokens[slot] = tokens - cost
+        return True
+
+    def delay(self, key: str, amount: int, now: float) -> float:
+        """Spend `amount` tokens; returns the seconds until they are covered."""
+        slot = self._touch(key, now)
+        tokens = self._refill(slot, now) - amount
+        self._tokens[slot] = tokens
+        return max(0.0, -tokens / self.rate)
+
+    def _touch(self, key: str, now: float) -> int:
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._claim(key)
+            self._tokens[slot] = self.burst
+            self._updated[slot] = now
+            self._blocked_until[slot] = 0
+        else:
+            self._slots.move_to_end(key)
+        return slot
+
+    def _refill(self, slot: int, now: float) -> float:
+        elapsed = now - self._updated[slot]
+        self._updated[slot] = now
+        return min(self.burst, self._tokens[slot] + elapsed * self.rate)
+
+    def _claim(self, key: str) -> int:
+        if self._free:
+            slot = self._free.pop()
+        else:
+            _, slot = self._slots.popitem(last=False)
+        self._slots[key] = slot
+        return slot
+
+    def sweep(self, now: float) -> int:
+        """Free the slots of idle keys, oldest first; returns how many."""
+        freed = 0
+        while self._slots:
+            key, slot = next(iter(self._slots.items()))
+            elapsed = now - self._updated[slot]
+            if (
+                self._tokens[slot] + elapsed * self.rate < self.burst
+                or now < self._blocked_until[slot]
+            ):
+                break
+            del self._slots[key]
+            self._free.append(slot)
+            freed += 1
+        return freed
+
+    async def sync(self):
+        """Nothing to share: the buckets only ever live in this process."""
+
+
+class RateLimiter:
+    """
+    Request budgets per client IP and per signing username. Callers pass the
+    wall clock as `now`, so that processes sharing a store agree on windows.
+
+    A request to a path in `costs` spends that many requests' worth of the
+    budget, so that an upload is not as cheap as pushing a prekey.
+    """
+
+    def __init__(
+        self,
+        ips: RateLimitStore,
+        users: RateLimitStore,
+        sweep_interval: float,
+        costs: Mapping[str, int] | None = None,
+    ):
+        self.sweep_interval = sweep_interval
+        self.ips = ips
+        self.users = users
+        self.costs = dict(costs or {})
+        self._next_sweep = 0.0
+
+    @property
+    def tracked_keys(self) -> int:
+        return len(self.ips) + len(self.users)
+
+    def cost(self, path: str) -> int:
+        return self.costs.get(path, 1)
+
+    def check_ip(self, ip: str, now: float, cost: int = 1):
+        self._sweep_if_due(now)
+        self._check(self.ips, ip, now, cost)
+
+    def check_user(self, username: str, now: float, cost: int = 1):
+        self._check(self.users, username, now, cost)
+
+    @staticmethod
+    def check_signer(claimed: str | None, username: str):
+        """
+        Once the body is parsed: the request was charged to the user its
+        X-Username header named, so that must be the signer.
+        """
+        if claimed != username:
+            raise HTTPException(
+                status_code=400,
+                detail=f"{USERNAME_HEADER} does not match the signed payload",
+            )
+
+    async def sync(self):
+        await self.ips.sync()
+        await self.users.sync()
+
+    @staticmethod
+    def _check(buckets: RateLimitStore, key: str, now: float, cost: int):
+        if not buckets.allow(key, now, cost):
+            raise HTTPException(status_code=429, detail="Too many requests.")
+
+    def _sweep_if_due(self, now: float):
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        freed = self.ips.sweep(now) + self.users.sweep(now)
+        logger.debug(
+            "Rate limiter freed %d idle keys, tracking %d", freed, self.tracked_keys
+        )
+
+
+class ByteShaper:
+    """
+    A byte rate per client IP and per X-Username, for bodies going one way.
+    Clients over it are not refused: `delay` says how long to hold the next
+    chunk so that the stream averages out at the rate, after a first
+    `burst` of bytes at full speed.
+    """
+
+    def __init__(self, ips: TokenBuckets, users: TokenBuckets, sweep_interval: float):
+        self.sweep_interval = sweep_interval
+        self.ips = ips
+        self.users = users
+        self._next_sweep = 0.0
+
+    def delay(
+        self, ip: str | None, username: str | None, size: int, now: float
+    ) -> float:
+        self._sweep_if_due(now)
+        wait = 0.0
+        if ip is not None:
+            wait = self.ips.delay(ip, size, now)
+        if username is not None:
+            wait = max(wait, self.users.delay(username, size, now))
+        return wait
+
+    def _sweep_if_due(self, now: float):
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        self.ips.sweep(now)
+        self.users.sweep(now)
+
+
+def rate_limit_store(namespace: str, settings: RateLimit) -> RateLimitStore:
+    rate = settings.requests_per_second
+    block_for = settings.timeout_period
+    max_keys = settings.max_tracked_keys
+    match settings.store:
+        case "memory":
+            return TokenBuckets(rate, rate, block_for, max_keys)
+        case "shared_memory":
+            return SharedMemoryWindows(
+                namespace,
+                rate,
+                block_for,
+                max_keys,
+                path=settings.shared_memory_path,
+                slots=settings.shared_memory_slots,
+            )
+        case "redis":
+            return RedisWindows(
+                namespace,
+                rate,
+                block_for,
+                max_keys,
+                url=settings.redis_url,
+                timeout=settings.redis_timeout,
+            )
+
+
+def byte_shaper(bytes_per_second: int, settings: RateLimit) -> ByteShaper | None:
+    if bytes_per_second <= 0:
+        return None
+    return ByteShaper(
+        *(
+            TokenBuckets(
+                bytes_per_second,
+                settings.byte_burst,
+                block_for=0,
+                max_keys=settings.max_tracked_keys,
+            )
+            for _ in range(2)
+        ),
+        sweep_interval=settings.sweep_interval,
+    )
+
+
+rate_limiter = RateLimiter(
+    rate_limit_store("ip", config_rate_limit),
+    rate_limit_store("user", config_rate_limit),
+    sweep_interval=config_rate_limit.sweep_interval,
+    costs=config_rate_limit.costs,
+)
+# None where the direction is not limited
+incoming_bytes = byte_shaper(config_rate_limit.bytes_in_per_second, config_rate_limit)
+outgoing_bytes = byte_shaper(config_rate_limit.bytes_out_per_second, config_rate_limit)
+
+
+async def run_rate_limit_sync(interval: float = config_rate_limit.sync_interval):
+    """Background task: write the hits counted here to the shared store."""
+    while True:
+        await asyncio.sleep(interval)
+        await rate_limiter.sync()
@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from collections.abc import Collection
+from dataclasses import dataclass
+
+from fastapi import HTTPException
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.negative_cache import missing_usernames
+from app.models.schema import User
+from app.shared import Logger, load_config
+
+logger = Logger(__name__).get_logger()
+
+config = load_config()
+
+
+class UsernameResolver:
+    """
+    Maps usernames at the API edge to the integer `user.id` the tables key on.
+
+    Usernames are never changed or freed, so a cached id cannot go stale and
+    needs no invalidation. Names `missing_usernames` knows to be unregistered
+    are answered without a query, and misses are reported to it.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._ids: OrderedDict[str, int] = OrderedDict()
+
+    def remember(self, username: str, user_id: int):
+        self._ids[username] = user_id
+        self._ids.move_to_end(username)
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    def cached(self, username: str) -> int | None:
+        user_id = self._ids.get(username)
+        if user_id is not None:
+            self._ids.move_to_end(username)
+        return user_id
+
+    async def resolve(self, session: AsyncSession, username: str) -> int | None:
+        user_id = self.cached(username)
+        if user_id is not None:
+            return user_id
+        generation = missing_usernames.generation
+        if await missing_usernames.known_absent(session, username):
+            return None
+
+        user_id = (
+            await session.exec(select(User.id).where(User.username == username))
+        ).first()
+        if user_id is not None:
+            self.remember(username, user_id)
+        else:
+            missing_usernames.miss(username, generation)
+        return user_id
+
+    async def resolve_many(
+        self, session: AsyncSession, names: Collection[str]
+    ) -> dict[str, int]:
+        """Ids of the users among `names` that exist; one query for the uncached."""
+        ids = {name: user_id for name in names if (user_id := self.cached(name))}
+        generation = missing_usernames.generation
+        uncached = [name for name in names if name not in ids]
+        absent = await missing_usernames.absent(session, uncached)
+        missing = [name for name in uncached if name not in absent]
+        if missing:
+            rows = await session.exec(
+                select(User.username, User.id).where(col(User.username).in_(missing))
+            )
+            for username, user_id in rows:
+                if user_id is not None:
+                    self.remember(username, user_id)
+                    ids[username] = user_id
+            for name in missing:
+                if name not in ids:
+                    missing_usernames.miss(name, generation)
+        return ids
+
+    async def require(
+        self, session: AsyncSession, username: str, detail: str = "User not found"
+    ) -> int:
+        """Like `resolve`, but a missing user is a 404."""
+        user_id = await self.resolve(session, username)
+        if user_id is None:
+            logger.error("User not found: %s", username)
+            raise HTTPException(status_code=404, detail=detail)
+        return user_id
+
+    def clear(self):
+        self._ids.clear()
+
+
+@dataclass(frozen=True, slots=True)
+class Principal:
+    """
+    The user whose key signed the request, loaded once while it is unwrapped.
+
+    Payload fields naming the user the request acts as (the owner, sharer,
+    or whose keys and messages are read) go through `owner`, which accepts
+    only the signer. Fields naming someone else (a recipient, the revoked
+    user) go through `require`, which resolves any registered user and costs
+    no query for the signer.
+    """
+
+    user_id: int
+    username: str
+
+    def owner(self, username: str) -> int:
+        """The signer's id; 403 if `username` is anyone else."""
+        if username != self.username:
+            logger.warning("Request signed by %s acts as %s", self.username, username)
+            raise HTTPException(
+                status_code=403, detail=f"Only {username} can sign this request"
+            )
+        return self.user_id
+
+    async def require(
+        self, session: AsyncSession, username: str, detail: str = "User not found"
+    ) -> int:
+        if username == self.username:
+            return self.user_id
+        return await usernames.require(session, username, detail)
+
+
+usernames = UsernameResolver(config.database.username_cache_size)
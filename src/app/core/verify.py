@@ -11,7 +11,9 @@ from app.shared.logger import Logger
 logger = Logger(__name__).get_logger()
 
 
-def signature_verify(public_key: Ed25519PublicKey, signature: str, data: str):
+def signature_verify(
+    public_key: Ed25519PublicKey, signature: str | bytes, data: str | bytes
+):
     # def verify_signature(self) -> None:
     """
     Verifies the Ed25519 signature of the payload.
@@ -20,8 +22,12 @@ def signature_verify(public_key: Ed25519PublicKey, signature: str, data: str):
     logger.debug("Starting signature verification.")
 
     try:
-        signature_bytes = base64.b64decode(signature)
-        public_key.verify(signature_bytes, data.encode(encoding="UTF-8"))
+        # msgpack clients send raw bytes, JSON clients send base64 / UTF-8 text
+        if isinstance(signature, str):
+            signature = base64.b64decode(signature)
+        if isinstance(data, str):
+            data = data.encode(encoding="UTF-8")
+        public_key.verify(signature, data)
     except InvalidSignature as e:
         logger.warning("Signature verification failed: %s", e)
         raise HTTPException(status_code=400, detail="Invalid signature") from e
@@ -1,13 +1,29 @@
+import asyncio
 import logging
+from contextlib import asynccontextmanager
 
 from fastapi import (
     FastAPI,
 )
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.middleware import RateLimit
+from app.core.messages import run_message_expiry
+from app.core.negative_cache import run_negative_cache_refresh
+from app.core.prekeys import PREKEYS_LOW_HEADER
+from app.core.rate_limits import incoming_bytes, outgoing_bytes, run_rate_limit_sync
+from app.middleware import (
+    QUERY_COUNT_HEADER,
+    RATE_LIMIT_KEYS_HEADER,
+    SERVER_TIMING_HEADER,
+    BodyLimit,
+    QueryCount,
+    RateLimit,
+    Throttle,
+    Timing,
+)
 from app.routers import get_routers
 from app.shared import Logger, load_config
+from app.shared.db import is_sqlite, run_incremental_vacuum, run_wal_checkpoints
 
 logger = Logger(__name__, level=logging.DEBUG).get_logger()
 
@@ -15,10 +31,40 @@ config = load_config()
 endpoint = config.endpoint
 
 
+# ================================================================================
+#       Background Tasks
+# ================================================================================
+def background_tasks():
+    messages = config.messages
+    if messages.ttl > 0 and messages.expiry_interval > 0:
+        yield run_message_expiry()
+    negative_cache = config.database.negative_cache
+    if negative_cache.enabled and negative_cache.refresh_interval > 0:
+        yield run_negative_cache_refresh()
+    if config.network.rate_limit.store != "memory":
+        yield run_rate_limit_sync()
+    if not is_sqlite(config.database.path):
+        return
+    sqlite = config.database.sqlite
+    if sqlite.checkpoint_interval > 0:
+        yield run_wal_checkpoints()
+    if sqlite.auto_vacuum == "INCREMENTAL" and sqlite.vacuum_interval > 0:
+        yield run_incremental_vacuum()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tasks = [asyncio.create_task(coroutine) for coroutine in background_tasks()]
+    yield
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
 # ================================================================================
 #       FastAPI Setup
 # ================================================================================
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Routers must be added before web, otherwise the web routes will take precedence
 for router in get_routers():
@@ -32,9 +78,30 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[
+        PREKEYS_LOW_HEADER,
+        QUERY_COUNT_HEADER,
+        RATE_LIMIT_KEYS_HEADER,
+        SERVER_TIMING_HEADER,
+    ],
 )
 
-app.add_middleware(RateLimit)
+# All plain ASGI middleware, so none of them puts the request in a task of its
+# own or buffers a streaming response. The last one added runs first.
+
+# Inside RateLimit and BodyLimit, so refused requests never reach it
+if incoming_bytes is not None or outgoing_bytes is not None:
+    app.add_middleware(Throttle)
+
+app.add_middleware(BodyLimit)
+
+app.add_middleware(RateLimit, report_keys=config.logging.rate_limit_keys)
+
+if config.logging.query_counts:
+    app.add_middleware(QueryCount)
+
+if config.logging.server_timing:
+    app.add_middleware(Timing)
 
 
 # ================================================================================
@@ -1,4 +1,16 @@
-from .rate_limit import RateLimit
-
-__all__ = ["RateLimit"]
+from .body_limit import BodyLimit
+from .query_count import QUERY_COUNT_HEADER, QueryCount
+from .rate_limit import RATE_LIMIT_KEYS_HEADER, RateLimit
+from .throttle import Throttle
+from .timing import SERVER_TIMING_HEADER, Timing
 
+__all__ = [
+    "QUERY_COUNT_HEADER",
+    "RATE_LIMIT_KEYS_HEADER",
+    "SERVER_TIMING_HEADER",
+    "BodyLimit",
+    "QueryCount",
+    "RateLimit",
+    "Throttle",
+    "Timing",
+]
@@ -0,0 +1,49 @@
+from fastapi import HTTPException, Response
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.shared import Logger, load_config
+
+logger = Logger(__name__).get_logger()
+
+config = load_config()
+
+
+class BodyLimit:
+    """
+    Refuses request bodies over `max_size` bytes with 413. A declared
+    Content-Length over it is refused before the app runs; a body sent
+    without one is counted as it arrives, and the read that goes over
+    raises the 413 from inside the handler.
+    """
+
+    def __init__(self, app: ASGIApp, max_size: int = config.network.max_body_size):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length is not None and int(content_length) > self.max_size:
+            logger.warning("Refused %s byte body for %s", content_length, scope["path"])
+            await Response(status_code=413)(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"Request body exceeds {self.max_size} bytes",
+                    )
+            return message
+
+        await self.app(scope, limited_receive, send)
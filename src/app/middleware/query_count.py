@@ -0,0 +1,37 @@
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.shared import Logger
+from app.shared.db import recording_queries
+
+logger = Logger(__name__).get_logger()
+
+QUERY_COUNT_HEADER = "X-Query-Count"
+
+
+class QueryCount:
+    """
+    Counts the SQL statements each request runs before its response starts,
+    logs them at debug level and reports them in the X-Query-Count header, so
+    tests can catch a handler that starts querying the same rows again.
+    Statements run later by a streaming response are not counted.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with recording_queries() as queries:
+
+            async def send_with_count(message: Message):
+                if message["type"] == "http.response.start":
+                    logger.debug("%s ran %d queries", scope["path"], len(queries))
+                    headers = MutableHeaders(scope=message)
+                    headers[QUERY_COUNT_HEADER] = str(len(queries))
+                await send(message)
+
+            await self.app(scope, receive, send_with_count)
@@ -1,120 +1,79 @@
-from collections import deque
-from time import monotonic
-from typing import TypeVar
+from time import time
 
-from fastapi import HTTPException, Request, Response
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-from app.models.requests import SignedPayload
-from app.shared import Config, Logger, load_config
+from app.core.rate_limits import USERNAME_HEADER, RateLimiter, rate_limiter
+from app.shared import Logger
 
 logger = Logger(__name__).get_logger()
-config: Config = load_config()
-config_rate_limit = config.network.rate_limit
 
-T = TypeVar("T")
+RATE_LIMIT_KEYS_HEADER = "X-Rate-Limit-Keys"
 
 
-class RateLimit(BaseHTTPMiddleware):
+class RateLimit:
     """Rate Limit middleware for FastApi endpoints
-    Based loosely on sliding window rate limiting.
-    Compares against IP and username.
+    Budgets per IP and per username, see `RateLimiter`; costly routes spend
+    more of them.
+
+    Both checks run before any of the body is read, so a throttled client
+    costs a dictionary lookup, however large its upload. The username comes
+    from the X-Username header, which every request with a body must send;
+    `SignedPayload.unwrap` checks it against the signer once the body is
+    parsed.
+
+    With `report_keys`, every response reports how many IPs and usernames
+    the limiter holds a bucket for in the X-Rate-Limit-Keys header.
     """
 
     def __init__(
         self,
-        app,
-        dispatch=None,
-        max_per_second=config_rate_limit.requests_per_second,
-        timeout_period_s=config_rate_limit.timeout_period,
+        app: ASGIApp,
+        limiter: RateLimiter = rate_limiter,
+        report_keys: bool = False,
     ):
-        super().__init__(app, dispatch)
-
-        # Params
-        self.__max_per_second = max_per_second
-        self.__timeout_period_s = timeout_period_s
-
-        self.__func = None
-
-        # Checks
-        self.__ip: dict[str, deque[float]] = {}
-        self.__user: dict[str, deque[float]] = {}
-        self.__timeout_club: dict[str, float] = {}
+        self.app = app
+        self.limiter = limiter
+        self.report_keys = report_keys
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        # Skip rate limiting for OPTIONS requests (CORS preflight)
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
 
-        # Time
-        self.__now = monotonic()
+        if self.report_keys:
+            send = self._reporting_keys(send)
 
-    async def dispatch(
-        self,
-        request: Request,
-        call_next: RequestResponseEndpoint,
-    ) -> Response:
         try:
-            assert request.client is not None
-
-            # Skip rate limiting for OPTIONS requests (CORS preflight)
-            if request.method == "OPTIONS":
-                return await call_next(request)
-
-            self.__now = monotonic()
-            self.__check_ip(request.client.host)
-
-            # Only check user rate limiting for requests that have JSON bodies
-            if request.method in ["POST", "PUT", "PATCH"]:
-                try:
-                    self.__check_user(
-                        SignedPayload.model_validate(await request.json()).username
-                    )
-                except Exception:
-                    # If we can't parse JSON or extract username, just skip user rate limiting
-                    # IP rate limiting will still apply
-                    pass
-
-            return await call_next(request)
+            client = scope.get("client")
+            assert client is not None
+
+            now = time()
+            cost = self.limiter.cost(scope["path"])
+            self.limiter.check_ip(client[0], now, cost)
+
+            username = Headers(scope=scope).get(USERNAME_HEADER)
+            if username is not None:
+                self.limiter.check_user(username, now, cost)
+            elif scope["method"] not in ("GET", "HEAD"):
+                raise HTTPException(
+                    status_code=400, detail=f"{USERNAME_HEADER} header is required"
+                )
         except HTTPException as e:
-            return Response(status_code=e.status_code)
-
-    def __check_ip(self, ip: str):
-        self.__check(self.__ip, ip)
-
-    def __check_user(self, user: str):
-        self.__check(self.__user, user)
-
-    def __check(self, bucket: dict, key: str):
-        # record the connection timestamp
-        # if property is in timeout; then reject
-        # lazyily prune old records
-        # after pruning, if records exceeds
-        # `max_per_second` then reject
-
-        self.__create_deque(bucket, key)
-        self.__timeout_check(key)
-
-        queue = bucket[key]
-        queue.append(self.__now)
-
-        while self.__now - queue[0] > 1:
-            queue.popleft()
-
-        if len(queue) > self.__max_per_second:
-            self.__timeout(key)
-            raise HTTPException(status_code=429, detail="Too many requests.")
-
-    @staticmethod
-    def __create_deque(bucket: dict, key: str):
-        if key not in bucket:
-            bucket[key] = deque()
-
-    def __timeout_check(self, key: str):
-        if key not in self.__timeout_club:
+            response = JSONResponse({"detail": e.detail}, status_code=e.status_code)
+            await response(scope, receive, send)
             return
 
-        timeout_timestamp = self.__timeout_club[key]
+        await self.app(scope, receive, send)
 
-        if self.__now - timeout_timestamp > self.__timeout_period_s:
-            del self.__timeout_club[key]
-        else:
-            raise HTTPException(status_code=429, detail="Too many requests.")
+    def _reporting_keys(self, send: Send) -> Send:
+        async def send_with_keys(message: Message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers[RATE_LIMIT_KEYS_HEADER] = str(self.limiter.tracked_keys)
+            await send(message)
 
-    def __timeout(self, key: str):
-        self.__timeout_club[key] = monotonic()
+        return send_with_keys
@@ -0,0 +1,66 @@
+import asyncio
+from time import time
+
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core.rate_limits import (
+    USERNAME_HEADER,
+    ByteShaper,
+    incoming_bytes,
+    outgoing_bytes,
+)
+from app.shared import Logger
+
+logger = Logger(__name__).get_logger()
+
+
+class Throttle:
+    """Byte rate middleware for FastApi endpoints
+    Slows request bodies to `incoming` and response bodies to `outgoing`, see
+    `ByteShaper`, so a large upload or download streams at the client's rate
+    instead of being refused.
+
+    A plain ASGI middleware, because pacing the body means wrapping `receive`
+    and `send`, which BaseHTTPMiddleware does not expose. The username comes
+    from the X-Username header; without it only the IP's rate applies.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        incoming: ByteShaper | None = incoming_bytes,
+        outgoing: ByteShaper | None = outgoing_bytes,
+    ):
+        self.app = app
+        self.incoming = incoming
+        self.outgoing = outgoing
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        client = scope.get("client")
+        ip = client[0] if client else None
+        username = Headers(scope=scope).get(USERNAME_HEADER)
+        incoming, outgoing = self.incoming, self.outgoing
+
+        async def throttled_receive() -> Message:
+            message = await receive()
+            if incoming is not None and message["type"] == "http.request":
+                await pause(incoming, len(message.get("body", b"")))
+            return message
+
+        async def throttled_send(message: Message):
+            if outgoing is not None and message["type"] == "http.response.body":
+                await pause(outgoing, len(message.get("body", b"")))
+            await send(message)
+
+        async def pause(shaper: ByteShaper, size: int):
+            delay = shaper.delay(ip, username, size, time())
+            if delay > 0:
+                logger.debug("Throttling %s for %.3fs", ip, delay)
+                await asyncio.sleep(delay)
+
+        await self.app(scope, throttled_receive, throttled_send)
@@ -0,0 +1,48 @@
+from time import perf_counter
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.shared import Logger
+
+logger = Logger(__name__).get_logger()
+
+SERVER_TIMING_HEADER = "Server-Timing"
+
+
+class Timing:
+    """
+    Reports how long each request took until its response started in a
+    Server-Timing header, and logs that and the full time at debug level,
+    so slow handlers show up in browser tools and logs alike.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = perf_counter()
+        first_byte_ms = 0.0
+
+        async def send_with_timing(message: Message):
+            nonlocal first_byte_ms
+            if message["type"] == "http.response.start":
+                first_byte_ms = (perf_counter() - started) * 1000
+                headers = MutableHeaders(scope=message)
+                headers.append(SERVER_TIMING_HEADER, f"app;dur={first_byte_ms:.1f}")
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            logger.debug(
+                "%s %s started its response after %.1fms, done after %.1fms",
+                scope["method"],
+                scope["path"],
+                first_byte_ms,
+                (perf_counter() - started) * 1000,
+            )
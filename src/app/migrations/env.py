@@ -0,0 +1,50 @@
+from logging.config import fileConfig
+
+from alembic import context
+from sqlmodel import SQLModel, create_engine
+
+from app.models import schema  # noqa: F401 # registers the tables on SQLModel.metadata
+from app.shared import load_config
+
+target_metadata = SQLModel.metadata
+
+if context.config.config_file_name is not None:
+    fileConfig(context.config.config_file_name, disable_existing_loggers=False)
+
+
+def run_migrations_offline():
+    context.configure(
+        url=load_config().database.path,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        render_as_batch=True,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    # app.shared.db hands over its own connection; the alembic CLI does not
+    connection = context.config.attributes.get("connection")
+    if connection is None:
+        with create_engine(load_config().database.path).connect() as connection:
+            _run_with(connection)
+    else:
+        _run_with(connection)
+
+
+def _run_with(connection):
+    # SQLite cannot ALTER most things in place, batch mode rebuilds the table
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        render_as_batch=True,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
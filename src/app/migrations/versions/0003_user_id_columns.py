@@ -0,0 +1,86 @@
+"""user id columns (expand)
+
+First half of moving every foreign key from user.username to user.id. Adds
+nullable integer columns next to the username ones, indexes them and fills
+them in. Nothing is dropped, so code that still writes usernames keeps
+working while this runs; 0004 backfills whatever it wrote in the meantime
+and removes the username columns.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19 09:02:41.118305
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: str | None = "0002"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+# (table, username column, id column)
+USER_KEYS = [
+    ("file", "owner_username", "owner_id"),
+    ("fileshare", "owner_username", "owner_id"),
+    ("fileshare", "recipient_username", "recipient_id"),
+    ("prekeybundle", "f_username", "user_id"),
+    ("otp", "f_username", "user_id"),
+    ("pqsignedprekeybundle", "f_username", "user_id"),
+    ("pqonetimeprekey", "f_username", "user_id"),
+    ("messagestore", "recipient_username", "recipient_id"),
+    ("messagestore", "sharer_username", "sharer_id"),
+]
+
+# (table, index name, columns) replacing the username indexes from 0002
+ID_INDEXES = [
+    ("file", "ix_file_owner_id", ["owner_id"]),
+    (
+        "fileshare",
+        "ix_fileshare_file_uuid_recipient_id_revoked",
+        ["file_uuid", "recipient_id", "revoked"],
+    ),
+    ("prekeybundle", "ix_prekeybundle_user_id", ["user_id"]),
+    ("otp", "ix_otp_user_id_used", ["user_id", "used"]),
+    ("pqsignedprekeybundle", "ix_pqsignedprekeybundle_user_id", ["user_id"]),
+    ("pqonetimeprekey", "ix_pqonetimeprekey_user_id_used", ["user_id", "used"]),
+    ("messagestore", "ix_messagestore_recipient_id", ["recipient_id"]),
+]
+
+
+def backfill_user_ids(table_name: str, username_column: str, id_column: str):
+    user = sa.table("user", sa.column("id"), sa.column("username"))
+    table = sa.table(table_name, sa.column(username_column), sa.column(id_column))
+    op.execute(
+        table.update()
+        .where(table.c[id_column].is_(None))
+        .values(
+            {
+                id_column: sa.select(user.c.id)
+                .where(user.c.username == table.c[username_column])
+                .scalar_subquery()
+            }
+        )
+    )
+
+
+def upgrade() -> None:
+    # Plain ADD COLUMN, not batch mode: SQLite adds a nullable column in place
+    for table_name, _, id_column in USER_KEYS:
+        op.add_column(table_name, sa.Column(id_column, sa.Integer(), nullable=True))
+    for table_name, index_name, columns in ID_INDEXES:
+        op.create_index(index_name, table_name, columns)
+    for table_name, username_column, id_column in USER_KEYS:
+        backfill_user_ids(table_name, username_column, id_column)
+
+
+def downgrade() -> None:
+    for table_name, index_name, _ in ID_INDEXES:
+        op.drop_index(index_name, table_name=table_name)
+    for table_name, _, id_column in USER_KEYS:
+        with op.batch_alter_table(table_name) as batch_op:
+            batch_op.drop_column(id_column)
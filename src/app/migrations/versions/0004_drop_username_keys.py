@@ -0,0 +1,136 @@
+"""drop username keys (contract)
+
+Second half of the user.id migration started in 0003. Backfills rows written
+by older code since then, makes the id columns required foreign keys to
+user.id and drops the username columns with their indexes.
+
+Code from before this pair still writes usernames and breaks once this has
+run, and the code after it needs it, so the release that ships both runs
+them one after the other on startup. Only 0003 can run under live traffic:
+upgrade to it by hand while the old release serves, then stop that release
+and start the new one, which applies this.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19 09:04:12.530871
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: str | None = "0003"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+# (table, username column, id column), as in 0003
+USER_KEYS = [
+    ("file", "owner_username", "owner_id"),
+    ("fileshare", "owner_username", "owner_id"),
+    ("fileshare", "recipient_username", "recipient_id"),
+    ("prekeybundle", "f_username", "user_id"),
+    ("otp", "f_username", "user_id"),
+    ("pqsignedprekeybundle", "f_username", "user_id"),
+    ("pqonetimeprekey", "f_username", "user_id"),
+    ("messagestore", "recipient_username", "recipient_id"),
+    ("messagestore", "sharer_username", "sharer_id"),
+]
+
+# (table, index name, columns) from 0002
+USERNAME_INDEXES = [
+    ("file", "ix_file_owner_username", ["owner_username"]),
+    (
+        "fileshare",
+        "ix_fileshare_file_uuid_recipient_username_revoked",
+        ["file_uuid", "recipient_username", "revoked"],
+    ),
+    ("prekeybundle", "ix_prekeybundle_f_username", ["f_username"]),
+    ("otp", "ix_otp_f_username_used", ["f_username", "used"]),
+    ("pqsignedprekeybundle", "ix_pqsignedprekeybundle_f_username", ["f_username"]),
+    ("pqonetimeprekey", "ix_pqonetimeprekey_f_username_used", ["f_username", "used"]),
+    ("messagestore", "ix_messagestore_recipient_username", ["recipient_username"]),
+]
+
+TABLES = list(dict.fromkeys(table_name for table_name, _, _ in USER_KEYS))
+
+
+def copy_user_column(
+    table_name: str, from_column: str, to_column: str, match: str, take: str
+):
+    """Set `to_column` to user.`take` of the user whose `match` is `from_column`."""
+    user = sa.table("user", sa.column("id"), sa.column("username"))
+    table = sa.table(table_name, sa.column(from_column), sa.column(to_column))
+    op.execute(
+        table.update()
+        .where(table.c[to_column].is_(None))
+        .values(
+            {
+                to_column: sa.select(user.c[take])
+                .where(user.c[match] == table.c[from_column])
+                .scalar_subquery()
+            }
+        )
+    )
+
+
+def upgrade() -> None:
+    for table_name, username_column, id_column in USER_KEYS:
+        copy_user_column(table_name, username_column, id_column, "username", "id")
+    for table_name, index_name, _ in USERNAME_INDEXES:
+        op.drop_index(index_name, table_name=table_name)
+
+    # SQLite cannot drop a foreign key column in place, batch mode rebuilds
+    # each table once with all of its changes
+    for table_name in TABLES:
+        with op.batch_alter_table(table_name) as batch_op:
+            for key_table, username_column, id_column in USER_KEYS:
+                if key_table != table_name:
+                    continue
+                batch_op.drop_column(username_column)
+                batch_op.alter_column(
+                    id_column, existing_type=sa.Integer(), nullable=False
+                )
+                batch_op.create_foreign_key(
+                    f"fk_{table_name}_{id_column}_user", "user", [id_column], ["id"]
+                )
+
+
+def downgrade() -> None:
+    for table_name in TABLES:
+        with op.batch_alter_table(table_name) as batch_op:
+            for key_table, username_column, id_column in USER_KEYS:
+                if key_table != table_name:
+                    continue
+                batch_op.drop_constraint(
+                    f"fk_{table_name}_{id_column}_user", type_="foreignkey"
+                )
+                batch_op.alter_column(
+                    id_column, existing_type=sa.Integer(), nullable=True
+                )
+                batch_op.add_column(
+                    sa.Column(username_column, sa.String(), nullable=True)
+                )
+
+    for table_name, username_column, id_column in USER_KEYS:
+        copy_user_column(table_name, id_column, username_column, "id", "username")
+
+    for table_name in TABLES:
+        with op.batch_alter_table(table_name) as batch_op:
+            for key_table, username_column, _ in USER_KEYS:
+                if key_table != table_name:
+                    continue
+                batch_op.alter_column(
+                    username_column, existing_type=sa.String(), nullable=False
+                )
+                batch_op.create_foreign_key(
+                    f"fk_{table_name}_{username_column}_user",
+                    "user",
+                    [username_column],
+                    ["username"],
+                )
+    for table_name, index_name, columns in USERNAME_INDEXES:
+        op.create_index(index_name, table_name, columns)
@@ -0,0 +1,48 @@
+"""delete claimed prekeys
+
+One-time prekeys are now deleted when they are handed out instead of being
+flagged as used. Removes the used rows, drops the `used` column and indexes
+the remaining keys by (user_id, id), the order claims take them in.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19 11:37:44.102385
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0005"
+down_revision: str | None = "0004"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+PREKEY_TABLES = ["otp", "pqonetimeprekey"]
+
+
+def upgrade() -> None:
+    for table_name in PREKEY_TABLES:
+        table = sa.table(table_name, sa.column("used"))
+        op.execute(table.delete().where(table.c.used == sa.true()))
+        op.drop_index(f"ix_{table_name}_user_id_used", table_name=table_name)
+        with op.batch_alter_table(table_name) as batch_op:
+            batch_op.drop_column("used")
+        op.create_index(f"ix_{table_name}_user_id_id", table_name, ["user_id", "id"])
+
+
+def downgrade() -> None:
+    for table_name in PREKEY_TABLES:
+        op.drop_index(f"ix_{table_name}_user_id_id", table_name=table_name)
+        with op.batch_alter_table(table_name) as batch_op:
+            batch_op.add_column(
+                sa.Column(
+                    "used", sa.Boolean(), nullable=False, server_default=sa.false()
+                )
+            )
+        op.create_index(
+            f"ix_{table_name}_user_id_used", table_name, ["user_id", "used"]
+        )
@@ -0,0 +1,57 @@
+"""prekey inventory
+
+Per-user counters of unclaimed one-time prekeys, so clients can see how many
+they have left without counting rows. Every existing user gets a row,
+backfilled from the prekey tables.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-19 13:02:51.418276
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0006"
+down_revision: str | None = "0005"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "prekeyinventory",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("otps", sa.Integer(), nullable=False),
+        sa.Column("pq_otps", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["user.id"]),
+        sa.PrimaryKeyConstraint("user_id"),
+    )
+
+    user = sa.table("user", sa.column("id"))
+    inventory = sa.table(
+        "prekeyinventory", sa.column("user_id"), sa.column("otps"), sa.column("pq_otps")
+    )
+
+    def remaining(table_name: str):
+        table = sa.table(table_name, sa.column("user_id"))
+        return (
+            sa.select(sa.func.count())
+            .where(table.c.user_id == user.c.id)
+            .scalar_subquery()
+        )
+
+    op.execute(
+        inventory.insert().from_select(
+            ["user_id", "otps", "pq_otps"],
+            sa.select(user.c.id, remaining("otp"), remaining("pqonetimeprekey")),
+        )
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("prekeyinventory")
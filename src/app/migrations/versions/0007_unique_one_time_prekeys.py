@@ -0,0 +1,110 @@
+"""unique one-time prekeys
+
+A user can store each one-time prekey once. Classical keys are unique on
+(user_id, otp_val). PQ keys are over 1 KB, so they get a SHA-256 digest column
+and are unique on (user_id, pqotp_digest) instead of indexing the key itself.
+Existing duplicates are deleted, keeping the oldest, and the inventory counts
+are recomputed.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-19 14:21:06.733912
+
+"""
+
+import hashlib
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0007"
+down_revision: str | None = "0006"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+BACKFILL_BATCH = 1000
+
+# (table, unique index, key column)
+UNIQUE_KEYS = [
+    ("otp", "uq_otp_user_id_otp_val", "otp_val"),
+    ("pqonetimeprekey", "uq_pqonetimeprekey_user_id_pqotp_digest", "pqotp_digest"),
+]
+
+
+def backfill_pq_digests():
+    pq = sa.table(
+        "pqonetimeprekey",
+        sa.column("id"),
+        sa.column("pqotp"),
+        sa.column("pqotp_digest"),
+    )
+    connection = op.get_bind()
+    rows = connection.execute(sa.select(pq.c.id, pq.c.pqotp)).all()
+    set_digest = (
+        pq.update()
+        .where(pq.c.id == sa.bindparam("row_id"))
+        .values(pqotp_digest=sa.bindparam("digest"))
+    )
+    for start in range(0, len(rows), BACKFILL_BATCH):
+        connection.execute(
+            set_digest,
+            [
+                {"row_id": row_id, "digest": hashlib.sha256(pqotp).digest()}
+                for row_id, pqotp in rows[start : start + BACKFILL_BATCH]
+            ],
+        )
+
+
+def delete_duplicates(table_name: str, key_column: str):
+    table = sa.table(
+        table_name, sa.column("id"), sa.column("user_id"), sa.column(key_column)
+    )
+    oldest = sa.select(sa.func.min(table.c.id)).group_by(
+        table.c.user_id, table.c[key_column]
+    )
+    op.execute(table.delete().where(table.c.id.not_in(oldest)))
+
+
+def recount_inventory():
+    inventory = sa.table(
+        "prekeyinventory", sa.column("user_id"), sa.column("otps"), sa.column("pq_otps")
+    )
+
+    def remaining(table_name: str):
+        table = sa.table(table_name, sa.column("user_id"))
+        return (
+            sa.select(sa.func.count())
+            .where(table.c.user_id == inventory.c.user_id)
+            .scalar_subquery()
+        )
+
+    op.execute(
+        inventory.update().values(
+            otps=remaining("otp"), pq_otps=remaining("pqonetimeprekey")
+        )
+    )
+
+
+def upgrade() -> None:
+    op.add_column(
+        "pqonetimeprekey", sa.Column("pqotp_digest", sa.LargeBinary(), nullable=True)
+    )
+    backfill_pq_digests()
+    with op.batch_alter_table("pqonetimeprekey") as batch_op:
+        batch_op.alter_column(
+            "pqotp_digest", existing_type=sa.LargeBinary(), nullable=False
+        )
+
+    for table_name, index_name, key_column in UNIQUE_KEYS:
+        delete_duplicates(table_name, key_column)
+        op.create_index(index_name, table_name, ["user_id", key_column], unique=True)
+    recount_inventory()
+
+
+def downgrade() -> None:
+    for table_name, index_name, _ in UNIQUE_KEYS:
+        op.drop_index(index_name, table_name=table_name)
+    with op.batch_alter_table("pqonetimeprekey") as batch_op:
+        batch_op.drop_column("pqotp_digest")
@@ -0,0 +1,34 @@
+"""message pages
+
+grab_return_messages now pages through a recipient's messages by id, so the
+recipient index becomes (recipient_id, id).
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-19 15:48:30.204517
+
+"""
+
+from collections.abc import Sequence
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0008"
+down_revision: str | None = "0007"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_messagestore_recipient_id_id", "messagestore", ["recipient_id", "id"]
+    )
+    op.drop_index("ix_messagestore_recipient_id", table_name="messagestore")
+
+
+def downgrade() -> None:
+    op.create_index(
+        "ix_messagestore_recipient_id", "messagestore", ["recipient_id"]
+    )
+    op.drop_index("ix_messagestore_recipient_id_id", table_name="messagestore")
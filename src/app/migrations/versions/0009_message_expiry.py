@@ -0,0 +1,67 @@
+"""message expiry
+
+Messages get a created_at timestamp so unacknowledged ones can expire, and
+a per-recipient counter so the cap on stored messages is one UPDATE. Existing
+messages are stamped with the migration time, giving them a full TTL, and
+every user gets a counter row backfilled from the stored messages.
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-19 17:05:12.640118
+
+"""
+
+from collections.abc import Sequence
+from datetime import UTC, datetime
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0009"
+down_revision: str | None = "0008"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    # SQLite cannot add a NOT NULL column with a non-constant default, so
+    # stamp existing rows first and tighten the column afterwards
+    op.add_column("messagestore", sa.Column("created_at", sa.DateTime(), nullable=True))
+    messages = sa.table("messagestore", sa.column("created_at", sa.DateTime()))
+    op.execute(messages.update().values(created_at=datetime.now(UTC)))
+    with op.batch_alter_table("messagestore") as batch_op:
+        batch_op.alter_column("created_at", existing_type=sa.DateTime(), nullable=False)
+    op.create_index("ix_messagestore_created_at", "messagestore", ["created_at"])
+
+    op.create_table(
+        "messageinventory",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("messages", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["user.id"]),
+        sa.PrimaryKeyConstraint("user_id"),
+    )
+
+    user = sa.table("user", sa.column("id"))
+    stored = sa.table("messagestore", sa.column("recipient_id"))
+    inventory = sa.table(
+        "messageinventory", sa.column("user_id"), sa.column("messages")
+    )
+    op.execute(
+        inventory.insert().from_select(
+            ["user_id", "messages"],
+            sa.select(
+                user.c.id,
+                sa.select(sa.func.count())
+                .where(stored.c.recipient_id == user.c.id)
+                .scalar_subquery(),
+            ),
+        )
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("messageinventory")
+    op.drop_index("ix_messagestore_created_at", table_name="messagestore")
+    with op.batch_alter_table("messagestore") as batch_op:
+        batch_op.drop_column("created_at")
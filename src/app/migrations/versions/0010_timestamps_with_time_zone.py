@@ -0,0 +1,59 @@
+"""timestamps with time zone
+
+File.date_created, FileShare.shared_at and MessageStore.created_at hold
+aware UTC datetimes. PostgreSQL stored them as timestamp without time zone,
+which asyncpg refuses to bind an aware value to, so the columns become
+timestamptz. Existing values were written as UTC and are read as such.
+SQLite has no separate type, so nothing changes there.
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-19 20:12:44.108352
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0010"
+down_revision: str | None = "0009"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+# (table, column)
+TIMESTAMPS = [
+    ("file", "date_created"),
+    ("fileshare", "shared_at"),
+    ("messagestore", "created_at"),
+]
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    for table_name, column in TIMESTAMPS:
+        op.alter_column(
+            table_name,
+            column,
+            existing_type=sa.DateTime(),
+            type_=sa.DateTime(timezone=True),
+            existing_nullable=False,
+            postgresql_using=f"{column} AT TIME ZONE 'UTC'",
+        )
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    for table_name, column in TIMESTAMPS:
+        op.alter_column(
+            table_name,
+            column,
+            existing_type=sa.DateTime(timezone=True),
+            type_=sa.DateTime(),
+            existing_nullable=False,
+            postgresql_using=f"{column} AT TIME ZONE 'UTC'",
+        )
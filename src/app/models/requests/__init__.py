@@ -1,7 +1,7 @@
 from .files import DownloadFileRequest, UploadFileRequest, UploadFileResponse
 from .register_account import RegisterAccount
-from .serde_base import SerdeBase
-from .signed_payload import SignedPayload
+from .serde_base import MSGPACK_MEDIA_TYPE, MsgPackResponse, SerdeBase, WireBytes
+from .signed_payload import PrincipalDep, SignedPayload
 from .x3dh import (
     GetPrekeyBundleRequest,
     GrabReturnMessagesRequest,
@@ -12,16 +12,20 @@ from .x3dh import (
 )
 
 __all__ = [
+    "MSGPACK_MEDIA_TYPE",
     "DownloadFileRequest",
     "GetPrekeyBundleRequest",
     "GrabReturnMessagesRequest",
     "GrabReturnMessages",
+    "MsgPackResponse",
     "OtpPrekeyPush",
     "PrekeyBundleResponse",
+    "PrincipalDep",
     "RegisterAccount",
     "SerdeBase",
     "SignedPayload",
     "SignedPrekeyPush",
     "UploadFileRequest",
     "UploadFileResponse",
+    "WireBytes",
 ]
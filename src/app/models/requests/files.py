@@ -1,4 +1,4 @@
-from .serde_base import SerdeBase
+from .serde_base import SerdeBase, WireBytes
 
 
 class DownloadFileRequest(SerdeBase):
@@ -10,7 +10,7 @@ class UploadFileRequest(SerdeBase):
     uuid: str
     username: str
     file_name: str  # Original filename from client
-    file_content_b64: str  # Base64 encoded file content
+    file_content_b64: WireBytes  # Base64 encoded file content
 
 
 class ShareFileRequest(SerdeBase):
@@ -32,7 +32,7 @@ class RevokeFileRequest(SerdeBase):
     sharer_username: str
     revoked_username: str
     file_uuid: str
-    file_content_b64: str
+    file_content_b64: WireBytes
 
 
 class RevokeFileResponse(SerdeBase):
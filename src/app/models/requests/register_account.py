@@ -1,5 +1,6 @@
-from .serde_base import SerdeBase
+from .serde_base import SerdeBase, WireBytes
+
 
 class RegisterAccount(SerdeBase):
     username: str
-    public_key: str
+    public_key: WireBytes
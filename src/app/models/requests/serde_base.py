@@ -1,9 +1,58 @@
-from pydantic import BaseModel, ConfigDict
+from base64 import b64encode
+from typing import Annotated, Any
+
+import msgpack
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, ConfigDict, PlainSerializer, SerializationInfo
 from pydantic.alias_generators import to_camel
 
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def _serialize_wire_bytes(value: str | bytes, info: SerializationInfo) -> str | bytes:
+    if isinstance(value, bytes) and info.mode_is_json():
+        return b64encode(value).decode("utf8")
+    return value
+
+
+# Binary field: base64 text when sent as JSON, native bytes when sent as msgpack
+WireBytes = Annotated[str | bytes, PlainSerializer(_serialize_wire_bytes)]
+
+
+def is_msgpack_request(request: Request) -> bool:
+    return request.headers.get("content-type", "").startswith(MSGPACK_MEDIA_TYPE)
+
+
+def accepts_msgpack(request: Request) -> bool:
+    return MSGPACK_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def accepts_ndjson(request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+class MsgPackResponse(Response):
+    media_type = MSGPACK_MEDIA_TYPE
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content, use_bin_type=True) or b""
+
+
 class SerdeBase(BaseModel):
     model_config = ConfigDict(
         alias_generator=to_camel,
         populate_by_name=True,
         from_attributes=True,
-    )
\ No newline at end of file
+    )
+
+    def to_response(
+        self, request: Request, headers: dict[str, str] | None = None
+    ) -> Response:
+        """Encode as msgpack if the client asked for it, JSON otherwise."""
+        if accepts_msgpack(request):
+            return MsgPackResponse(self.model_dump(by_alias=True), headers=headers)
+        return JSONResponse(
+            self.model_dump(mode="json", by_alias=True), headers=headers
+        )
@@ -1,26 +1,45 @@
 import json
 from collections.abc import Awaitable, Callable
+from typing import Annotated, Self
 
+import msgpack
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
-from fastapi import HTTPException, Request
+from fastapi import Depends, HTTPException, Request
 from pydantic import BaseModel
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from app.core.negative_cache import missing_usernames
+from app.core.rate_limits import USERNAME_HEADER, rate_limiter
+from app.core.users import Principal, usernames
 from app.core.verify import signature_verify
+from app.models.requests.serde_base import is_msgpack_request
 from app.models.schema import User
 from app.shared import Logger
-from app.shared.db import engine
+from app.shared.db import SessionDep
 
 logger = Logger(__name__).get_logger()
 
-type UnwrapHandler[T] = Callable[[Request], Awaitable[T]]
+type UnwrapHandler[T] = Callable[[Request, AsyncSession], Awaitable[T]]
 
 
 class SignedPayload[T: BaseModel](BaseModel):
-    payload: str  # JSON string payload (minified)
-    signature: str  # Base64-encoded signature
+    payload: str | bytes  # JSON string payload (minified), or msgpack bytes
+    signature: str | bytes  # Base64-encoded signature, or raw bytes in msgpack
     username: str  # Plaintext string of username
 
+    @classmethod
+    async def from_request(cls, request: Request) -> Self:
+        """Parse the envelope from either a JSON or a msgpack request body."""
+        if is_msgpack_request(request):
+            return cls.model_validate(msgpack.unpackb(await request.body()))
+        return cls.model_validate(await request.json())
+
+    def decode_payload(self) -> dict:
+        if isinstance(self.payload, bytes):
+            return msgpack.unpackb(self.payload)
+        return json.loads(self.payload)
+
     @classmethod
     def unwrap(cls, output_type: T) -> UnwrapHandler[T]:
         return cls._create_handler(output_type, verify_signature=True)
@@ -41,16 +60,19 @@ class SignedPayload[T: BaseModel](BaseModel):
             verify_signature,
         )
 
-        async def unwrap_handler(request: Request) -> T:
+        async def unwrap_handler(request: Request, session: SessionDep) -> T:
             logger.debug("Handling unwrap request.")
             try:
-                signed_payload = cls.model_validate(await request.json())
-                logger.debug("Request JSON body parsed successfully.")
+                signed_payload = await cls.from_request(request)
+                logger.debug("Request body parsed successfully.")
+                rate_limiter.check_signer(
+                    request.headers.get(USERNAME_HEADER), signed_payload.username
+                )
 
                 if verify_signature:
-                    signed_payload.verify()
+                    request.state.principal = await signed_payload.verify(session)
 
-                payload_data = json.loads(signed_payload.payload)
+                payload_data = signed_payload.decode_payload()
                 logger.debug("Payload successfully decoded: %s", payload_data)
 
                 result = output_type.model_validate(payload_data)
@@ -60,7 +82,7 @@ class SignedPayload[T: BaseModel](BaseModel):
                 )
                 return result
 
-            except (ValueError, json.JSONDecodeError) as e:
+            except (ValueError, TypeError, msgpack.UnpackException) as e:
                 logger.warning("Failed to unwrap payload: %s", e)
                 raise HTTPException(
                     status_code=400,
@@ -69,21 +91,46 @@ class SignedPayload[T: BaseModel](BaseModel):
 
         return unwrap_handler
 
-    def verify(self):
-        with Session(engine) as session:
-            statement = select(User).where(User.username == self.username)
-            user = session.exec(statement).first()
+    async def verify(self, session: AsyncSession) -> Principal:
+        user = None
+        generation = missing_usernames.generation
+        if not await missing_usernames.known_absent(session, self.username):
+            statement = select(User.id, User.public_key).where(
+                User.username == self.username
+            )
+            user = (await session.exec(statement)).first()
+            if user is None:
+                missing_usernames.miss(self.username, generation)
 
-        if user is None:
+        if user is None or user[0] is None:
             raise HTTPException(
                 status_code=404,
                 detail="User does not exists",
             )
+        user_id, public_key_bytes = user
 
-        public_key = Ed25519PublicKey.from_public_bytes(user.public_key)
+        public_key = Ed25519PublicKey.from_public_bytes(public_key_bytes)
 
         signature_verify(
             public_key=public_key,
             signature=self.signature,
             data=self.payload,
         )
+
+        # Other requests from this user resolve it by name; seed the id cache
+        usernames.remember(self.username, user_id)
+        return Principal(user_id=user_id, username=self.username)
+
+
+def get_principal(request: Request) -> Principal:
+    """
+    The signer of the request, set by the `SignedPayload.unwrap` dependency.
+    Declare it after the unwrapped payload: dependencies resolve in order.
+    """
+    principal = getattr(request.state, "principal", None)
+    if principal is None:
+        raise RuntimeError("No verified SignedPayload in this request")
+    return principal
+
+
+PrincipalDep = Annotated[Principal, Depends(get_principal)]
@@ -1,28 +1,28 @@
-from .serde_base import SerdeBase
+from .serde_base import SerdeBase, WireBytes
 
 
 class SignedPrekeyPush(SerdeBase):
     username: str
-    signed_prekey_public: str
-    signed_prekey_signature: str
+    signed_prekey_public: WireBytes
+    signed_prekey_signature: WireBytes
 
 
 class OtpPrekeyPush(SerdeBase):
     username: str
-    pub_otps: list[str]  # list of otp public keys
+    pub_otps: list[WireBytes]  # list of otp public keys
 
 
 class PQSignedPrekeyPush(SerdeBase):
     """Post-quantum signed prekey push for PQXDH last-resort KEM prekey"""
     username: str
-    pq_signed_prekey_public: str  # base64-encoded KEM last-resort public key
-    pq_signed_prekey_signature: str  # base64-encoded signature
+    pq_signed_prekey_public: WireBytes  # base64-encoded KEM last-resort public key
+    pq_signed_prekey_signature: WireBytes  # base64-encoded signature
 
 
 class PQOtpData(SerdeBase):
     """Individual PQ OTP entry with public key and signature."""
-    public_key: str
-    signature: str
+    public_key: WireBytes
+    signature: WireBytes
 
 
 class PQOtpPrekeyPush(SerdeBase):
@@ -31,6 +31,16 @@ class PQOtpPrekeyPush(SerdeBase):
     pub_pq_otps: list[PQOtpData]
 
 
+class PrekeyInventoryRequest(SerdeBase):
+    username: str
+
+
+class PrekeyInventoryResponse(SerdeBase):
+    otps: int  # unclaimed classical one-time prekeys
+    pq_otps: int  # unclaimed PQ one-time prekeys
+    low_watermark: int  # replenish before either count drops below this
+
+
 class GetPrekeyBundleRequest(SerdeBase):
     username: str
     target_username: str
@@ -38,53 +48,104 @@ class GetPrekeyBundleRequest(SerdeBase):
 
 class PrekeyBundleResponse(SerdeBase):
     # Classical X3DH fields
-    identity_key: str
-    signed_prekey: str
-    signed_prekey_signature: str
-    one_time_prekey: str
+    identity_key: WireBytes
+    signed_prekey: WireBytes
+    signed_prekey_signature: WireBytes
+    one_time_prekey: WireBytes
     
     # Post-quantum PQXDH fields
-    pq_signed_prekey: str  # base64(KEM last-resort public key)
-    pq_signed_prekey_signature: str  # base64(signature on that key)
+    pq_signed_prekey: WireBytes  # base64(KEM last-resort public key)
+    pq_signed_prekey_signature: WireBytes  # base64(signature on that key)
     
-    one_time_pq_prekey: str | None = None  # base64(one-time KEM public key)
-    one_time_pq_prekey_signature: str | None = None  # base64(signature on one-time key)
+    one_time_pq_prekey: WireBytes | None = None  # base64(one-time KEM public key)
+    # base64(signature on one-time key)
+    one_time_pq_prekey_signature: WireBytes | None = None
+
+
+class GetPrekeyBundlesRequest(SerdeBase):
+    username: str
+    target_usernames: list[str]
+
+
+class PrekeyBundlesResponse(SerdeBase):
+    bundles: dict[str, PrekeyBundleResponse]  # by target username
+    errors: dict[str, str]  # targets without a bundle, and why
 
 
 class ReturnMessage(SerdeBase):
+    id: int  # acknowledge with this id once the message is stored client-side
     # Classical X3DH fields
-    sharer_identity_key_public: str
-    sharer_ephemeral_key_public: str
+    sharer_identity_key_public: WireBytes
+    sharer_ephemeral_key_public: WireBytes
     sharer_username: str
-    otp_hash: str
-    encrypted_message: str
+    otp_hash: WireBytes
+    encrypted_message: WireBytes
     
     # Post-quantum PQXDH fields
-    kem_ciphertext: str  # base64(KEM ciphertext CT)
-    pq_otp_hash: str  # hash of the PQ OTP used
+    kem_ciphertext: WireBytes  # base64(KEM ciphertext CT)
+    pq_otp_hash: WireBytes  # hash of the PQ OTP used
 
 
 class PostReturnMessage(SerdeBase):
     # Classical X3DH fields
     sharer_username: str
     recipient_username: str
-    sharer_identity_key_public: str  # Alice's public iKEK
-    sharer_ephemeral_key_public: str  # Ephemeral key (random key that Alice generated during the secret derivation step)
-    otp_hash: str  # Hash of the Bob's OT PreKey
-    encrypted_message: str  # eMessage (encrypted message)
+    sharer_identity_key_public: WireBytes  # Alice's public iKEK
+    # Ephemeral key (random key that Alice generated during the secret derivation step)
+    sharer_ephemeral_key_public: WireBytes
+    otp_hash: WireBytes  # Hash of the Bob's OT PreKey
+    encrypted_message: WireBytes  # eMessage (encrypted message)
     
     # Post-quantum PQXDH fields
-    kem_ciphertext: str  # base64(KEM ciphertext CT)
-    pq_otp_hash: str  # hash of the PQ OTP used
+    kem_ciphertext: WireBytes  # base64(KEM ciphertext CT)
+    pq_otp_hash: WireBytes  # hash of the PQ OTP used
 
     
 class PostReturnMessageResponse(SerdeBase):
     message: str
 
 
+class RecipientMessage(SerdeBase):
+    """The per-recipient part of a PostReturnMessage."""
+    recipient_username: str
+    sharer_ephemeral_key_public: WireBytes
+    otp_hash: WireBytes
+    encrypted_message: WireBytes
+    kem_ciphertext: WireBytes
+    pq_otp_hash: WireBytes
+
+
+class PostReturnMessages(SerdeBase):
+    sharer_username: str
+    sharer_identity_key_public: WireBytes
+    messages: list[RecipientMessage]
+
+
+class PostReturnMessagesResponse(SerdeBase):
+    posted: dict[str, int]  # message id by recipient username
+    errors: dict[str, str]  # recipients nothing was stored for, and why
+
+
 class GrabReturnMessagesRequest(SerdeBase):
     username: str
+    after: int = 0  # cursor: the next_cursor of the previous page
+    limit: int | None = None  # page size, capped by [messages] page_size
+    wait: float = 0  # seconds to wait for a message if none is queued, up to max_wait
 
 
 class GrabReturnMessages(SerdeBase):
     messages: list[ReturnMessage]
+    next_cursor: int | None = None  # `after` for the next page, None on the last
+
+
+class AckReturnMessagesRequest(SerdeBase):
+    username: str
+    message_ids: list[int]
+
+
+class AckReturnMessagesResponse(SerdeBase):
+    deleted: int
+
+
+class SubscribeMessagesRequest(SerdeBase):
+    username: str
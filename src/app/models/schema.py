@@ -1,5 +1,6 @@
-from datetime import datetime
+from datetime import UTC, datetime
 
+from sqlalchemy import DateTime, Index
 from sqlmodel import Field, Relationship, SQLModel
 
 # TODO - we need to do some stuff to do authentication
@@ -20,19 +21,19 @@ class User(SQLModel, table=True):
     owned_files: list["File"] = Relationship(back_populates="owner")
     shared_files: list["FileShare"] = Relationship(
         back_populates="owner",
-        sa_relationship_kwargs={"foreign_keys": "FileShare.owner_username"},
+        sa_relationship_kwargs={"foreign_keys": "FileShare.owner_id"},
     )
     received_files: list["FileShare"] = Relationship(
         back_populates="recipient",
-        sa_relationship_kwargs={"foreign_keys": "FileShare.recipient_username"},
+        sa_relationship_kwargs={"foreign_keys": "FileShare.recipient_id"},
     )
     received_messages: list["MessageStore"] = Relationship(
         back_populates="recipient",
-        sa_relationship_kwargs={"foreign_keys": "MessageStore.recipient_username"},
+        sa_relationship_kwargs={"foreign_keys": "MessageStore.recipient_id"},
     )
     sent_messages: list["MessageStore"] = Relationship(
         back_populates="sharer",
-        sa_relationship_kwargs={"foreign_keys": "MessageStore.sharer_username"},
+        sa_relationship_kwargs={"foreign_keys": "MessageStore.sharer_id"},
     )
 
 
@@ -43,9 +44,16 @@ class File(SQLModel, table=True):
     )
     file_name: str = Field(..., description="Original name of the file")
     size: int = Field(..., description="Size of the file in bytes")
-    date_created: datetime = Field(..., description="Timestamp when file was created")
-    owner_username: str = Field(
-        ..., foreign_key="user.username", description="Username of the file owner"
+    date_created: datetime = Field(
+        ...,
+        sa_type=DateTime(timezone=True),
+        description="Timestamp when file was created",
+    )
+    owner_id: int = Field(
+        ...,
+        foreign_key="user.id",
+        index=True,
+        description="User.id of the file owner",
     )
 
     # Relationships
@@ -54,18 +62,30 @@ class File(SQLModel, table=True):
 
 
 class FileShare(SQLModel, table=True):
+    # Access checks filter on all three; the prefix also serves share/revoke
+    __table_args__ = (
+        Index(
+            "ix_fileshare_file_uuid_recipient_id_revoked",
+            "file_uuid",
+            "recipient_id",
+            "revoked",
+        ),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     file_uuid: str = Field(
         ..., foreign_key="file.uuid", description="UUID of the shared file"
     )
-    owner_username: str = Field(
-        ..., foreign_key="user.username", description="Username of the file owner"
+    owner_id: int = Field(
+        ..., foreign_key="user.id", description="User.id of the file owner"
     )
-    recipient_username: str = Field(
-        ..., foreign_key="user.username", description="Username of the recipient"
+    recipient_id: int = Field(
+        ..., foreign_key="user.id", description="User.id of the recipient"
     )
     shared_at: datetime = Field(
-        default_factory=datetime.utcnow, description="Timestamp when file was shared"
+        default_factory=lambda: datetime.now(UTC),
+        sa_type=DateTime(timezone=True),
+        description="Timestamp when file was shared",
     )
     revoked: bool = Field(
         default=False, description="Flag indicating if access has been revoked"
@@ -75,18 +95,18 @@ class FileShare(SQLModel, table=True):
     file: File | None = Relationship(back_populates="shares")
     owner: User | None = Relationship(
         back_populates="shared_files",
-        sa_relationship_kwargs={"foreign_keys": "FileShare.owner_username"},
+        sa_relationship_kwargs={"foreign_keys": "FileShare.owner_id"},
     )
     recipient: User | None = Relationship(
         back_populates="received_files",
-        sa_relationship_kwargs={"foreign_keys": "FileShare.recipient_username"},
+        sa_relationship_kwargs={"foreign_keys": "FileShare.recipient_id"},
     )
 
 
 class PrekeyBundle(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    f_username: str = Field(
-        ..., foreign_key="user.username", description="Foreign key to User.username"
+    user_id: int = Field(
+        ..., foreign_key="user.id", index=True, description="Foreign key to User.id"
     )
     prekey: bytes = Field(..., description="Medium term pre-key")
     sig_prekey: bytes = Field(..., description="Signature of the medium term pre-key")
@@ -95,14 +115,17 @@ class PrekeyBundle(SQLModel, table=True):
 
 
 class Otp(SQLModel, table=True):
+    """Unclaimed one-time prekey; the row is deleted when it is handed out"""
+    __table_args__ = (
+        Index("ix_otp_user_id_id", "user_id", "id"),
+        Index("uq_otp_user_id_otp_val", "user_id", "otp_val", unique=True),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
-    f_username: str = Field(
-        ..., foreign_key="user.username", description="Foreign key to User.username"
+    user_id: int = Field(
+        ..., foreign_key="user.id", description="Foreign key to User.id"
     )
     otp_val: bytes = Field(..., description="One-time prekey value")
-    used: bool = Field(
-        default=False, description="Flag indicating if the OTP has been used"
-    )
 
     user: User | None = Relationship(back_populates="otps")
 
@@ -110,8 +133,8 @@ class Otp(SQLModel, table=True):
 class PQSignedPrekeyBundle(SQLModel, table=True):
     """Post-quantum signed prekey bundle for PQXDH last-resort KEM prekey"""
     id: int | None = Field(default=None, primary_key=True)
-    f_username: str = Field(
-        ..., foreign_key="user.username", description="Foreign key to User.username"
+    user_id: int = Field(
+        ..., foreign_key="user.id", index=True, description="Foreign key to User.id"
     )
     pqspkb: bytes = Field(..., description="PQ last-resort KEM public key")
     pqspkb_sig: bytes = Field(..., description="Signature over the KEM public key")
@@ -120,24 +143,56 @@ class PQSignedPrekeyBundle(SQLModel, table=True):
 
 
 class PQOneTimePrekey(SQLModel, table=True):
-    """Post-quantum one-time prekey for PQXDH"""
+    """Unclaimed post-quantum one-time prekey for PQXDH, deleted when handed out"""
+    __table_args__ = (
+        Index("ix_pqonetimeprekey_user_id_id", "user_id", "id"),
+        Index(
+            "uq_pqonetimeprekey_user_id_pqotp_digest",
+            "user_id",
+            "pqotp_digest",
+            unique=True,
+        ),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
-    f_username: str = Field(
-        ..., foreign_key="user.username", description="Foreign key to User.username"
+    user_id: int = Field(
+        ..., foreign_key="user.id", description="Foreign key to User.id"
     )
     pqotp: bytes = Field(..., description="PQ one-time KEM public key")
     pqotp_sig: bytes = Field(..., description="Signature over the one-time KEM public key")
-    used: bool = Field(
-        default=False, description="Flag indicating if the PQ OTP has been used"
+    pqotp_digest: bytes = Field(
+        ..., description="SHA-256 of pqotp, keeps keys unique without indexing them"
     )
 
     user: User | None = Relationship(back_populates="pq_otps")
 
 
+class PrekeyInventory(SQLModel, table=True):
+    """
+    Remaining one-time prekeys per user, kept in step with the Otp and
+    PQOneTimePrekey tables by the push and claim statements.
+    """
+    user_id: int = Field(..., foreign_key="user.id", primary_key=True)
+    otps: int = Field(default=0, description="Unclaimed classical one-time prekeys")
+    pq_otps: int = Field(default=0, description="Unclaimed PQ one-time prekeys")
+
+
+class MessageInventory(SQLModel, table=True):
+    """
+    Stored messages per recipient, kept in step with MessageStore by posts,
+    acks and expiry, so the per-recipient cap costs one UPDATE.
+    """
+    user_id: int = Field(..., foreign_key="user.id", primary_key=True)
+    messages: int = Field(default=0, description="Stored, unacknowledged messages")
+
+
 class MessageStore(SQLModel, table=True):
+    # Pages of a recipient's messages are read in id order
+    __table_args__ = (Index("ix_messagestore_recipient_id_id", "recipient_id", "id"),)
+
     id: int | None = Field(default=None, primary_key=True)
-    recipient_username: str = Field(..., foreign_key="user.username")
-    sharer_username: str = Field(..., foreign_key="user.username")
+    recipient_id: int = Field(..., foreign_key="user.id")
+    sharer_id: int = Field(..., foreign_key="user.id")
     sharer_identity_key_public: bytes = Field(
         ..., description="Sharer's public identity key"
     )
@@ -149,13 +204,20 @@ class MessageStore(SQLModel, table=True):
     # Post-quantum fields for PQXDH
     pq_ct: bytes = Field(..., description="PQ KEM ciphertext for this initial message")
     pq_otp_hash: bytes = Field(..., description="Hash of the recipient's PQ OTP used for this message")
+    # Messages never acknowledged are deleted [messages] ttl after this
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(UTC),
+        sa_type=DateTime(timezone=True),
+        index=True,
+        description="When the message was posted",
+    )
 
     # disambiguated relationships:
     recipient: User | None = Relationship(
         back_populates="received_messages",
-        sa_relationship_kwargs={"foreign_keys": "MessageStore.recipient_username"},
+        sa_relationship_kwargs={"foreign_keys": "MessageStore.recipient_id"},
     )
     sharer: User | None = Relationship(
         back_populates="sent_messages",
-        sa_relationship_kwargs={"foreign_keys": "MessageStore.sharer_username"},
+        sa_relationship_kwargs={"foreign_keys": "MessageStore.sharer_id"},
     )
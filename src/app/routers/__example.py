@@ -4,7 +4,7 @@ from typing import Annotated
 from fastapi import APIRouter, Depends
 from pydantic import BaseModel
 
-from app.models.requests import SignedPayload
+from app.models.requests import PrincipalDep, SignedPayload
 from app.shared import Logger, load_config
 
 logger = Logger(__name__).get_logger()
@@ -23,6 +23,7 @@ async def my_endpoint(
     data: Annotated[
         MyEndpointRequest, Depends(SignedPayload.unwrap(MyEndpointRequest))
     ],
+    principal: PrincipalDep,  # the signer, after the payload it was unwrapped from
 ): ...
 
 
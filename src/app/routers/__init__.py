@@ -1,8 +1,9 @@
 from .auth import router as auth_router
 from .files import router as files_router
+from .push import router as push_router
 from .x3dh import router as x3dh_router
 
-_routers = [auth_router, files_router, x3dh_router]
+_routers = [auth_router, files_router, push_router, x3dh_router]
 
 __all__ = ["get_routers"]
 
@@ -3,13 +3,15 @@ from typing import Annotated
 
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import JSONResponse
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.models.requests import SignedPayload
 from app.models.requests.register_account import RegisterAccount
-from app.models.schema import User
+from app.models.schema import MessageInventory, PrekeyInventory, User
 from app.shared import Logger, load_config
-from app.shared.db import engine
+from app.shared.db import SessionDep
+from app.shared.group_commit import writes
 
 logger = Logger(__name__).get_logger()
 
@@ -23,6 +25,7 @@ async def register(
     data: Annotated[
         RegisterAccount, Depends(SignedPayload.unwrap_no_checks(RegisterAccount))
     ],
+    session: SessionDep,
 ):
     """
     input: master password
@@ -38,22 +41,32 @@ async def register(
     """
     logger.debug(data)
 
-    with Session(engine) as session:
-        # Check if username is unique
-        existing_user = session.exec(
-            select(User).where(User.username == data.username)
-        ).first()
-        if existing_user:
-            raise HTTPException(status_code=403, detail="Username already exists")
-
-        # Persist to db
-        # Assuming RegisterAccount has 'username' and 'public_key' attributes
-        # based on the schema.py and common practice.
-        public_key_bytes = base64.b64decode(data.public_key)
+    # Check if username is unique
+    existing_user = (await session.exec(
+        select(User).where(User.username == data.username)
+    )).first()
+    if existing_user:
+        raise HTTPException(status_code=403, detail="Username already exists")
+
+    # Persist to db
+    # Assuming RegisterAccount has 'username' and 'public_key' attributes
+    # based on the schema.py and common practice.
+    public_key_bytes = (
+        data.public_key
+        if isinstance(data.public_key, bytes)
+        else base64.b64decode(data.public_key)
+    )
+
+    async def store(session: AsyncSession) -> User:
         new_user = User(username=data.username, public_key=public_key_bytes)
         session.add(new_user)
-        session.commit()
-        session.refresh(new_user)
+        await session.flush()
+        assert new_user.id is not None
+        session.add(PrekeyInventory(user_id=new_user.id))
+        session.add(MessageInventory(user_id=new_user.id))
+        return new_user
+
+    new_user = await writes.commit(session, store)
 
     return JSONResponse(
         content={"message": "User registered successfully", "user_id": new_user.id}
@@ -2,21 +2,28 @@ import base64
 from datetime import datetime, UTC
 from pathlib import Path
 from typing import Annotated
+from uuid import uuid4
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse, JSONResponse
-from sqlmodel import Session, select
+from sqlalchemy import and_
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from app.core.negative_cache import missing_files
 from app.models.requests import (
     DownloadFileRequest,
+    PrincipalDep,
     SignedPayload,
     UploadFileRequest,
     UploadFileResponse,
 )
 from app.models.requests.files import DeleteFileRequest, RevokeFileRequest, RevokeFileResponse, ShareFileRequest
-from app.models.schema import File, FileShare, MessageStore, User
+from app.models.schema import File, FileShare
 from app.shared import Logger, load_config
-from app.shared.db import engine
+from app.shared.db import SessionDep
+from app.shared.group_commit import writes
 
 logger = Logger(__name__).get_logger()
 
@@ -46,11 +53,71 @@ def get_safe_file_path(file_uuid: str) -> Path:
     return resolved_path
 
 
+def file_not_found(file_uuid: str) -> HTTPException:
+    return HTTPException(
+        status_code=404, detail=f"File with UUID {file_uuid} not found"
+    )
+
+
+async def find_file(session: AsyncSession, file_uuid: str) -> File:
+    """The file with `file_uuid`, 404 if there is none."""
+    file = None
+    generation = missing_files.generation
+    if not await missing_files.known_absent(session, file_uuid):
+        file = (await session.exec(select(File).where(File.uuid == file_uuid))).first()
+        if not file:
+            missing_files.miss(file_uuid, generation)
+    if not file:
+        raise file_not_found(file_uuid)
+    return file
+
+
+async def file_with_share(
+    session: AsyncSession, file_uuid: str, recipient_id: int
+) -> tuple[File, FileShare | None]:
+    """The file and its share with `recipient_id` in one query; 404 if no file."""
+    generation = missing_files.generation
+    if await missing_files.known_absent(session, file_uuid):
+        raise file_not_found(file_uuid)
+    row = (await session.exec(
+        select(File, FileShare)
+        .outerjoin(
+            FileShare,
+            and_(
+                col(FileShare.file_uuid) == File.uuid,
+                col(FileShare.recipient_id) == recipient_id,
+            ),
+        )
+        .where(File.uuid == file_uuid)
+    )).first()
+    if row is None:
+        missing_files.miss(file_uuid, generation)
+        raise file_not_found(file_uuid)
+    return row
+
+
+def decode_file_content(content: str | bytes) -> bytes:
+    if isinstance(content, bytes):
+        return content
+    return base64.b64decode(content, validate=True)
+
+
+async def save_file(file_path: Path, content: bytes):
+    """Write `content` to `file_path` in a worker thread; 500 if that fails."""
+    try:
+        await run_in_threadpool(file_path.write_bytes, content)
+    except Exception as e:
+        logger.error("Failed to save file to disk: %s", e)
+        raise HTTPException(status_code=500, detail="Failed to save file") from e
+
+
 @router.post("/files/upload", response_model=UploadFileResponse)
 async def upload_file(
     data: Annotated[
         UploadFileRequest, Depends(SignedPayload.unwrap(UploadFileRequest))
     ],
+    principal: PrincipalDep,
+    session: SessionDep,
 ):
     """
     Upload a file via JSON payload. The file content is Base64 encoded.
@@ -65,51 +132,66 @@ async def upload_file(
         "Uploading file: %s for user: %s, UUID: %s", data.file_name, data.username, data.uuid
     )
 
-    with Session(engine) as session:
-        # Verify user exists
-        user = session.exec(select(User).where(User.username == data.username)).first()
-        if not user:
-            raise HTTPException(
-                status_code=404, detail=f"User {data.username} not found"
-            )
+    # Verify the signer is the user named
+    user_id = principal.owner(data.username)
 
-        # Check if file UUID already exists
-        existing_file = session.exec(select(File).where(File.uuid == data.uuid)).first()
-        if existing_file:
+    # Check if file UUID already exists
+    async def check_new_uuid(session: AsyncSession):
+        existing = await session.exec(select(File.id).where(File.uuid == data.uuid))
+        if existing.first():
             raise HTTPException(
                 status_code=409, detail=f"File with UUID {data.uuid} already exists"
             )
 
-        # Decode Base64 file content
-        try:
-            file_content = base64.b64decode(data.file_content_b64, validate=True)
-            file_size = len(file_content)
-            logger.info(
-                "Decoded %s bytes from Base64 input for file: %s", file_size, data.file_name
-            )
-        except Exception as e:
-            logger.error("Failed to decode Base64 content: %s", e)
-            raise HTTPException(status_code=400, detail="Invalid Base64 content") from e
+    await check_new_uuid(session)
+    # Release the request's connection while the content is decoded and saved
+    await session.close()
 
-        # Check file size limits
-        max_file_size = config.files.max_file_size
-        if file_size > max_file_size:
-            logger.warning(
-                "File %s (%s bytes) exceeds maximum file size (%s bytes)", 
-                data.file_name, file_size, max_file_size
-            )
-            raise HTTPException(
-                status_code=413, 
-                detail=f"File size {file_size} bytes exceeds maximum allowed size of {max_file_size} bytes"
-            )
+    # Decode Base64 file content (msgpack clients send the raw bytes)
+    try:
+        file_content = await run_in_threadpool(
+            decode_file_content, data.file_content_b64
+        )
+        file_size = len(file_content)
+        logger.info(
+            "Decoded %s bytes from Base64 input for file: %s", file_size, data.file_name
+        )
+    except Exception as e:
+        logger.error("Failed to decode Base64 content: %s", e)
+        raise HTTPException(status_code=400, detail="Invalid Base64 content") from e
+
+    # Check file size limits
+    max_file_size = config.files.max_file_size
+    if file_size > max_file_size:
+        logger.warning(
+            "File %s (%s bytes) exceeds maximum file size (%s bytes)", 
+            data.file_name, file_size, max_file_size
+        )
+        raise HTTPException(
+            status_code=413, 
+            detail=f"File size {file_size} bytes exceeds maximum allowed size of {max_file_size} bytes"
+        )
+
+    # Create file path using UUID
+    file_path = get_safe_file_path(data.uuid)
+
+    # Save the content under a temporary name; it replaces file_path only
+    # once the record is committed, so a failed upload leaves no file behind
+    # and never overwrites another upload's
+    part_path = uploads_dir / f".{uuid4().hex}.part"
+    await save_file(part_path, file_content)
+
+    async def store(session: AsyncSession):
+        # Checked again here, another upload may have taken the UUID meanwhile
+        await check_new_uuid(session)
 
         # Check total user storage limit
         max_total_storage = config.files.max_total_user_storage
-        current_storage = session.exec(
-            select(File.size).where(File.owner_username == data.username)
-        ).all()
+        current_storage = (await session.exec(
+            select(File.size).where(File.owner_id == user_id)
+        )).all()
         total_current_storage = sum(size for size in current_storage if size is not None)
-        
+
         if total_current_storage + file_size > max_total_storage:
             logger.warning(
                 "User %s storage (%s bytes) + new file (%s bytes) exceeds total storage limit (%s bytes)",
@@ -121,38 +203,30 @@ async def upload_file(
             )
 
         logger.info(
-            "Size checks passed for %s: file size %s bytes, user total storage %s bytes", 
+            "Size checks passed for %s: file size %s bytes, user total storage %s bytes",
             data.username, file_size, total_current_storage
         )
 
-        # Create file path using UUID
-        file_path = get_safe_file_path(data.uuid)
-
-        # Save file to disk
-        try:
-            with open(file_path, "wb") as f:
-                f.write(file_content)
-            logger.info("File saved to: %s", file_path)
-        except Exception as e:
-            logger.error("Failed to save file to disk: %s", e)
-            raise HTTPException(status_code=500, detail="Failed to save file") from e
-
         # Create database record
-        new_file = File(
+        session.add(File(
             uuid=data.uuid,
             file_name=data.file_name or "unknown",
             size=file_size,
             date_created=datetime.now(UTC),
-            owner_username=data.username,
-        )
-
-        session.add(new_file)
-        session.commit()
-        session.refresh(new_file)
+            owner_id=user_id,
+        ))
 
-        logger.info(
-            "File upload completed: %s (%s bytes) for user %s", data.file_name, file_size, data.username
-        )
+    try:
+        await writes.commit(session, store)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+    part_path.replace(file_path)
+    logger.info("File saved to: %s", file_path)
+
+    logger.info(
+        "File upload completed: %s (%s bytes) for user %s", data.file_name, file_size, data.username
+    )
 
     return JSONResponse(content={"message": "File uploaded successfully"})
 
@@ -162,6 +236,8 @@ async def download_file(
     data: Annotated[
         DownloadFileRequest, Depends(SignedPayload.unwrap(DownloadFileRequest))
     ],
+    principal: PrincipalDep,
+    session: SessionDep,
 ):
     """
     Download a file by UUID.
@@ -170,103 +246,83 @@ async def download_file(
     """
     logger.debug("Download request for UUID: %s by user: %s", data.uuid, data.username)
 
-    with Session(engine) as session:
-        # Verify user exists
-        user = session.exec(select(User).where(User.username == data.username)).first()
-        if not user:
-            raise HTTPException(
-                status_code=404, detail=f"User {data.username} not found"
-            )
+    # Verify the signer is the user named
+    user_id = principal.owner(data.username)
 
-        # Verify file exists
-        file = session.exec(select(File).where(File.uuid == data.uuid)).first()
-        if not file:
-            raise HTTPException(
-                status_code=404, detail=f"File with UUID {data.uuid} not found"
-            )
+    # Verify file exists
+    file = await find_file(session, data.uuid)
 
-        # Check access permissions
-        has_access = False
+    # Check access permissions
+    has_access = False
 
-        # Check if user is the owner
-        if file.owner_username == data.username:
-            has_access = True
-            logger.info("Access granted: %s is owner of file %s", data.username, data.uuid)
-        else:
-            # Check if file has been shared with this user
-            file_share = session.exec(
-                select(FileShare).where(
-                    FileShare.file_uuid == data.uuid,
-                    FileShare.recipient_username == data.username,
-                    FileShare.revoked == False,
-                )
-            ).first()
-
-            if file_share:
-                has_access = True
-                logger.info(
-                    "Access granted: file %s shared with %s", data.uuid, data.username
-                )
-
-        if not has_access:
-            logger.warning(
-                "Access denied: %s cannot access file %s", data.username, data.uuid
+    # Check if user is the owner
+    if file.owner_id == user_id:
+        has_access = True
+        logger.info("Access granted: %s is owner of file %s", data.username, data.uuid)
+    else:
+        # Check if file has been shared with this user
+        file_share = (await session.exec(
+            select(FileShare).where(
+                FileShare.file_uuid == data.uuid,
+                FileShare.recipient_id == user_id,
+                FileShare.revoked == False,
             )
-            raise HTTPException(
-                status_code=403,
-                detail=f"User {data.username} does not have access to file {data.uuid}",
+        )).first()
+
+        if file_share:
+            has_access = True
+            logger.info(
+                "Access granted: file %s shared with %s", data.uuid, data.username
             )
 
-        # Check if file exists on disk
-        file_path = get_safe_file_path(data.uuid)
-        if not file_path.exists():
-            logger.error("File not found on disk: %s", file_path)
-            raise HTTPException(status_code=404, detail="File not found on disk")
+    if not has_access:
+        logger.warning(
+            "Access denied: %s cannot access file %s", data.username, data.uuid
+        )
+        raise HTTPException(
+            status_code=403,
+            detail=f"User {data.username} does not have access to file {data.uuid}",
+        )
 
-        logger.info("Serving file %s to %s", file.file_name, data.username)
+    # Check if file exists on disk
+    file_path = get_safe_file_path(data.uuid)
+    if not file_path.exists():
+        logger.error("File not found on disk: %s", file_path)
+        raise HTTPException(status_code=404, detail="File not found on disk")
 
-        # Return file as download
-        return FileResponse(
-            path=file_path,
-            filename=file.file_name,
-            media_type="application/octet-stream",
-        )
+    logger.info("Serving file %s to %s", file.file_name, data.username)
+
+    # Return file as download
+    return FileResponse(
+        path=file_path,
+        filename=file.file_name,
+        media_type="application/octet-stream",
+    )
 
 
 @router.post("/files/share_file")
 async def share_file(
     data: Annotated[ShareFileRequest, Depends(SignedPayload.unwrap(ShareFileRequest))],
+    principal: PrincipalDep,
+    session: SessionDep,
 ):
     logger.debug(
         "Sharing file from %s to %s", data.sharer_username, data.recipient_username
     )
-    with Session(engine) as session:
-        # Verify sharer exists
-        sharer = session.exec(
-            select(User).where(User.username == data.sharer_username)
-        ).first()
-        if not sharer:
-            raise HTTPException(
-                status_code=404, detail=f"Sharer {data.sharer_username} not found" 
-            )
-
-        # Verify recipient exists
-        recipient = session.exec(
-            select(User).where(User.username == data.recipient_username)
-        ).first()
-        if not recipient:
-            raise HTTPException(
-                status_code=404, detail=f"Recipient {data.recipient_username} not found"
-            )
+    # The sharer is the signer, verify the recipient exists
+    sharer_id = principal.owner(data.sharer_username)
+    recipient = data.recipient_username
+    recipient_id = await principal.require(
+        session, recipient, f"Recipient {recipient} not found"
+    )
 
-        # Verify file exists and sharer owns it
-        file = session.exec(select(File).where(File.uuid == data.file_uuid)).first()
-        if not file:
-            raise HTTPException(
-                status_code=404, detail=f"File with UUID {data.file_uuid} not found"
-            )
+    async def share(session: AsyncSession):
+        # Verify file exists and sharer owns it, loading any existing share with it
+        file, existing_share = await file_with_share(
+            session, data.file_uuid, recipient_id
+        )
 
-        if file.owner_username != data.sharer_username:
+        if file.owner_id != sharer_id:
             raise HTTPException(
                 status_code=403,
                 detail=f"User {data.sharer_username} does not own file {data.file_uuid}",
@@ -277,19 +333,11 @@ async def share_file(
         )
 
         # Check if file is already shared with this recipient
-        existing_share = session.exec(
-            select(FileShare).where(
-                FileShare.file_uuid == data.file_uuid,
-                FileShare.recipient_username == data.recipient_username,
-            )
-        ).first()
-
         if existing_share:
             if existing_share.revoked:
                 # Re-enable access if previously revoked
                 existing_share.revoked = False
                 session.add(existing_share)
-                session.commit()
                 logger.info(
                     "Re-enabled access for %s to file %s", data.recipient_username, data.file_uuid
                 )
@@ -301,51 +349,41 @@ async def share_file(
             # Create new file share record
             new_file_share = FileShare(
                 file_uuid=data.file_uuid,
-                owner_username=data.sharer_username,
-                recipient_username=data.recipient_username,
+                owner_id=sharer_id,
+                recipient_id=recipient_id,
             )
             session.add(new_file_share)
-            session.commit()
             logger.info("Created new file share record for %s", data.recipient_username)
 
+    await writes.commit(session, share)
+
     return JSONResponse(content={"message": "File shared successfully"})
 
 
 @router.post("/files/revoke_file")
 async def revoke_file(
+    request: Request,
     data: Annotated[RevokeFileRequest, Depends(SignedPayload.unwrap(RevokeFileRequest))],
+    principal: PrincipalDep,
+    session: SessionDep,
 ):
     logger.debug(
         "Revocation request for file %s from %s to %s", data.file_uuid, data.sharer_username, data.revoked_username
     )
     
-    with Session(engine) as session:
-        # Verify sharer exists
-        sharer = session.exec(
-            select(User).where(User.username == data.sharer_username)
-        ).first()
-        if not sharer:
-            raise HTTPException(
-                status_code=404, detail=f"Sharer {data.sharer_username} not found" 
-            )
-
-        # Verify revoked user exists
-        revoked = session.exec(
-            select(User).where(User.username == data.revoked_username)
-        ).first()
-        if not revoked:
-            raise HTTPException(
-                status_code=404, detail=f"Revoked {data.revoked_username} not found"
-            )
+    # The sharer is the signer, verify the revoked user exists
+    sharer_id = principal.owner(data.sharer_username)
+    revoked_id = await principal.require(
+        session, data.revoked_username, f"Revoked {data.revoked_username} not found"
+    )
 
-        # Verify file exists and sharer owns it
-        file = session.exec(select(File).where(File.uuid == data.file_uuid)).first()
-        if not file:
-            raise HTTPException(
-                status_code=404, detail=f"File with UUID {data.file_uuid} not found"
-            )
+    async def revoke(session: AsyncSession) -> File:
+        # Verify file exists and sharer owns it, loading the revoked user's share too
+        file, existing_share = await file_with_share(
+            session, data.file_uuid, revoked_id
+        )
 
-        if file.owner_username != data.sharer_username:
+        if file.owner_id != sharer_id:
             raise HTTPException(
                 status_code=403,
                 detail=f"User {data.sharer_username} does not own file {data.file_uuid}",
@@ -356,18 +394,9 @@ async def revoke_file(
         )
 
         # Check to make sure the user being revoked currently has access to this file
-        existing_share = session.exec(
-            select(FileShare).where(
-                FileShare.file_uuid == data.file_uuid,
-                FileShare.recipient_username == data.revoked_username,
-            )
-        ).first()
-
         if existing_share and not existing_share.revoked:
             existing_share.revoked = True
             session.add(existing_share)
-            session.commit()
-            
             logger.info(
                 "Revoked access for %s to file %s", data.revoked_username, data.file_uuid
             )
@@ -375,37 +404,38 @@ async def revoke_file(
             raise HTTPException(
                 status_code=400, detail=f"User {data.revoked_username} does not have access to this file"
             )
-            
-        # Update the encrypted contents of the now-revoked file
-        try:
-            file_content = base64.b64decode(data.file_content_b64, validate=True)
-            file_size = len(file_content)
-            logger.info(
-                "Decoded %s bytes from Base64 input for file: %s", file_size, file.uuid
-            )
-        except Exception as e:
-            logger.error("Failed to decode Base64 content: %s", e)
-            raise HTTPException(status_code=400, detail="Invalid Base64 content") from e
-
-        file_path = get_safe_file_path(data.file_uuid)
-
-        # Save file to disk
-        try:
-            with open(file_path, "wb") as f:
-                f.write(file_content)
-            logger.info("File saved to: %s", file_path)
-        except Exception as e:
-            logger.error("Failed to save file to disk: %s", e)
-            raise HTTPException(status_code=500, detail="Failed to save file") from e
-        
-    
-    return RevokeFileResponse(message="File revoked successfully")
+        return file
+
+    file = await writes.commit(session, revoke)
+
+    # Update the encrypted contents of the now-revoked file
+    try:
+        file_content = await run_in_threadpool(
+            decode_file_content, data.file_content_b64
+        )
+        file_size = len(file_content)
+        logger.info(
+            "Decoded %s bytes from Base64 input for file: %s", file_size, file.uuid
+        )
+    except Exception as e:
+        logger.error("Failed to decode Base64 content: %s", e)
+        raise HTTPException(status_code=400, detail="Invalid Base64 content") from e
+
+    file_path = get_safe_file_path(data.file_uuid)
+
+    # Save file to disk
+    await save_file(file_path, file_content)
+    logger.info("File saved to: %s", file_path)
+
+    return RevokeFileResponse(message="File revoked successfully").to_response(request)
 
 @router.post("/files/delete")
 async def delete_file(
     data: Annotated[
         DeleteFileRequest, Depends(SignedPayload.unwrap(DeleteFileRequest))
     ],
+    principal: PrincipalDep,
+    session: SessionDep,
 ):
     """
     send: file UUID signed
@@ -417,49 +447,40 @@ async def delete_file(
     """
     logger.debug("Delete request for UUID: %s by user: %s", data.uuid, data.username)
 
-    with Session(engine) as session:
-        # Verify user exists
-        user = session.exec(select(User).where(User.username == data.username)).first()
-        if not user:
-            raise HTTPException(
-                status_code=404, detail=f"User {data.username} not found"
-            )
+    # Verify the signer is the user named
+    user_id = principal.owner(data.username)
 
-        # Verify file exists
-        file = session.exec(select(File).where(File.uuid == data.uuid)).first()
-        if not file:
-            raise HTTPException(
-                status_code=404, detail=f"File with UUID {data.uuid} not found"
-            )
+    # Verify file exists
+    file = await find_file(session, data.uuid)
 
-        # Check access permissions
-        has_access = False
+    # Check access permissions
+    has_access = False
 
-        # Check if user is the owner
-        if file.owner_username == data.username:
-            has_access = True
-            logger.info("Access granted: %s is owner of file %s", data.username, data.uuid)
+    # Check if user is the owner
+    if file.owner_id == user_id:
+        has_access = True
+        logger.info("Access granted: %s is owner of file %s", data.username, data.uuid)
 
-        if not has_access:
-            logger.warning(
-                "Access denied: %s cannot delete file %s", data.username, data.uuid
-            )
-            raise HTTPException(
-                status_code=403,
-                detail=f"User {data.username} does not have access to delete file {data.uuid}",
-            )
+    if not has_access:
+        logger.warning(
+            "Access denied: %s cannot delete file %s", data.username, data.uuid
+        )
+        raise HTTPException(
+            status_code=403,
+            detail=f"User {data.username} does not have access to delete file {data.uuid}",
+        )
 
-        # Check if file exists on disk
-        file_path = get_safe_file_path(data.uuid)
-        if not file_path.exists():
-            logger.error("File not found on disk: %s", file_path)
-            raise HTTPException(status_code=404, detail="File not found on disk")
-
-        try:
-            file_path.unlink()
-        except Exception as e:
-            logger.error("Failed to delete file: %s", e)
-            raise HTTPException(status_code=500, detail="Failed to delete file") from e
-        
-        # Return file as download
-        return JSONResponse({ "message": "File deleted successfully" })
+    # Check if file exists on disk
+    file_path = get_safe_file_path(data.uuid)
+    if not file_path.exists():
+        logger.error("File not found on disk: %s", file_path)
+        raise HTTPException(status_code=404, detail="File not found on disk")
+
+    try:
+        file_path.unlink()
+    except Exception as e:
+        logger.error("Failed to delete file: %s", e)
+        raise HTTPException(status_code=500, detail="Failed to delete file") from e
+    
+    # Return file as download
+    return JSONResponse({ "message": "File deleted successfully" })
@@ -0,0 +1,131 @@
+import asyncio
+import json
+from collections.abc import AsyncGenerator
+from typing import Annotated
+
+import anyio
+import msgpack
+from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.pubsub import SUBSCRIBED_EVENT, Subscription, messages_hub
+from app.models.requests import PrincipalDep, SignedPayload
+from app.models.requests.x3dh import SubscribeMessagesRequest
+from app.shared import Logger, load_config
+from app.shared.db import SessionDep, async_engine
+
+logger = Logger(__name__).get_logger()
+
+router = APIRouter()
+
+config = load_config()
+
+# Seconds a new WebSocket has to send its signed subscribe frame
+AUTH_TIMEOUT = 10
+
+# Protocol: the client subscribes, waits for {"type":"subscribed"}, then
+# fetches anything already stored with grab_return_messages. From then on each
+# posted message arrives as {"type":"message","message":{...}} in the same
+# shape as a grabbed one, and is deleted only by ack_return_messages as
+# before. {"type":"resync"} means the connection fell too far behind and the
+# client should grab again.
+
+
+async def authenticate(websocket: WebSocket) -> int:
+    """Read the signed subscribe frame and return the subscriber's user id."""
+    message = await websocket.receive()
+    if message.get("bytes") is not None:
+        envelope = SignedPayload.model_validate(msgpack.unpackb(message["bytes"]))
+    else:
+        envelope = SignedPayload.model_validate(json.loads(message.get("text") or ""))
+
+    async with AsyncSession(async_engine) as session:
+        principal = await envelope.verify(session)
+    data = SubscribeMessagesRequest.model_validate(envelope.decode_payload())
+    if data.username != principal.username:
+        raise ValueError("Subscriptions are only for the signing user")
+    return principal.user_id
+
+
+async def forward_events(websocket: WebSocket, subscription: Subscription):
+    while True:
+        await websocket.send_text(await subscription.get())
+
+
+async def wait_for_disconnect(websocket: WebSocket):
+    # Clients have nothing more to send; reading notices the close promptly
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+
+async def sse_events(user_id: int, keepalive: float) -> AsyncGenerator[str]:
+    subscription = messages_hub.subscribe(user_id)
+    try:
+        yield f"data: {SUBSCRIBED_EVENT}\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), keepalive)
+            except TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield f"data: {event}\n\n"
+    finally:
+        messages_hub.unsubscribe(subscription)
+
+
+if config.endpoint.ws_client is not None:
+
+    @router.websocket(config.endpoint.ws_client)
+    async def message_socket(websocket: WebSocket):
+        await websocket.accept()
+        try:
+            user_id = await asyncio.wait_for(authenticate(websocket), AUTH_TIMEOUT)
+        except (
+            TimeoutError,
+            HTTPException,
+            ValidationError,
+            ValueError,
+            TypeError,
+            msgpack.UnpackException,
+        ) as e:
+            logger.warning("Rejected push subscription: %s", e)
+            await websocket.close(code=1008)
+            return
+        except WebSocketDisconnect:
+            return
+
+        subscription = messages_hub.subscribe(user_id)
+        logger.info("Push subscription for user %s over WebSocket", user_id)
+        try:
+            await websocket.send_text(SUBSCRIBED_EVENT)
+            async with anyio.create_task_group() as task_group:
+                task_group.start_soon(forward_events, websocket, subscription)
+                await wait_for_disconnect(websocket)
+                task_group.cancel_scope.cancel()
+        except* WebSocketDisconnect:
+            pass
+        finally:
+            messages_hub.unsubscribe(subscription)
+
+    @router.post(f"{config.endpoint.ws_client}/sse")
+    async def message_events(
+        data: Annotated[
+            SubscribeMessagesRequest,
+            Depends(SignedPayload.unwrap(SubscribeMessagesRequest)),
+        ],
+        principal: PrincipalDep,
+        session: SessionDep,
+    ):
+        """Server-Sent Events fallback for clients that cannot open a WebSocket."""
+        # Like the WebSocket, only the signer subscribes to their messages
+        user_id = principal.owner(data.username)
+        logger.info("Push subscription for user %s over SSE", user_id)
+        # The stream can stay open for hours; do not hold a connection for it
+        await session.close()
+        return StreamingResponse(
+            sse_events(user_id, config.messages.sse_keepalive),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
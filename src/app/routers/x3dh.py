@@ -1,34 +1,74 @@
-from base64 import b64decode, b64encode
-from typing import Annotated
-
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import JSONResponse
-from sqlmodel import Session, select
-
-from app.models.requests import SignedPayload
+import asyncio
+from base64 import b64decode
+from collections.abc import AsyncIterator
+from contextlib import suppress
+from hashlib import sha256
+from typing import Annotated, TypedDict
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlmodel import col, insert, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.messages import (
+    delete_acked_messages,
+    release_message_slots,
+    reserve_message_slots,
+    return_messages_page,
+)
+from app.core.negative_cache import missing_usernames
+from app.core.prekeys import (
+    StaticBundle,
+    adjust_inventory,
+    claim_one_time_prekey,
+    claim_one_time_prekeys,
+    insert_one_time_prekeys,
+    low_prekey_headers,
+    static_bundle,
+    static_bundles,
+)
+from app.core.pubsub import message_event, messages_hub
+from app.core.users import usernames
+from app.models.requests import PrincipalDep, SignedPayload
+from app.models.requests.serde_base import (
+    NDJSON_MEDIA_TYPE,
+    accepts_msgpack,
+    accepts_ndjson,
+)
 from app.models.requests.x3dh import (
+    AckReturnMessagesRequest,
+    AckReturnMessagesResponse,
     GetPrekeyBundleRequest,
+    GetPrekeyBundlesRequest,
     GrabReturnMessages,
+    GrabReturnMessagesRequest,
+    OtpPrekeyPush,
     PostReturnMessage,
     PostReturnMessageResponse,
-    ReturnMessage,
-    OtpPrekeyPush,
+    PostReturnMessages,
+    PostReturnMessagesResponse,
+    PQOtpPrekeyPush,
+    PQSignedPrekeyPush,
     PrekeyBundleResponse,
+    PrekeyBundlesResponse,
+    PrekeyInventoryRequest,
+    PrekeyInventoryResponse,
+    RecipientMessage,
+    ReturnMessage,
     SignedPrekeyPush,
-    GrabReturnMessagesRequest,
-    PQSignedPrekeyPush,
-    PQOtpPrekeyPush,
 )
 from app.models.schema import (
-    MessageStore, 
-    Otp, 
-    PrekeyBundle, 
-    User, 
+    MessageStore,
+    Otp,
+    PQOneTimePrekey,
     PQSignedPrekeyBundle,
-    PQOneTimePrekey
+    PrekeyBundle,
+    PrekeyInventory,
+    User,
 )
 from app.shared import Logger, load_config
-from app.shared.db import engine
+from app.shared.db import SessionDep, async_engine
+from app.shared.group_commit import writes
 
 logger = Logger(__name__).get_logger()
 
@@ -37,12 +77,15 @@ router = APIRouter()
 config = load_config()
 endpoint = config.endpoint
 
-def validate_base64_and_decode(data: str, field_name: str, expected_min_length: int = 1) -> bytes:
+def validate_base64_and_decode(
+    data: str | bytes, field_name: str, expected_min_length: int = 1
+) -> bytes:
     """
     Validate and decode base64 data with proper error handling and logging.
+    Raw bytes (sent by msgpack clients) skip decoding and only get length checked.
     """
     try:
-        decoded = b64decode(data, validate=True)
+        decoded = data if isinstance(data, bytes) else b64decode(data, validate=True)
         if len(decoded) < expected_min_length:
             logger.error("Decoded %s is too short: %d bytes", field_name, len(decoded))
             raise HTTPException(
@@ -62,6 +105,8 @@ def validate_base64_and_decode(data: str, field_name: str, expected_min_length:
 @router.post("/x3dh/signed_prekey_push")
 async def signed_prekey_push(
     data: Annotated[SignedPrekeyPush, Depends(SignedPayload.unwrap(SignedPrekeyPush))],
+    principal: PrincipalDep,
+    session: SessionDep,
 ):
     logger.info("Processing signed prekey push for user: %s", data.username)
     
@@ -69,16 +114,13 @@ async def signed_prekey_push(
     prekey_bytes = validate_base64_and_decode(data.signed_prekey_public, "signed_prekey_public", 32)
     sig_bytes = validate_base64_and_decode(data.signed_prekey_signature, "signed_prekey_signature", 16)
     
-    with Session(engine) as session:
-        user = session.exec(select(User).where(User.username == data.username)).first()
-        if not user:
-            logger.error("User not found for signed prekey push: %s", data.username)
-            raise HTTPException(status_code=404, detail="User not found")
-
-        prekey_bundle = session.exec(
-            select(PrekeyBundle).where(PrekeyBundle.f_username == data.username)
-        ).first()
-        
+    user_id = principal.owner(data.username)
+
+    async def store(session: AsyncSession):
+        prekey_bundle = (await session.exec(
+            select(PrekeyBundle).where(PrekeyBundle.user_id == user_id)
+        )).first()
+
         if prekey_bundle:
             logger.info("Updating existing prekey bundle for user: %s", data.username)
             prekey_bundle.prekey = prekey_bytes
@@ -86,16 +128,16 @@ async def signed_prekey_push(
         else:
             logger.info("Creating new prekey bundle for user: %s", data.username)
             prekey_bundle = PrekeyBundle(
-                f_username=data.username,
+                user_id=user_id,
                 prekey=prekey_bytes,
                 sig_prekey=sig_bytes,
             )
-        
         session.add(prekey_bundle)
-        session.commit()
-        session.refresh(prekey_bundle)
-        
-        logger.info("Successfully processed signed prekey push for user: %s", data.username)
+
+    await writes.commit(session, store)
+    static_bundles.invalidate(data.username)
+    
+    logger.info("Successfully processed signed prekey push for user: %s", data.username)
 
     return JSONResponse(content={"message": "Signed prekey push received"})
 
@@ -103,6 +145,8 @@ async def signed_prekey_push(
 @router.post("/x3dh/pq_signed_prekey_push")
 async def pq_signed_prekey_push(
     data: Annotated[PQSignedPrekeyPush, Depends(SignedPayload.unwrap(PQSignedPrekeyPush))],
+    principal: PrincipalDep,
+    session: SessionDep,
 ):
     logger.info("Processing PQ signed prekey push for user: %s", data.username)
     
@@ -110,16 +154,13 @@ async def pq_signed_prekey_push(
     pqspkb_bytes = validate_base64_and_decode(data.pq_signed_prekey_public, "pq_signed_prekey_public", 32)
     pqspkb_sig_bytes = validate_base64_and_decode(data.pq_signed_prekey_signature, "pq_signed_prekey_signature", 16)
     
-    with Session(engine) as session:
-        user = session.exec(select(User).where(User.username == data.username)).first()
-        if not user:
-            logger.error("User not found for PQ signed prekey push: %s", data.username)
-            raise HTTPException(status_code=404, detail="User not found")
-
-        pq_prekey_bundle = session.exec(
-            select(PQSignedPrekeyBundle).where(PQSignedPrekeyBundle.f_username == data.username)
-        ).first()
-        
+    user_id = principal.owner(data.username)
+
+    async def store(session: AsyncSession):
+        pq_prekey_bundle = (await session.exec(
+            select(PQSignedPrekeyBundle).where(PQSignedPrekeyBundle.user_id == user_id)
+        )).first()
+
         if pq_prekey_bundle:
             logger.info("Updating existing PQ signed prekey bundle for user: %s", data.username)
             pq_prekey_bundle.pqspkb = pqspkb_bytes
@@ -127,322 +168,706 @@ async def pq_signed_prekey_push(
         else:
             logger.info("Creating new PQ signed prekey bundle for user: %s", data.username)
             pq_prekey_bundle = PQSignedPrekeyBundle(
-                f_username=data.username,
+                user_id=user_id,
                 pqspkb=pqspkb_bytes,
                 pqspkb_sig=pqspkb_sig_bytes,
             )
-        
         session.add(pq_prekey_bundle)
-        session.commit()
-        session.refresh(pq_prekey_bundle)
-        
-        logger.info("Successfully processed PQ signed prekey push for user: %s", data.username)
+
+    await writes.commit(session, store)
+    static_bundles.invalidate(data.username)
+    
+    logger.info("Successfully processed PQ signed prekey push for user: %s", data.username)
 
     return JSONResponse(content={"message": "PQ signed prekey push received"})
 
 
+def decode_keys(values: list[str | bytes], min_length: int) -> list[bytes | None]:
+    """
+    Decode a whole batch of base64 (or raw msgpack) keys in one pass; entries
+    that are malformed or shorter than `min_length` come back as None.
+    """
+    decoded = []
+    for value in values:
+        try:
+            key = value if isinstance(value, bytes) else b64decode(value, validate=True)
+        except ValueError:  # binascii.Error, or non-ASCII text
+            key = None
+        decoded.append(key if key is not None and len(key) >= min_length else None)
+    return decoded
+
+
+def check_push_size(count: int, kind: str):
+    if not count:
+        raise HTTPException(
+            status_code=400, detail=f"At least one {kind} prekey must be provided"
+        )
+    if count > config.prekeys.max_push_batch:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {config.prekeys.max_push_batch} {kind} prekeys per push",
+        )
+
+
+def push_response(message: str, pushed: int, stored: int, remaining) -> JSONResponse:
+    return JSONResponse(
+        content={"message": message, "stored": stored, "duplicates": pushed - stored},
+        headers=low_prekey_headers(*remaining) if remaining else None,
+    )
+
+
 @router.post("/x3dh/otp_prekey_push")
 async def otp_prekey_push(
     data: Annotated[OtpPrekeyPush, Depends(SignedPayload.unwrap(OtpPrekeyPush))],
+    principal: PrincipalDep,
+    session: SessionDep,
 ):
     logger.info("Processing OTP prekey push for user: %s with %d keys", data.username, len(data.pub_otps))
-    
-    if not data.pub_otps:
-        logger.error("Empty OTP prekey list provided for user: %s", data.username)
-        raise HTTPException(status_code=400, detail="At least one OTP prekey must be provided")
-    
-    with Session(engine) as session:
-        user = session.exec(select(User).where(User.username == data.username)).first()
-        if not user:
-            logger.error("User not found for OTP prekey push: %s", data.username)
-            raise HTTPException(status_code=404, detail="User not found")
-
-        valid_otps = []
-        for i, otp_key in enumerate(data.pub_otps):
-            try:
-                otp_bytes = validate_base64_and_decode(otp_key, f"otp_key[{i}]", 32)
-                valid_otps.append(otp_bytes)
-            except HTTPException:
-                logger.error("Skipping invalid OTP key at index %d for user %s", i, data.username)
-                continue
-        
-        if not valid_otps:
-            logger.error("No valid OTP keys found for user: %s", data.username)
-            raise HTTPException(status_code=400, detail="No valid OTP keys provided")
+    check_push_size(len(data.pub_otps), "OTP")
+
+    user_id = principal.owner(data.username)
+
+    decoded = decode_keys(data.pub_otps, 32)
+    # dict.fromkeys drops repeats within the batch and keeps the client's order
+    valid_otps = list(dict.fromkeys(key for key in decoded if key is not None))
+    if len(valid_otps) < len(decoded):
+        logger.warning(
+            "Skipped %d invalid or repeated OTP keys for user: %s",
+            len(decoded) - len(valid_otps),
+            data.username,
+        )
+    if not valid_otps:
+        logger.error("No valid OTP keys found for user: %s", data.username)
+        raise HTTPException(status_code=400, detail="No valid OTP keys provided")
 
-        for otp_bytes in valid_otps:
-            new_otp = Otp(f_username=data.username, otp_val=otp_bytes)
-            session.add(new_otp)
+    async def store(session: AsyncSession):
+        stored = len((await session.exec(insert_one_time_prekeys(Otp, [
+            {"user_id": user_id, "otp_val": otp_bytes} for otp_bytes in valid_otps
+        ]))).all())
+        remaining = (await session.exec(adjust_inventory(user_id, otps=stored))).first()
+        return stored, remaining
 
-        session.commit()
-        logger.info("Successfully added %d OTP prekeys for user: %s", len(valid_otps), data.username)
+    stored, remaining = await writes.commit(session, store)
+    logger.info("Stored %d new OTP prekeys for user: %s", stored, data.username)
 
-    return JSONResponse(content={"message": "OTP prekey push received"})
+    return push_response("OTP prekey push received", len(decoded), stored, remaining)
 
 
 @router.post("/x3dh/pq_otp_prekey_push")
 async def pq_otp_prekey_push(
     data: Annotated[PQOtpPrekeyPush, Depends(SignedPayload.unwrap(PQOtpPrekeyPush))],
+    principal: PrincipalDep,
+    session: SessionDep,
 ):
     logger.info("Processing PQ OTP prekey push for user: %s with %d keys", data.username, len(data.pub_pq_otps))
-    
-    if not data.pub_pq_otps:
-        logger.error("Empty PQ OTP prekey list provided for user: %s", data.username)
-        raise HTTPException(status_code=400, detail="At least one PQ OTP prekey must be provided")
-    
-    with Session(engine) as session:
-        user = session.exec(select(User).where(User.username == data.username)).first()
-        if not user:
-            logger.error("User not found for PQ OTP prekey push: %s", data.username)
-            raise HTTPException(status_code=404, detail="User not found")
-
-        valid_pq_otps = []
-        for i, otp_data_item in enumerate(data.pub_pq_otps):
-            try:
-                otp_bytes = validate_base64_and_decode(otp_data_item.public_key, f"pq_otp_key[{i}].public_key", 32)
-                sig_bytes = validate_base64_and_decode(otp_data_item.signature, f"pq_otp_key[{i}].signature", 16)
-                
-                valid_pq_otps.append((otp_bytes, sig_bytes))
-            except (HTTPException, AttributeError) as e:
-                logger.error("Skipping invalid PQ OTP key at index %d for user %s: %s", i, data.username, e)
-                continue
-        
-        if not valid_pq_otps:
-            logger.error("No valid PQ OTP keys found for user: %s", data.username)
-            raise HTTPException(status_code=400, detail="No valid PQ OTP keys provided")
-
-        for otp_bytes, sig_bytes in valid_pq_otps:
-            new_pq_otp = PQOneTimePrekey(
-                f_username=data.username,
-                pqotp=otp_bytes,
-                pqotp_sig=sig_bytes
-            )
-            session.add(new_pq_otp)
+    check_push_size(len(data.pub_pq_otps), "PQ OTP")
+
+    user_id = principal.owner(data.username)
+
+    public_keys = decode_keys([item.public_key for item in data.pub_pq_otps], 32)
+    signatures = decode_keys([item.signature for item in data.pub_pq_otps], 16)
+    valid_pq_otps = {
+        sha256(public_key).digest(): (public_key, signature)
+        for public_key, signature in zip(public_keys, signatures, strict=True)
+        if public_key is not None and signature is not None
+    }
+    if len(valid_pq_otps) < len(public_keys):
+        logger.warning(
+            "Skipped %d invalid or repeated PQ OTP keys for user: %s",
+            len(public_keys) - len(valid_pq_otps),
+            data.username,
+        )
+    if not valid_pq_otps:
+        logger.error("No valid PQ OTP keys found for user: %s", data.username)
+        raise HTTPException(status_code=400, detail="No valid PQ OTP keys provided")
+
+    async def store(session: AsyncSession):
+        stored = len((await session.exec(insert_one_time_prekeys(PQOneTimePrekey, [
+            {
+                "user_id": user_id,
+                "pqotp": public_key,
+                "pqotp_sig": signature,
+                "pqotp_digest": digest,
+            }
+            for digest, (public_key, signature) in valid_pq_otps.items()
+        ]))).all())
+        remaining = (
+            await session.exec(adjust_inventory(user_id, pq_otps=stored))
+        ).first()
+        return stored, remaining
+
+    stored, remaining = await writes.commit(session, store)
+    logger.info("Stored %d new PQ OTP prekeys for user: %s", stored, data.username)
 
-        session.commit()
-        logger.info("Successfully added %d PQ OTP prekeys for user: %s", len(valid_pq_otps), data.username)
+    return push_response(
+        "PQ OTP prekey push received", len(public_keys), stored, remaining
+    )
 
-    return JSONResponse(content={"message": "PQ OTP prekey push received"})
+
+@router.post("/x3dh/prekey_inventory", response_model=PrekeyInventoryResponse)
+async def prekey_inventory(
+    request: Request,
+    data: Annotated[
+        PrekeyInventoryRequest, Depends(SignedPayload.unwrap(PrekeyInventoryRequest))
+    ],
+    principal: PrincipalDep,
+    session: SessionDep,
+):
+    """How many one-time prekeys the user has left, from a single row."""
+    user_id = principal.owner(data.username)
+    inventory = await session.get(PrekeyInventory, user_id) or PrekeyInventory(
+        user_id=user_id
+    )
+
+    response = PrekeyInventoryResponse(
+        otps=inventory.otps,
+        pq_otps=inventory.pq_otps,
+        low_watermark=config.prekeys.low_watermark,
+    )
+    return response.to_response(
+        request, headers=low_prekey_headers(inventory.otps, inventory.pq_otps)
+    )
+
+
+def static_bundle_error(
+    username: str,
+    user: User | None,
+    prekey_bundle_db: PrekeyBundle | None,
+    pq_prekey_bundle_db: PQSignedPrekeyBundle | None,
+) -> str | None:
+    """Why `username` has no bundle to hand out, or None if it has one."""
+    if not user:
+        logger.error("Target user not found: %s", username)
+        return "Target user not found"
+    if not prekey_bundle_db:
+        logger.error("Classical prekey bundle not found for user: %s", username)
+        return "Prekey bundle not found for user"
+    if not pq_prekey_bundle_db:
+        logger.error("PQ signed prekey bundle not found for user: %s", username)
+        return "PQ prekey bundle not found for user"
+    return None
+
+
+async def load_static_bundle(session: SessionDep, username: str) -> StaticBundle:
+    """Target user and both signed prekeys in one query, 404 if any is missing."""
+    generation = missing_usernames.generation
+    if await missing_usernames.known_absent(session, username):
+        raise HTTPException(status_code=404, detail="Target user not found")
+    user, prekey_bundle_db, pq_prekey_bundle_db = (
+        await session.exec(static_bundle([username]))
+    ).first() or (None, None, None)
+    if not user:
+        missing_usernames.miss(username, generation)
+    error = static_bundle_error(username, user, prekey_bundle_db, pq_prekey_bundle_db)
+    if error or not user or not prekey_bundle_db or not pq_prekey_bundle_db:
+        raise HTTPException(status_code=404, detail=error)
+
+    return StaticBundle.from_rows(user, prekey_bundle_db, pq_prekey_bundle_db)
 
 
 @router.post("/x3dh/prekey_bundle", response_model=PrekeyBundleResponse)
 async def get_prekey_bundle(
+    request: Request,
     data: Annotated[
         GetPrekeyBundleRequest, Depends(SignedPayload.unwrap(GetPrekeyBundleRequest))
     ],
+    session: SessionDep,
 ):
     logger.info("Fetching prekey bundle for user: %s (requested by: %s)", data.target_username, data.username)
     
-    with Session(engine) as session:
-        # Verify target user exists
-        user = session.exec(
-            select(User).where(User.username == data.target_username)
-        ).first()
-        if not user:
-            logger.error("Target user not found: %s", data.target_username)
-            raise HTTPException(status_code=404, detail="Target user not found")
-
-        # Fetch classical prekey bundle
-        prekey_bundle_db = session.exec(
-            select(PrekeyBundle).where(PrekeyBundle.f_username == data.target_username)
-        ).first()
-        if not prekey_bundle_db:
-            logger.error("Classical prekey bundle not found for user: %s", data.target_username)
-            raise HTTPException(
-                status_code=404, detail="Prekey bundle not found for user"
-            )
-
-        # Fetch PQ signed prekey bundle
-        pq_prekey_bundle_db = session.exec(
-            select(PQSignedPrekeyBundle).where(PQSignedPrekeyBundle.f_username == data.target_username)
-        ).first()
-        if not pq_prekey_bundle_db:
-            logger.error("PQ signed prekey bundle not found for user: %s", data.target_username)
-            raise HTTPException(
-                status_code=404, detail="PQ prekey bundle not found for user"
-            )
-
-        # Fetch an unused classical OTP with row-level locking
-        otp_record = session.exec(
-            select(Otp)
-            .where(Otp.f_username == data.target_username, Otp.used == False)
-            .with_for_update()
-        ).first()
-
-        one_time_prekey_val = None
-        if otp_record:
-            one_time_prekey_val = otp_record.otp_val
-            otp_record.used = True
-            session.add(otp_record)
-            logger.info("Classical OTP %s for user %s marked as used", otp_record.id, data.target_username)
-        else:
+    static = static_bundles.get(data.target_username)
+    if static is None:
+        generation = static_bundles.generation
+        static = await load_static_bundle(session, data.target_username)
+        static_bundles.put(data.target_username, static, generation)
+    user_id = static.user_id
+
+    # Consume one classical and one PQ OTP. Each claim picks and deletes its
+    # row in a single statement; if either is missing nothing is committed.
+    async def claim(session: AsyncSession) -> tuple[Otp, PQOneTimePrekey]:
+        otp_record = (
+            await session.exec(claim_one_time_prekey(Otp, user_id))
+        ).scalars().first()
+        if not otp_record:
             logger.error("Mandatory classical OTP not available for user: %s", data.target_username)
             raise HTTPException(
                 status_code=404,
                 detail=f"Mandatory OTP not available for user: {data.target_username}",
             )
+        logger.info(
+            "Classical OTP %s for user %s claimed", otp_record.id, data.target_username
+        )
 
-        # Fetch an unused PQ OTP with row-level locking (prefer one-time over last-resort)
-        pq_otp_record = session.exec(
-            select(PQOneTimePrekey)
-            .where(PQOneTimePrekey.f_username == data.target_username, PQOneTimePrekey.used == False)
-            .with_for_update()
-        ).first()
-
-        pq_one_time_key = None
-        pq_one_time_sig = None
-        
-        if pq_otp_record:
-            # Use one-time PQ prekey
-            pq_one_time_key = pq_otp_record.pqotp
-            pq_one_time_sig = pq_otp_record.pqotp_sig
-            pq_otp_record.used = True
-            session.add(pq_otp_record)
-            logger.info("PQ OTP %s for user %s marked as used", pq_otp_record.id, data.target_username)
-        else:
+        pq_otp_record = (
+            await session.exec(claim_one_time_prekey(PQOneTimePrekey, user_id))
+        ).scalars().first()
+        if not pq_otp_record:
             # PQ OTP is mandatory, raise an error if not found
             logger.error("Mandatory PQ OTP not available for user: %s", data.target_username)
             raise HTTPException(
                 status_code=404,
                 detail=f"Mandatory PQ OTP not available for user: {data.target_username}",
             )
+        logger.info(
+            "PQ OTP %s for user %s claimed", pq_otp_record.id, data.target_username
+        )
+
+        await session.exec(adjust_inventory(user_id, otps=-1, pq_otps=-1))
+        return otp_record, pq_otp_record
 
-        session.commit()
-
-        response = PrekeyBundleResponse(
-            # Classical X3DH fields
-            identity_key=b64encode(user.public_key).decode("utf8"),
-            signed_prekey=b64encode(prekey_bundle_db.prekey).decode("utf8"),
-            signed_prekey_signature=b64encode(prekey_bundle_db.sig_prekey).decode("utf8"),
-            one_time_prekey=b64encode(one_time_prekey_val).decode("utf8"),
-            
-            # Post-quantum PQXDH fields
-            pq_signed_prekey=b64encode(pq_prekey_bundle_db.pqspkb).decode("utf8"),
-            pq_signed_prekey_signature=b64encode(pq_prekey_bundle_db.pqspkb_sig).decode("utf8"),
-            
-            # One-time PQ prekey fields (always present since it's mandatory)
-            one_time_pq_prekey=b64encode(pq_one_time_key).decode("utf8"),
-            one_time_pq_prekey_signature=b64encode(pq_one_time_sig).decode("utf8"),
+    otp_record, pq_otp_record = await writes.commit(session, claim)
+
+    # The static fields come pre-encoded for JSON; the one-time prekey bytes
+    # are base64-encoded on serialisation for JSON clients only
+    response = PrekeyBundleResponse(
+        **static.fields(as_json=not accepts_msgpack(request)),
+        one_time_prekey=otp_record.otp_val,
+        # One-time PQ prekey fields (always present since it's mandatory)
+        one_time_pq_prekey=pq_otp_record.pqotp,
+        one_time_pq_prekey_signature=pq_otp_record.pqotp_sig,
+    )
+    
+    logger.info("Successfully provided prekey bundle for user: %s to requester: %s", data.target_username, data.username)
+    return response.to_response(request)
+
+
+@router.post("/x3dh/prekey_bundles", response_model=PrekeyBundlesResponse)
+async def get_prekey_bundles(
+    request: Request,
+    data: Annotated[
+        GetPrekeyBundlesRequest, Depends(SignedPayload.unwrap(GetPrekeyBundlesRequest))
+    ],
+    session: SessionDep,
+):
+    """
+    `get_prekey_bundle` for a group: one signature check and one transaction,
+    with each step a single set-based statement across all targets. Targets
+    without a full bundle are reported in `errors` and keep their keys.
+    """
+    targets = list(dict.fromkeys(data.target_usernames))
+    logger.info(
+        "Fetching %d prekey bundles (requested by: %s)", len(targets), data.username
+    )
+    if not targets:
+        raise HTTPException(
+            status_code=400, detail="At least one target must be provided"
+        )
+    if len(targets) > config.prekeys.max_bundle_batch:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {config.prekeys.max_bundle_batch} targets per fetch",
         )
-        
-        logger.info("Successfully provided prekey bundle for user: %s to requester: %s", data.target_username, data.username)
-        return response
+
+    errors: dict[str, str] = {}
+    statics = {name: static for name in targets if (static := static_bundles.get(name))}
+    missing_generation = missing_usernames.generation
+    uncached = [name for name in targets if name not in statics]
+    absent = await missing_usernames.absent(session, uncached)
+    missing = []
+    for name in uncached:
+        if name in absent:
+            errors[name] = "Target user not found"
+        else:
+            missing.append(name)
+    if missing:
+        generation = static_bundles.generation
+        rows = (await session.exec(static_bundle(missing))).all()
+        found = {
+            user.username: (user, prekey, pq_prekey) for user, prekey, pq_prekey in rows
+        }
+        for name in missing:
+            user, prekey, pq_prekey = found.get(name, (None, None, None))
+            if not user:
+                missing_usernames.miss(name, missing_generation)
+            error = static_bundle_error(name, user, prekey, pq_prekey)
+            if error or not user or not prekey or not pq_prekey:
+                errors[name] = error or "Target user not found"
+                continue
+            statics[name] = StaticBundle.from_rows(user, prekey, pq_prekey)
+            static_bundles.put(name, statics[name], generation)
+
+    # PQ keys are only claimed for targets that got a classical one, and a
+    # classical key whose target has no PQ key left is put back
+    async def claim(
+        session: AsyncSession,
+    ) -> tuple[dict[int, Otp], dict[int, PQOneTimePrekey]]:
+        otps = {
+            otp.user_id: otp
+            for otp in (await session.exec(
+                claim_one_time_prekeys(
+                    Otp, [static.user_id for static in statics.values()]
+                )
+            )).scalars()
+        }
+        pq_otps = {
+            pq_otp.user_id: pq_otp
+            for pq_otp in (await session.exec(
+                claim_one_time_prekeys(PQOneTimePrekey, list(otps))
+            )).scalars()
+        } if otps else {}
+        unserved = [otp for user_id, otp in otps.items() if user_id not in pq_otps]
+        if unserved:
+            await session.exec(
+                insert(Otp).values([otp.model_dump() for otp in unserved])
+            )
+        if pq_otps:
+            await session.exec(adjust_inventory(list(pq_otps), otps=-1, pq_otps=-1))
+        return otps, pq_otps
+
+    otps, pq_otps = await writes.commit(session, claim)
+
+    as_json = not accepts_msgpack(request)
+    bundles = {}
+    for name, static in statics.items():
+        otp, pq_otp = otps.get(static.user_id), pq_otps.get(static.user_id)
+        if not otp or not pq_otp:
+            kind = "PQ OTP" if otp else "OTP"
+            logger.error("Mandatory %s not available for user: %s", kind, name)
+            errors[name] = f"Mandatory {kind} not available for user: {name}"
+            continue
+        bundles[name] = PrekeyBundleResponse(
+            **static.fields(as_json=as_json),
+            one_time_prekey=otp.otp_val,
+            one_time_pq_prekey=pq_otp.pqotp,
+            one_time_pq_prekey_signature=pq_otp.pqotp_sig,
+        )
+
+    logger.info(
+        "Provided %d of %d prekey bundles to requester: %s",
+        len(bundles),
+        len(targets),
+        data.username,
+    )
+    return PrekeyBundlesResponse(bundles=bundles, errors=errors).to_response(request)
+
+
+class MessageFields(TypedDict):
+    """One recipient's decoded message fields, named as MessageStore columns."""
+    eph_key: bytes
+    otp_hash: bytes
+    e_message: bytes
+    pq_ct: bytes
+    pq_otp_hash: bytes
+
+
+def decode_message_fields(
+    message: PostReturnMessage | RecipientMessage,
+) -> MessageFields:
+    """Validate and decode one recipient's message fields; raises 400 on bad input."""
+    decode = validate_base64_and_decode
+    return {
+        "eph_key": decode(
+            message.sharer_ephemeral_key_public, "sharer_ephemeral_key_public", 32
+        ),
+        "otp_hash": decode(message.otp_hash, "otp_hash", 16),
+        "e_message": decode(message.encrypted_message, "encrypted_message", 1),
+        # PQ fields
+        "pq_ct": decode(message.kem_ciphertext, "kem_ciphertext", 32),
+        "pq_otp_hash": decode(message.pq_otp_hash, "pq_otp_hash", 16),
+    }
 
 
 @router.post("/x3dh/post_return_message", response_model=PostReturnMessageResponse)
 async def post_return_messages(
+    request: Request,
     data: Annotated[
         PostReturnMessage, Depends(SignedPayload.unwrap(PostReturnMessage))
     ],
+    principal: PrincipalDep,
+    session: SessionDep,
 ):
     logger.info("Posting return message from %s to %s", data.sharer_username, data.recipient_username)
     
     # Validate all base64 inputs
     sharer_identity_bytes = validate_base64_and_decode(data.sharer_identity_key_public, "sharer_identity_key_public", 32)
-    sharer_eph_bytes = validate_base64_and_decode(data.sharer_ephemeral_key_public, "sharer_ephemeral_key_public", 32)
-    otp_hash_bytes = validate_base64_and_decode(data.otp_hash, "otp_hash", 16)
-    encrypted_msg_bytes = validate_base64_and_decode(data.encrypted_message, "encrypted_message", 1)
-    kem_ct_bytes = validate_base64_and_decode(data.kem_ciphertext, "kem_ciphertext", 32)
-    pq_otp_hash_bytes = validate_base64_and_decode(data.pq_otp_hash, "pq_otp_hash", 16)
+    fields = decode_message_fields(data)
     
-    with Session(engine) as session:
-        # Verify sharer exists
-        sharer = session.exec(
-            select(User).where(User.username == data.sharer_username)
-        ).first()
-        
-        if not sharer:
-            logger.error("Sharer not found: %s", data.sharer_username)
+    # The sharer is the signer, verify the recipient exists
+    sharer_id = principal.owner(data.sharer_username)
+    recipient = data.recipient_username
+    recipient_id = await principal.require(
+        session, recipient, f"Recipient {recipient} not found"
+    )
+
+    async def store(session: AsyncSession) -> MessageStore:
+        # Count it against the recipient's cap in the same transaction
+        if (await session.exec(reserve_message_slots([recipient_id]))).first() is None:
             raise HTTPException(
-                status_code=404, detail=f"Sharer {data.sharer_username} not found" 
+                status_code=429,
+                detail=f"Recipient {recipient} has too many undelivered messages",
             )
-
-        # Verify recipient exists
-        recipient = session.exec(
-            select(User).where(User.username == data.recipient_username)
-        ).first()
-        
-        if not recipient:
-            logger.error("Recipient not found: %s", data.recipient_username)
-            raise HTTPException(
-                status_code=404, detail=f"Recipient {data.recipient_username} not found"
-            )
-        
-        # Store the initial message for the recipient        
+        # Store the initial message for the recipient
         new_message = MessageStore(
-            recipient_username=data.recipient_username,
+            recipient_id=recipient_id,
             sharer_identity_key_public=sharer_identity_bytes,
-            eph_key=sharer_eph_bytes,
-            sharer_username=data.sharer_username,
-            otp_hash=otp_hash_bytes,
-            e_message=encrypted_msg_bytes,
-            # PQ fields
-            pq_ct=kem_ct_bytes,
-            pq_otp_hash=pq_otp_hash_bytes,
+            sharer_id=sharer_id,
+            **fields,
         )
-
         session.add(new_message)
-        session.commit()
-        session.refresh(new_message)
+        await session.flush()
+        return new_message
 
-        logger.info(
-            "Initial message (ID: %s) stored for %s from %s with PQ OTP hash", 
-            new_message.id, data.recipient_username, data.sharer_username
+    new_message = await writes.commit(session, store)
+
+    logger.info(
+        "Initial message (ID: %s) stored for %s from %s with PQ OTP hash", 
+        new_message.id, data.recipient_username, data.sharer_username
+    )
+
+    # Push to the recipient's open connections; they still ack it as usual
+    messages_hub.publish(
+        recipient_id, message_event(return_message(new_message, data.sharer_username))
+    )
+
+    return PostReturnMessageResponse(
+        message="Message posted successfully"
+    ).to_response(request)
+
+
+@router.post("/x3dh/post_return_messages", response_model=PostReturnMessagesResponse)
+async def post_group_return_messages(
+    request: Request,
+    data: Annotated[
+        PostReturnMessages, Depends(SignedPayload.unwrap(PostReturnMessages))
+    ],
+    principal: PrincipalDep,
+    session: SessionDep,
+):
+    """
+    `post_return_message` for a group: the sharer is checked once, recipients
+    are resolved in one query, counted against their caps in one UPDATE and
+    their messages stored in one multi-row INSERT. Recipients that are
+    unknown, full or sent malformed fields are reported in `errors`.
+    """
+    names = [message.recipient_username for message in data.messages]
+    logger.info(
+        "Posting return messages from %s to %d recipients",
+        data.sharer_username,
+        len(names),
+    )
+    if not names:
+        raise HTTPException(
+            status_code=400, detail="At least one message must be provided"
+        )
+    if len(names) > config.messages.max_fanout:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {config.messages.max_fanout} recipients per post",
+        )
+    if len(set(names)) != len(names):
+        raise HTTPException(
+            status_code=400, detail="Each recipient may appear only once"
+        )
+
+    sharer_identity_bytes = validate_base64_and_decode(data.sharer_identity_key_public, "sharer_identity_key_public", 32)
+    sharer_id = principal.owner(data.sharer_username)
+    recipient_ids = await usernames.resolve_many(session, names)
+
+    errors: dict[str, str] = {}
+    pending: dict[int, MessageStore] = {}
+    for message in data.messages:
+        name = message.recipient_username
+        if name not in recipient_ids:
+            errors[name] = f"Recipient {name} not found"
+            continue
+        try:
+            fields = decode_message_fields(message)
+        except HTTPException as e:
+            errors[name] = str(e.detail)
+            continue
+        pending[recipient_ids[name]] = MessageStore(
+            recipient_id=recipient_ids[name],
+            sharer_identity_key_public=sharer_identity_bytes,
+            sharer_id=sharer_id,
+            **fields,
+        )
+
+    async def store(session: AsyncSession) -> set[int]:
+        reserved = set(
+            (await session.exec(reserve_message_slots(list(pending)))).scalars()
+        )
+        if reserved:
+            rows = [pending[recipient_id] for recipient_id in reserved]
+            inserted = await session.exec(
+                insert(MessageStore)
+                .values([row.model_dump(exclude={"id"}) for row in rows])
+                .returning(col(MessageStore.id), col(MessageStore.recipient_id))
+            )
+            for message_id, recipient_id in inserted:
+                pending[recipient_id].id = message_id
+        return reserved
+
+    stored: dict[str, MessageStore] = {}
+    if pending:
+        reserved = await writes.commit(session, store)
+        for name, recipient_id in recipient_ids.items():
+            if recipient_id in reserved:
+                stored[name] = pending[recipient_id]
+            elif recipient_id in pending:
+                errors[name] = f"Recipient {name} has too many undelivered messages"
+
+    for message in stored.values():
+        messages_hub.publish(
+            message.recipient_id,
+            message_event(return_message(message, data.sharer_username)),
         )
-        
-        return PostReturnMessageResponse(message="Message posted successfully")
+
+    logger.info(
+        "Stored %d of %d return messages from %s",
+        len(stored),
+        len(names),
+        data.sharer_username,
+    )
+    return PostReturnMessagesResponse(
+        posted={name: message.id for name, message in stored.items() if message.id},
+        errors=errors,
+    ).to_response(request)
+
+
+def return_message(record: MessageStore, sharer_username: str) -> ReturnMessage:
+    assert record.id is not None
+    return ReturnMessage(
+        id=record.id,
+        # Classical X3DH fields
+        sharer_identity_key_public=record.sharer_identity_key_public,
+        sharer_ephemeral_key_public=record.eph_key,
+        sharer_username=sharer_username,
+        otp_hash=record.otp_hash,
+        encrypted_message=record.e_message,
+        # Post-quantum PQXDH fields
+        kem_ciphertext=record.pq_ct,
+        pq_otp_hash=record.pq_otp_hash,
+    )
+
+
+async def stream_return_messages(
+    recipient_id: int, after: int, page_size: int
+) -> AsyncIterator[str]:
+    """
+    Every message after the cursor as NDJSON, one page at a time. Each page
+    gets its own short session, so a slow reader never holds a connection.
+    """
+    while True:
+        async with AsyncSession(async_engine) as session:
+            page = (await session.exec(
+                return_messages_page(recipient_id, after, page_size)
+            )).all()
+        for record, sharer_username in page:
+            message = return_message(record, sharer_username)
+            yield message.model_dump_json(by_alias=True) + "\n"
+        if len(page) < page_size:
+            return
+        after = page[-1][0].id or after
+
+
+async def wait_for_messages(
+    session: AsyncSession, recipient_id: int, after: int, timeout: float
+):
+    """
+    Long polling: return once the recipient has a message after the cursor,
+    or after `timeout` seconds. post_return_messages wakes the wait directly
+    through the hub, so nothing polls the database meanwhile.
+    """
+    with messages_hub.parked(recipient_id) as wakeup:
+        if (await session.exec(return_messages_page(recipient_id, after, 1))).first():
+            return
+        # Parked requests hold no connection
+        await session.close()
+        with suppress(TimeoutError):
+            await asyncio.wait_for(wakeup.wait(), timeout)
 
 
 @router.post(
     "/x3dh/grab_return_messages", response_model=GrabReturnMessages
 )
 async def grab_return_messages(
+    request: Request,
     data: Annotated[
         GrabReturnMessagesRequest,
         Depends(SignedPayload.unwrap(GrabReturnMessagesRequest)),
     ],
+    principal: PrincipalDep,
+    session: SessionDep,
 ):
+    """
+    One page of the user's messages after the `after` cursor, or all of them
+    streamed as NDJSON if the client accepts it. With `wait`, a user with no
+    new messages is answered when one arrives rather than straight away.
+    Nothing is deleted here: messages stay until acknowledged with
+    ack_return_messages, so a lost response loses nothing.
+    """
     logger.info("Grabbing initial messages for user: %s", data.username)
-    
-    with Session(engine) as session:
-        # Verify user exists
-        user = session.exec(select(User).where(User.username == data.username)).first()
-        if not user:
-            logger.error("User not found for grab messages: %s", data.username)
-            raise HTTPException(
-                status_code=404, detail=f"User {data.username} not found"
-            )
+    page_size = min(data.limit or config.messages.page_size, config.messages.page_size)
+    if page_size < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+
+    # Only the signer reads their messages
+    user_id = principal.owner(data.username)
+
+    wait = min(data.wait, config.messages.max_wait)
+    if wait > 0:
+        await wait_for_messages(session, user_id, data.after, wait)
+
+    # Polling for messages is when a user learns their prekeys are running low
+    inventory = await session.get(PrekeyInventory, user_id)
+    headers = (
+        low_prekey_headers(inventory.otps, inventory.pq_otps) if inventory else None
+    )
+
+    if accepts_ndjson(request):
+        # Release the request's connection before the stream starts
+        await session.close()
+        return StreamingResponse(
+            stream_return_messages(user_id, data.after, page_size),
+            media_type=NDJSON_MEDIA_TYPE,
+            headers=headers,
+        )
 
-        # Fetch all messages for the user
-        message_records = session.exec(
-            select(MessageStore).where(MessageStore.recipient_username == data.username)
-        ).all()
-
-        if not message_records:
-            logger.info("No initial messages found for user: %s", data.username)
-            return GrabReturnMessages(messages=[])
-
-        return_messages = []
-        for record in message_records:
-            return_messages.append(
-                ReturnMessage(
-                    # Classical X3DH fields
-                    sharer_identity_key_public=b64encode(record.sharer_identity_key_public).decode("utf8"),
-                    sharer_ephemeral_key_public=b64encode(record.eph_key).decode("utf8"),
-                    sharer_username=record.sharer_username,
-                    otp_hash=b64encode(record.otp_hash).decode("utf8"),
-                    encrypted_message=b64encode(record.e_message).decode("utf8"),
-                    # Post-quantum PQXDH fields
-                    kem_ciphertext=b64encode(record.pq_ct).decode("utf8"),
-                    pq_otp_hash=b64encode(record.pq_otp_hash).decode("utf8"),
-                )
-            )
-            # Delete the message from the server after fetching
-            session.delete(record)
+    # One row more than the page tells whether there is a next page
+    page = (await session.exec(
+        return_messages_page(user_id, data.after, page_size + 1)
+    )).all()
+    messages = [return_message(record, sharer) for record, sharer in page[:page_size]]
+    next_cursor = messages[-1].id if len(page) > page_size else None
 
-        session.commit()
-        logger.info(
-            "Retrieved and deleted %s initial messages for user: %s", len(return_messages), data.username
+    logger.info(
+        "Returned %d initial messages for user: %s", len(messages), data.username
+    )
+    return GrabReturnMessages(messages=messages, next_cursor=next_cursor).to_response(
+        request, headers=headers
+    )
+
+
+@router.post(
+    "/x3dh/ack_return_messages", response_model=AckReturnMessagesResponse
+)
+async def ack_return_messages(
+    request: Request,
+    data: Annotated[
+        AckReturnMessagesRequest,
+        Depends(SignedPayload.unwrap(AckReturnMessagesRequest)),
+    ],
+    principal: PrincipalDep,
+    session: SessionDep,
+):
+    """Delete messages the client has safely stored, in one statement."""
+    if len(data.message_ids) > config.messages.max_ack_batch:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {config.messages.max_ack_batch} message ids per ack",
         )
+    # Only the recipient acknowledges their messages
+    user_id = principal.owner(data.username)
+
+    async def delete(session: AsyncSession) -> int:
+        deleted = len((await session.exec(
+            delete_acked_messages(user_id, set(data.message_ids))
+        )).all())
+        if deleted:
+            await session.exec(release_message_slots({user_id: deleted}))
+        return deleted
+
+    deleted = await writes.commit(session, delete) if data.message_ids else 0
+    logger.info("Acknowledged %d initial messages for user: %s", deleted, data.username)
 
-        return GrabReturnMessages(messages=return_messages)
+    return AckReturnMessagesResponse(deleted=deleted).to_response(request)
@@ -1,23 +1,113 @@
 from logging import CRITICAL, DEBUG, ERROR, INFO, WARNING
-from os import PathLike
+from os import PathLike, environ
 from pathlib import Path
+from tempfile import gettempdir
 from tomllib import load
+from typing import Literal
 
-from pydantic import BaseModel, field_validator
+from pydantic import BaseModel, Field, ValidationInfo, field_validator
 
 DEFAULT_CONFIG_PATH = Path("config.toml")
 
+# Names a second TOML file merged over config.toml, e.g. for the CI database
+SPECIFIC_CONFIG_ENV = "BENJI_CONFIG"
+
 
 class General(BaseModel):
     title: str
 
 
+class SqliteProfile(BaseModel):
+    # Applied as PRAGMAs on every new SQLite connection
+    journal_mode: Literal[
+        "DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"
+    ] = "WAL"
+    synchronous: Literal["OFF", "NORMAL", "FULL", "EXTRA"] = "NORMAL"
+    cache_size: int = -65536  # negative = KiB, so 64 MiB
+    mmap_size: int = 268435456  # 256 MiB
+    busy_timeout: int = 5000  # ms
+    temp_store: Literal["DEFAULT", "FILE", "MEMORY"] = "MEMORY"
+    wal_autocheckpoint: int = 1000  # pages, 0 leaves checkpoints to the background task
+    # Only takes effect on new databases, or after a one-off VACUUM
+    auto_vacuum: Literal["NONE", "FULL", "INCREMENTAL"] = "INCREMENTAL"
+
+    # Write transactions only, reads are always DEFERRED. IMMEDIATE takes the
+    # write lock at BEGIN, so a transaction that reads and then writes waits
+    # on busy_timeout instead of failing with SQLITE_BUSY
+    transaction_mode: Literal["DEFERRED", "IMMEDIATE"] = "IMMEDIATE"
+    # Pooled read-only connections; writes share one more connection
+    read_connections: int = Field(default=4, ge=1)
+
+    # Background WAL checkpoints
+    checkpoint_interval: float = 30  # seconds, 0 disables
+    checkpoint_mode: Literal["PASSIVE", "FULL", "RESTART", "TRUNCATE"] = "PASSIVE"
+
+    # Background incremental vacuum, returns free pages left by deleted rows
+    vacuum_interval: float = 300  # seconds, 0 disables
+    vacuum_pages: int = 2000  # pages freed per run, 0 frees all
+
+    # Group commit: writes from concurrent requests are committed together,
+    # one transaction per `group_commit_window` seconds or per
+    # `group_commit_max_batch` writes, whichever comes first
+    group_commit: bool = False
+    group_commit_window: float = 0.002
+    group_commit_max_batch: int = 64
+
+    def pragmas(self) -> dict[str, str | int]:
+        return {
+            # Before anything else, it must be set before the first table exists
+            "auto_vacuum": self.auto_vacuum,
+            "journal_mode": self.journal_mode,
+            "synchronous": self.synchronous,
+            "cache_size": self.cache_size,
+            "mmap_size": self.mmap_size,
+            "busy_timeout": self.busy_timeout,
+            "temp_store": self.temp_store,
+            "wal_autocheckpoint": self.wal_autocheckpoint,
+        }
+
+
+class Pool(BaseModel):
+    # Connection pool for server databases; SQLite has `read_connections`
+    size: int = 10  # 0 disables pooling, e.g. behind PgBouncer
+    max_overflow: int = 10
+    timeout: float = 30  # seconds to wait for a free connection
+    recycle: int = 1800  # seconds before a connection is replaced, -1 never
+    pre_ping: bool = True  # test connections on checkout, drops dead ones
+
+
+class NegativeCache(BaseModel):
+    # Rejects unknown usernames and file UUIDs without their lookup
+    enabled: bool = True
+    bloom_capacity: int = 1_000_000  # keys per filter before it is resized
+    false_positive_rate: float = Field(default=0.01, gt=0, lt=1)
+    refresh_interval: float = 300  # seconds between filter rebuilds, 0 never loads
+    miss_ttl: float = 10  # seconds a looked-up miss is remembered
+    miss_cache_size: int = 10_000  # remembered misses per key kind
+    # Seconds an answer may miss another worker's insert; the newest id is
+    # read at most this often
+    max_staleness: float = 1
+
+
 class Database(BaseModel):
     path: str
+    username_cache_size: int = 100_000  # cached username -> user.id entries
+    bundle_cache_size: int = 10_000  # cached static prekey bundle parts
+    bundle_cache_ttl: float = 30  # seconds a cached bundle part is served, 0 disables
+
+    pool: Pool = Pool()
+    sqlite: SqliteProfile = SqliteProfile()
+    negative_cache: NegativeCache = NegativeCache()
 
 
 class Logging(BaseModel):
     level: int
+    # Count SQL statements per request and report them in X-Query-Count
+    query_counts: bool = False
+    # Report the time to the response in a Server-Timing header
+    server_timing: bool = False
+    # Report the rate limiter's tracked keys in an X-Rate-Limit-Keys header
+    rate_limit_keys: bool = False
 
     @field_validator("level", mode="before")
     @classmethod
@@ -42,19 +132,86 @@ class Files(BaseModel):
     max_total_user_storage: int = 1073741824  # 1 GB default
 
 
+class Prekeys(BaseModel):
+    # Responses to a user carry X-Prekeys-Low while either kind of one-time
+    # prekey they have left is below this
+    low_watermark: int = 20
+    # Keys accepted by one otp_prekey_push or pq_otp_prekey_push
+    max_push_batch: int = 1000
+    # Targets accepted by one prekey_bundles fetch
+    max_bundle_batch: int = 100
+
+
+class Messages(BaseModel):
+    # grab_return_messages pages; clients may ask for fewer, never more
+    page_size: int = 100
+    # Message ids accepted by one ack_return_messages
+    max_ack_batch: int = 1000
+    # Recipients accepted by one post_return_messages
+    max_fanout: int = 100
+    # Events a push connection may fall behind by before it is told to resync
+    push_queue_size: int = 100
+    # Seconds between SSE keepalive comments, so proxies keep idle streams open
+    sse_keepalive: float = 15
+    # Longest grab_return_messages `wait`, in seconds
+    max_wait: float = 30
+    # Grabs parked waiting for a message, per worker and per user
+    max_parked: int = 10_000
+    max_parked_per_user: int = 4
+    # Messages never acknowledged are deleted after `ttl` seconds (0 keeps them)
+    ttl: float = 30 * 24 * 3600
+    # Stored messages per recipient; posts beyond this are refused
+    max_per_recipient: int = 1000
+    # Seconds between expiry sweeps, and rows deleted per sweep transaction
+    expiry_interval: float = 300
+    expiry_batch: int = 500
+
+
 class Endpoint(BaseModel):
-    # ws_client: str
-    ...
+    # WebSocket push channel for new messages, with an SSE fallback at
+    # `<ws_client>/sse`; None disables both
+    ws_client: str | None = None
+
 
 class RateLimit(BaseModel):
     requests_per_second: int
     timeout_period: int
+    max_tracked_keys: int = 100_000  # IPs, and usernames, with a bucket each
+    sweep_interval: float = 10  # seconds between scans for idle keys
+    # Where the counters live: this process, every worker on this host, or
+    # every host through Redis
+    store: Literal["memory", "shared_memory", "redis"] = "memory"
+    sync_interval: float = 0.05  # seconds between batched writes to a shared store
+    shared_memory_path: str = str(Path(gettempdir()) / "benji-rate-limits")
+    shared_memory_slots: int = 131_072  # keys the file holds, IPs and users together
+    redis_url: str = "redis://localhost:6379/0"
+    redis_timeout: float = 0.25  # seconds; past it the store counts as down
+    # Requests to these paths spend this much of the budget instead of 1
+    costs: dict[str, int] = {}
+    # Bodies are slowed to these rates per IP and per X-Username; 0 turns it off
+    bytes_in_per_second: int = 0
+    bytes_out_per_second: int = 0
+    byte_burst: int = 1_048_576  # bytes a client can move at full speed first
+
+    @field_validator("costs")
+    @classmethod
+    def costs_fit_the_budget(cls, costs: dict[str, int], info: ValidationInfo):
+        # A request costing more than a full bucket could never be made
+        limit = info.data.get("requests_per_second", 0)
+        for path, cost in costs.items():
+            if not 1 <= cost <= limit:
+                raise ValueError(
+                    f"cost of {path} must be between 1 and requests_per_second"
+                )
+        return costs
 
 
 class Network(BaseModel):
     host: str
     port: int
     reload: bool
+    # Larger request bodies are refused with 413
+    max_body_size: int = 146_800_640  # 140 MiB
 
     rate_limit: RateLimit
 
@@ -64,6 +221,8 @@ class Config(BaseModel):
     database: Database
     paths: Paths
     files: Files
+    prekeys: Prekeys = Prekeys()
+    messages: Messages = Messages()
     logging: Logging
     endpoint: Endpoint
     network: Network
@@ -71,9 +230,11 @@ class Config(BaseModel):
 
 def load_config(
     shared_config_file: PathLike = DEFAULT_CONFIG_PATH,
-    specific_config_file: PathLike | None = None,
+    specific_config_file: PathLike | str | None = None,
 ) -> Config:
     """Load and merge configurations from TOML files."""
+    specific_config_file = specific_config_file or environ.get(SPECIFIC_CONFIG_ENV)
+
     # Load shared config
     with Path(shared_config_file).open("rb") as f:
         config_data = load(f)
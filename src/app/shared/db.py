@@ -1,14 +1,255 @@
+import asyncio
 import logging
+from collections.abc import AsyncIterator, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Annotated
 
-from sqlalchemy import Engine
-from sqlmodel import SQLModel, create_engine
+from alembic import command
+from alembic.config import Config as AlembicConfig
+from fastapi import Depends
+from sqlalchemy import Connection, Engine, event, inspect, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import NullPool
+from sqlmodel import create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.models.schema import *  # noqa: F403 # SQLModel subclasses need to be in memory
 from app.shared import Logger, load_config
+from app.shared.config import Pool, SqliteProfile
 
 logger = Logger(__name__, level=logging.DEBUG).get_logger()
 
 config = load_config()
 
+# Async drivers used by the request path, keyed by the sync backend name
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+}
+
+
+def to_async_url(database_url: str) -> str:
+    url = make_url(database_url)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise ValueError(f"No async driver known for database {database_url}")
+    return url.set(drivername=f"{url.get_backend_name()}+{driver}").render_as_string(
+        hide_password=False
+    )
+
+
+def is_sqlite(database_url: str) -> bool:
+    return make_url(database_url).get_backend_name() == "sqlite"
+
+
+def apply_sqlite_profile(
+    dbapi_connection, profile: SqliteProfile, read_only: bool = False
+):
+    pragmas = profile.pragmas()
+    if read_only:
+        # Setting auto_vacuum writes the database header, so it would wait
+        # for the writer; a read connection refuses writes instead, so one
+        # slipping into a read session fails loudly rather than upgrading a
+        # DEFERRED transaction, which SQLite may refuse with SQLITE_BUSY
+        del pragmas["auto_vacuum"]
+        pragmas["query_only"] = "ON"
+    cursor = dbapi_connection.cursor()
+    for pragma, value in pragmas.items():
+        # Values are validated by SqliteProfile, so formatting them in is safe
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+    cursor.close()
+
+
+def async_engine_options(database_url: str, pool: Pool = config.database.pool) -> dict:
+    # SQLite readers get connections of their own: in WAL mode they neither
+    # wait for the writer nor for each other. Writes use `write_engine`.
+    if is_sqlite(database_url):
+        return {"pool_size": config.database.sqlite.read_connections, "max_overflow": 0}
+    if pool.size == 0:
+        return {"poolclass": NullPool}
+    return {
+        "pool_size": pool.size,
+        "max_overflow": pool.max_overflow,
+        "pool_timeout": pool.timeout,
+        "pool_recycle": pool.recycle,
+        "pool_pre_ping": pool.pre_ping,
+    }
+
+
+# The sync engine is only used for schema management and scripts;
+# request handlers must use the async session below.
 engine: Engine = create_engine(config.database.path)
-SQLModel.metadata.create_all(engine)
+
+async_engine: AsyncEngine = create_async_engine(
+    to_async_url(config.database.path),
+    **async_engine_options(config.database.path),
+)
+
+# SQLite has a single writer, and a transaction that read first and then
+# writes fails instantly with "database is locked" if another connection
+# wrote in between. Writes therefore get one connection of their own, whose
+# transactions begin in `transaction_mode`, and queue for it in asyncio
+# instead of racing for the file lock. Server databases write through the
+# same pool as reads.
+write_engine: AsyncEngine = (
+    create_async_engine(
+        to_async_url(config.database.path), pool_size=1, max_overflow=0
+    )
+    if is_sqlite(config.database.path)
+    else async_engine
+)
+
+
+def _sqlite_connect(read_only: bool):
+    def on_connect(dbapi_connection, _connection_record):
+        apply_sqlite_profile(dbapi_connection, config.database.sqlite, read_only)
+        # Stop the driver from issuing its own BEGIN; `_sqlite_begin` does it instead
+        dbapi_connection.isolation_level = None
+
+    return on_connect
+
+
+def _sqlite_begin(mode: str):
+    def on_begin(connection):
+        if connection.get_execution_options().get("isolation_level") == "AUTOCOMMIT":
+            return
+        connection.exec_driver_sql(f"BEGIN {mode}")
+
+    return on_begin
+
+
+if is_sqlite(config.database.path):
+    write_mode = config.database.sqlite.transaction_mode
+    for _engine, read_only, mode in (
+        (engine, False, write_mode),
+        (write_engine.sync_engine, False, write_mode),
+        (async_engine.sync_engine, True, "DEFERRED"),
+    ):
+        event.listen(_engine, "connect", _sqlite_connect(read_only))
+        event.listen(_engine, "begin", _sqlite_begin(mode))
+
+# Statements run on behalf of the current request, see `recording_queries`
+_query_log: ContextVar[list[str] | None] = ContextVar("query_log", default=None)
+
+
+@contextmanager
+def recording_queries(log: list[str] | None = None) -> Iterator[list[str]]:
+    """
+    Collect the SQL statements the async engines run in this context (and in
+    tasks started from it) into a list. Transaction control is left out, so
+    counts match across backends.
+    """
+    log = [] if log is None else log
+    token = _query_log.set(log)
+    try:
+        yield log
+    finally:
+        _query_log.reset(token)
+
+
+def current_query_log() -> list[str] | None:
+    return _query_log.get()
+
+
+def _record_query(_connection, _cursor, statement: str, *_):
+    log = _query_log.get()
+    if log is not None and not statement.startswith("BEGIN"):
+        log.append(statement)
+
+
+for _engine in {async_engine, write_engine}:
+    event.listen(_engine.sync_engine, "before_cursor_execute", _record_query)
+
+MIGRATIONS_PATH = Path(__file__).resolve().parent.parent / "migrations"
+
+# Databases created by `SQLModel.metadata.create_all` before migrations existed
+# already match this revision
+INITIAL_REVISION = "0001"
+
+
+def alembic_config(connection: Connection | None = None) -> AlembicConfig:
+    alembic_cfg = AlembicConfig()
+    alembic_cfg.set_main_option("script_location", str(MIGRATIONS_PATH))
+    alembic_cfg.attributes["connection"] = connection
+    return alembic_cfg
+
+
+def run_migrations(engine: Engine):
+    """Upgrade the database to the newest alembic revision."""
+    with engine.begin() as connection:
+        alembic_cfg = alembic_config(connection)
+        tables = inspect(connection).get_table_names()
+        if "user" in tables and "alembic_version" not in tables:
+            logger.info("Stamping pre-migration database at %s", INITIAL_REVISION)
+            command.stamp(alembic_cfg, INITIAL_REVISION)
+        command.upgrade(alembic_cfg, "head")
+
+
+run_migrations(engine)
+
+
+async def get_session() -> AsyncIterator[AsyncSession]:
+    """
+    Request-scoped session; FastAPI caches it so every dependency shares it.
+    It reads: writes go through `app.shared.group_commit.writes`.
+    """
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+
+SessionDep = Annotated[AsyncSession, Depends(get_session)]
+
+
+async def checkpoint_wal(mode: str = config.database.sqlite.checkpoint_mode):
+    """Run one WAL checkpoint; returns (busy, log pages, checkpointed pages)."""
+    # Checkpoints cannot run inside a transaction
+    async with write_engine.connect() as connection:
+        await connection.execution_options(isolation_level="AUTOCOMMIT")
+        result = await connection.exec_driver_sql(f"PRAGMA wal_checkpoint({mode})")
+        return tuple(result.one())
+
+
+async def run_wal_checkpoints(
+    interval: float = config.database.sqlite.checkpoint_interval,
+):
+    """Background task: checkpoint the WAL every `interval` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            busy, log_pages, checkpointed = await checkpoint_wal()
+            logger.debug(
+                "WAL checkpoint: busy=%s log=%s checkpointed=%s",
+                busy,
+                log_pages,
+                checkpointed,
+            )
+        except Exception as e:
+            logger.warning("WAL checkpoint failed: %s", e)
+
+
+async def incremental_vacuum(pages: int = config.database.sqlite.vacuum_pages) -> int:
+    """Free up to `pages` pages from the freelist (0 = all); returns pages left."""
+    async with write_engine.connect() as connection:
+        await connection.execution_options(isolation_level="AUTOCOMMIT")
+        # sqlite3's execute() steps the pragma once, freeing a single page;
+        # executescript() runs it to completion
+        raw = (await connection.get_raw_connection()).driver_connection
+        assert raw is not None
+        await raw.executescript(f"PRAGMA incremental_vacuum({pages})")
+        result = await connection.exec_driver_sql("PRAGMA freelist_count")
+        return result.scalar_one()
+
+
+async def run_incremental_vacuum(
+    interval: float = config.database.sqlite.vacuum_interval,
+):
+    """Background task: shrink the database file every `interval` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            free_pages = await incremental_vacuum()
+            logger.debug("Incremental vacuum: %s free pages left", free_pages)
+        except Exception as e:
+            logger.warning("Incremental vacuum failed: %s", e)
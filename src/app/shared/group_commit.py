@@ -0,0 +1,167 @@
+import asyncio
+import contextvars
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.shared import Logger, load_config
+from app.shared.db import current_query_log, is_sqlite, recording_queries, write_engine
+
+logger = Logger(__name__).get_logger()
+
+config = load_config()
+
+# The database work of one request: reads and writes on the given session,
+# without committing. Whatever it returns is handed back to the request. It
+# may run more than once, so it must not add objects created outside it.
+type WriteUnit[T] = Callable[[AsyncSession], Awaitable[T]]
+
+# A queued unit, the future its request awaits and that request's query log
+type _Pending = tuple[WriteUnit[Any], asyncio.Future[Any], list[str] | None]
+
+
+class WriteCoalescer:
+    """
+    Group commit for SQLite. Handlers pass their writes as a `WriteUnit` to
+    `commit`, and a single writer task runs every unit queued within `window`
+    seconds (or `max_batch` of them) in order, in one transaction. A request
+    resumes once the COMMIT of its batch has returned.
+
+    A unit that raises gets its error, and the batch is rolled back and run
+    again without it. That costs far less than a SAVEPOINT around every unit
+    when failures are rare, but units may run more than once: they must do
+    all of their work on the session they are given.
+
+    Disabled, `commit` runs the unit in a session of its own on `engine` and
+    commits it straight away, so handlers have one code path either way. When
+    the request's session is already on `engine`, as with a server database
+    that reads and writes through one pool, the unit runs in that session.
+    """
+
+    def __init__(
+        self, engine: AsyncEngine, enabled: bool, window: float, max_batch: int
+    ):
+        self.engine = engine
+        self.enabled = enabled
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue[_Pending] | None = None
+        self._writer: asyncio.Task | None = None
+
+    async def commit[T](self, session: AsyncSession, unit: WriteUnit[T]) -> T:
+        if not self.enabled and session.bind is self.engine:
+            result = await unit(session)
+            await session.commit()
+            return result
+
+        # The request's read transaction ends here, so its reads after the
+        # write see it
+        await session.close()
+        if not self.enabled:
+            async with AsyncSession(self.engine, expire_on_commit=False) as writer:
+                result = await unit(writer)
+                await writer.commit()
+                return result
+
+        future = asyncio.get_running_loop().create_future()
+        self._writer_queue().put_nowait((unit, future, current_query_log()))
+        return await future
+
+    async def close(self):
+        """Stop the writer task; units still queued are not run."""
+        if self._writer is not None:
+            self._writer.cancel()
+            await asyncio.gather(self._writer, return_exceptions=True)
+            self._writer = None
+
+    def _writer_queue(self) -> asyncio.Queue[_Pending]:
+        """The queue of the writer task for this event loop, started on first use."""
+        loop = asyncio.get_running_loop()
+        writer = self._writer
+        if writer is None or writer.done() or writer.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            # In a context of its own, not that of the request that started it
+            self._writer = loop.create_task(
+                self._write_batches(self._queue), context=contextvars.Context()
+            )
+        assert self._queue is not None
+        return self._queue
+
+    async def _write_batches(self, queue: asyncio.Queue[_Pending]):
+        while True:
+            batch = await self._next_batch(queue)
+            try:
+                await self._commit_batch(batch)
+            except Exception as e:
+                logger.error("Group commit of %d writes failed: %s", len(batch), e)
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def _next_batch(self, queue: asyncio.Queue[_Pending]) -> list[_Pending]:
+        batch = [await queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.window
+        while len(batch) < self.max_batch:
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except TimeoutError:
+                break
+        return batch
+
+    async def _commit_batch(self, batch: list[_Pending]):
+        pending = [pending for pending in batch if not pending[1].cancelled()]
+        while pending:
+            results, failure = await self._try_batch(pending)
+            if failure is None:
+                break
+            # Everything ran in one transaction, now rolled back: fail the
+            # unit that raised and run the rest again without it
+            index, error = failure
+            _, future, _ = pending.pop(index)
+            if not future.done():
+                future.set_exception(error)
+        else:
+            return
+
+        logger.debug("Group commit of %d writes", len(pending))
+        for (_, future, _), result in zip(pending, results, strict=True):
+            if not future.done():
+                future.set_result(result)
+
+    async def _try_batch(
+        self, pending: list[_Pending]
+    ) -> tuple[list[Any], tuple[int, Exception] | None]:
+        """
+        Run the units in order in one transaction and commit it. If one
+        raises, nothing is committed and its index and error are returned.
+        """
+        results = []
+        async with AsyncSession(self.engine, expire_on_commit=False) as session:
+            for index, (unit, _, query_log) in enumerate(pending):
+                try:
+                    # Flushing each unit pins a failing write on the unit
+                    # that made it, and counts its statements against its
+                    # request
+                    with recording_queries(query_log):
+                        results.append(await unit(session))
+                        await session.flush()
+                except Exception as e:
+                    return results, (index, e)
+            await session.commit()
+        return results, None
+
+
+writes = WriteCoalescer(
+    write_engine,
+    enabled=config.database.sqlite.group_commit and is_sqlite(config.database.path),
+    window=config.database.sqlite.group_commit_window,
+    max_batch=config.database.sqlite.group_commit_max_batch,
+)
@@ -0,0 +1,130 @@
+"""
+Helpers and fixtures shared by the test modules.
+
+A module signs as its users with one key through a `Signer`, which gives
+every username a client address of its own, so that one user's requests do
+not spend another's IP budget. The `full_rate_limits` fixture refills every
+budget around each test, so no module depends on what ran before it.
+"""
+
+import base64
+import json
+from itertools import count
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from fastapi.testclient import TestClient
+from httpx import Response
+from starlette.types import ASGIApp
+
+from app.core.rate_limits import (
+    USERNAME_HEADER,
+    ByteShaper,
+    TokenBuckets,
+    incoming_bytes,
+    outgoing_bytes,
+    rate_limit_store,
+    rate_limiter,
+)
+from app.main import app
+from app.shared import load_config
+
+config = load_config()
+
+# Client addresses handed out to users, unique across modules
+_addresses = (f"172.16.{n // 256}.{n % 256}" for n in count(1))
+
+
+def b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+class Signer:
+    """
+    Signs payloads with the Ed25519 key made from `seed`, for any username.
+    Users post to `asgi` through a TestClient of their own, or all through
+    `client`.
+    """
+
+    def __init__(
+        self, seed: bytes, client: TestClient | None = None, asgi: ASGIApp = app
+    ):
+        self.private_key = Ed25519PrivateKey.from_private_bytes(seed)
+        self.public_key_b64 = b64(self.private_key.public_key().public_bytes_raw())
+        self.shared_client = client
+        self.asgi = asgi
+        self.clients: dict[str, TestClient] = {}
+
+    def client(self, username: str) -> TestClient:
+        if self.shared_client is not None:
+            return self.shared_client
+        if username not in self.clients:
+            self.clients[username] = TestClient(
+                self.asgi, client=(next(_addresses), 50000)
+            )
+        return self.clients[username]
+
+    def signed(self, payload_dict: dict, username: str) -> dict:
+        payload_json = json.dumps(payload_dict, separators=(",", ":"))
+        return {
+            "payload": payload_json,
+            "signature": b64(self.private_key.sign(payload_json.encode())),
+            "username": username,
+        }
+
+    def post(
+        self,
+        url: str,
+        payload_dict: dict,
+        username: str,
+        status: int | None = 200,
+        headers: dict | None = None,
+    ) -> Response:
+        """Post signed as `username`; asserts the status unless it is None."""
+        response = self.client(username).post(
+            url,
+            json=self.signed(payload_dict, username),
+            headers={USERNAME_HEADER: username, **(headers or {})},
+        )
+        if status is not None:
+            assert response.status_code == status, f"{url}: {response.text}"
+        return response
+
+    def register(self, *usernames: str):
+        for username in usernames:
+            self.post(
+                "/auth/register",
+                {"username": username, "public_key": self.public_key_b64},
+                username,
+            )
+
+
+def _refill(shaper: ByteShaper | None):
+    if shaper is None:
+        return
+    for side in ("ips", "users"):
+        buckets: TokenBuckets = getattr(shaper, side)
+        setattr(
+            shaper,
+            side,
+            TokenBuckets(
+                buckets.rate, buckets.burst, buckets.block_for, buckets.max_keys
+            ),
+        )
+
+
+def refill_rate_limits():
+    """Give the app's rate limiter and byte shapers fresh, full buckets."""
+    settings = config.network.rate_limit
+    rate_limiter.ips = rate_limit_store("ip", settings)
+    rate_limiter.users = rate_limit_store("user", settings)
+    _refill(incoming_bytes)
+    _refill(outgoing_bytes)
+
+
+@pytest.fixture(autouse=True)
+def full_rate_limits():
+    # After the test as well, so the next module's setup starts full too
+    refill_rate_limits()
+    yield
+    refill_rate_limits()
@@ -1,7 +1,26 @@
-from sqlalchemy import Engine
-from sqlmodel import Session, SQLModel, create_engine
+import asyncio
 
-from app.shared.db import engine
+import pytest
+from sqlalchemy import Engine, event, func
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, SQLModel, col, create_engine, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.users import UsernameResolver
+from app.models.schema import User
+from app.shared.db import (
+    async_engine,
+    checkpoint_wal,
+    config,
+    engine,
+    incremental_vacuum,
+    is_sqlite,
+    write_engine,
+)
+
+sqlite_only = pytest.mark.skipif(
+    not is_sqlite(config.database.path), reason="SQLite specific"
+)
 
 
 def test_db_engine_exists():
@@ -21,3 +40,113 @@ def test_db_schema():
         # Add default metric types if they don't exist
         # session.add(User(username="bob dylan", public_key=b"hehahahahahaha", ))
         session.commit()
+
+
+@sqlite_only
+def test_sqlite_profile_applied():
+    """
+    Test that the configured SQLite PRAGMAs are set on new connections.
+    """
+    profile = config.database.sqlite
+    with engine.connect() as connection:
+        journal_mode = connection.exec_driver_sql("PRAGMA journal_mode").scalar()
+        busy_timeout = connection.exec_driver_sql("PRAGMA busy_timeout").scalar()
+        cache_size = connection.exec_driver_sql("PRAGMA cache_size").scalar()
+
+    assert str(journal_mode).upper() == profile.journal_mode
+    assert busy_timeout == profile.busy_timeout
+    assert cache_size == profile.cache_size
+
+
+@sqlite_only
+def test_wal_checkpoint():
+    busy, _, _ = asyncio.run(checkpoint_wal("PASSIVE"))
+    assert busy == 0
+
+
+@sqlite_only
+def test_incremental_vacuum_empties_freelist():
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        # Databases created before auto_vacuum was configured need one VACUUM
+        if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+            connection.exec_driver_sql("VACUUM")
+        assert connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2
+        connection.exec_driver_sql(
+            "CREATE TABLE IF NOT EXISTS vacuum_probe (data BLOB)"
+        )
+        connection.exec_driver_sql(
+            "WITH RECURSIVE n(i) AS "
+            "(SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 50) "
+            "INSERT INTO vacuum_probe SELECT randomblob(4000) FROM n"
+        )
+        connection.exec_driver_sql("DROP TABLE vacuum_probe")
+        free_pages = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+        assert free_pages and free_pages > 1
+
+    assert asyncio.run(incremental_vacuum(0)) == 0
+
+
+@sqlite_only
+def test_reads_run_beside_an_open_write():
+    """
+    Reads begin DEFERRED on connections of their own, so they go ahead while
+    a write transaction holds the lock; only writes begin IMMEDIATE.
+    """
+    begins = []
+
+    def record(_conn, _cursor, statement, *_):
+        if statement.startswith("BEGIN"):
+            begins.append(statement)
+
+    async def read():
+        async with AsyncSession(async_engine) as session:
+            return (await session.exec(select(func.count()).select_from(User))).one()
+
+    async def run():
+        async with AsyncSession(write_engine) as writer:
+            await writer.exec(select(User.id).limit(1))
+            return await asyncio.wait_for(asyncio.gather(read(), read()), timeout=2)
+
+    for _engine in (async_engine, write_engine):
+        event.listen(_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        assert len(asyncio.run(run())) == 2
+    finally:
+        for _engine in (async_engine, write_engine):
+            event.remove(_engine.sync_engine, "before_cursor_execute", record)
+
+    assert begins.count(f"BEGIN {config.database.sqlite.transaction_mode}") == 1
+    assert begins.count("BEGIN DEFERRED") == 2
+
+
+@sqlite_only
+def test_read_sessions_refuse_writes():
+    async def write_on_read_session():
+        async with AsyncSession(async_engine) as session:
+            await session.exec(
+                update(User).where(col(User.id) == -1).values(username="")
+            )
+
+    with pytest.raises(OperationalError, match="readonly"):
+        asyncio.run(write_on_read_session())
+
+
+def test_username_resolver():
+    resolver = UsernameResolver(max_size=2)
+
+    async def resolve(username):
+        async with AsyncSession(async_engine) as session:
+            return await resolver.resolve(session, username)
+
+    # Misses are not cached, the name may be registered later
+    assert asyncio.run(resolve("resolver_user_missing")) is None
+    assert resolver.cached("resolver_user_missing") is None
+
+    # Least recently used entries are evicted past max_size
+    resolver.remember("a", 1)
+    resolver.remember("b", 2)
+    resolver.cached("a")
+    resolver.remember("c", 3)
+    assert resolver.cached("b") is None
+    assert resolver.cached("a") == 1
+    assert resolver.cached("c") == 3
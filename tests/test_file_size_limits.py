@@ -12,7 +12,9 @@ import pytest
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 from fastapi.testclient import TestClient
 
+from app.core.rate_limits import USERNAME_HEADER
 from app.main import app
+from app.routers import files
 
 client = TestClient(app)
 
@@ -59,7 +61,9 @@ def setup_test_users(private_key):
         "public_key": public_key_b64,
     }
     signed_payload = sign_payload(register_payload, private_key, TEST_USERNAME)
-    response = client.post("/auth/register", json=signed_payload)
+    response = client.post(
+        "/auth/register", json=signed_payload, headers={USERNAME_HEADER: TEST_USERNAME}
+    )
     
     # Register storage test user
     register_payload_storage = {
@@ -67,7 +71,11 @@ def setup_test_users(private_key):
         "public_key": public_key_b64,
     }
     signed_payload_storage = sign_payload(register_payload_storage, private_key, TEST_USERNAME_STORAGE)
-    response_storage = client.post("/auth/register", json=signed_payload_storage)
+    response_storage = client.post(
+        "/auth/register",
+        json=signed_payload_storage,
+        headers={USERNAME_HEADER: TEST_USERNAME_STORAGE},
+    )
 
 
 class TestFileSizeLimits:
@@ -88,7 +96,11 @@ class TestFileSizeLimits:
         }
 
         signed_payload = sign_payload(upload_payload, private_key, TEST_USERNAME)
-        response = client.post("/files/upload", json=signed_payload)
+        response = client.post(
+            "/files/upload",
+            json=signed_payload,
+            headers={USERNAME_HEADER: TEST_USERNAME},
+        )
 
         assert response.status_code == 200
         assert "uploaded successfully" in response.json().get("message", "").lower()
@@ -110,7 +122,11 @@ class TestFileSizeLimits:
         }
 
         signed_payload = sign_payload(upload_payload, private_key, TEST_USERNAME)
-        response = client.post("/files/upload", json=signed_payload)
+        response = client.post(
+            "/files/upload",
+            json=signed_payload,
+            headers={USERNAME_HEADER: TEST_USERNAME},
+        )
 
         # This should succeed since we're using a small file
         assert response.status_code == 200
@@ -137,11 +153,42 @@ class TestStorageLimits:
             }
 
             signed_payload = sign_payload(upload_payload, private_key, TEST_USERNAME_STORAGE)
-            response = client.post("/files/upload", json=signed_payload)
+            response = client.post(
+                "/files/upload",
+                json=signed_payload,
+                headers={USERNAME_HEADER: TEST_USERNAME_STORAGE},
+            )
 
             assert response.status_code == 200
             assert "uploaded successfully" in response.json().get("message", "").lower()
 
+    def test_upload_over_storage_limit_leaves_no_file(
+        self, private_key, setup_test_users, monkeypatch
+    ):
+        """Test that an upload refused for storage leaves nothing on disk."""
+        monkeypatch.setattr(files.config.files, "max_total_user_storage", 1024)
+        file_uuid = str(uuid_lib.uuid4())
+
+        upload_payload = {
+            "uuid": file_uuid,
+            "username": TEST_USERNAME_STORAGE,
+            "file_name": "over_limit.txt",
+            "file_content_b64": create_test_file_content(2048),
+        }
+
+        signed_payload = sign_payload(
+            upload_payload, private_key, TEST_USERNAME_STORAGE
+        )
+        response = client.post(
+            "/files/upload",
+            json=signed_payload,
+            headers={USERNAME_HEADER: TEST_USERNAME_STORAGE},
+        )
+
+        assert response.status_code == 413
+        assert not (files.uploads_dir / file_uuid).exists()
+        assert not list(files.uploads_dir.glob(".*.part"))
+
 
 class TestInvalidFileContent:
     """Test handling of invalid file content."""
@@ -158,7 +205,11 @@ class TestInvalidFileContent:
         }
 
         signed_payload = sign_payload(upload_payload, private_key, TEST_USERNAME)
-        response = client.post("/files/upload", json=signed_payload)
+        response = client.post(
+            "/files/upload",
+            json=signed_payload,
+            headers={USERNAME_HEADER: TEST_USERNAME},
+        )
 
         assert response.status_code == 400
         assert "Invalid Base64 content" in response.json().get("detail", "")
@@ -177,7 +228,11 @@ class TestInvalidFileContent:
         }
 
         signed_payload = sign_payload(upload_payload, private_key, TEST_USERNAME)
-        response = client.post("/files/upload", json=signed_payload)
+        response = client.post(
+            "/files/upload",
+            json=signed_payload,
+            headers={USERNAME_HEADER: TEST_USERNAME},
+        )
 
         assert response.status_code == 200
         assert "uploaded successfully" in response.json().get("message", "").lower() 
\ No newline at end of file
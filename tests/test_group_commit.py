@@ -0,0 +1,100 @@
+"""
+Test the group-commit write coalescer.
+"""
+
+import asyncio
+import uuid as uuid_lib
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import event
+from sqlmodel import Session, col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.models.schema import User
+from app.shared.db import async_engine, config, engine, is_sqlite, write_engine
+from app.shared.group_commit import WriteCoalescer
+
+suffix = uuid_lib.uuid4().hex[:8]
+
+
+def add_user(name: str, fail: bool = False):
+    async def unit(session: AsyncSession) -> str:
+        session.add(User(username=name, public_key=b"\x00" * 32))
+        await session.flush()
+        if fail:
+            raise HTTPException(status_code=409, detail="unit failed")
+        return name
+
+    return unit
+
+
+def stored(names: list[str]) -> set[str]:
+    with Session(engine) as session:
+        query = select(User.username).where(col(User.username).in_(names))
+        return set(session.exec(query))
+
+
+async def submit_concurrently(coalescer: WriteCoalescer, units) -> list:
+    async def submit(unit):
+        async with AsyncSession(async_engine) as session:
+            return await coalescer.commit(session, unit)
+
+    return await asyncio.gather(
+        *(submit(unit) for unit in units), return_exceptions=True
+    )
+
+
+sqlite_only = pytest.mark.skipif(
+    not is_sqlite(config.database.path), reason="counts SQLite BEGINs"
+)
+
+
+def run_counting_transactions(coalescer: WriteCoalescer, units) -> tuple[list, int]:
+    begins = []
+
+    def record(_conn, _cursor, statement, *_):
+        if statement.startswith("BEGIN"):
+            begins.append(statement)
+
+    event.listen(write_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        results = asyncio.run(submit_concurrently(coalescer, units))
+    finally:
+        event.remove(write_engine.sync_engine, "before_cursor_execute", record)
+    return results, len(begins)
+
+
+@sqlite_only
+def test_concurrent_writes_share_one_transaction():
+    coalescer = WriteCoalescer(write_engine, enabled=True, window=0.05, max_batch=64)
+    names = [f"group_commit_{suffix}_{i}" for i in range(20)]
+
+    results, transactions = run_counting_transactions(coalescer, map(add_user, names))
+
+    assert results == names
+    assert transactions == 1
+    assert stored(names) == set(names)
+
+
+@sqlite_only
+def test_batches_are_capped():
+    coalescer = WriteCoalescer(write_engine, enabled=True, window=0.05, max_batch=4)
+    names = [f"group_capped_{suffix}_{i}" for i in range(10)]
+
+    _, transactions = run_counting_transactions(coalescer, map(add_user, names))
+
+    assert transactions == 3
+    assert stored(names) == set(names)
+
+
+def test_failing_write_only_rolls_back_itself():
+    coalescer = WriteCoalescer(write_engine, enabled=True, window=0.05, max_batch=64)
+    names = [f"group_rollback_{suffix}_{i}" for i in range(3)]
+    units = [add_user(names[0]), add_user(names[1], fail=True), add_user(names[2])]
+
+    first, failed, last = asyncio.run(submit_concurrently(coalescer, units))
+
+    assert (first, last) == (names[0], names[2])
+    assert isinstance(failed, HTTPException) and failed.status_code == 409
+    assert stored(names) == {names[0], names[2]}
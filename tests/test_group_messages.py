@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Test posting initial messages to several recipients in one request.
+"""
+
+import os
+import uuid as uuid_lib
+
+from sqlalchemy import event
+from sqlmodel import Session, col, select, update
+
+from app.models.schema import MessageInventory, User
+from app.shared import load_config
+from app.shared.db import engine, write_engine
+from tests.conftest import Signer, b64
+
+config = load_config()
+
+signer = Signer(b"group_messages_test_key_32_byte!")
+post = signer.post
+
+suffix = uuid_lib.uuid4().hex[:8]
+SHARER = f"group_sharer_{suffix}"
+MEMBERS = [f"group_member_{i}_{suffix}" for i in range(3)]
+FULL = f"group_full_{suffix}"
+
+
+def recipient_message(recipient: str, body: bytes) -> dict:
+    return {
+        "recipient_username": recipient,
+        "sharer_ephemeral_key_public": b64(os.urandom(32)),
+        "otp_hash": b64(os.urandom(32)),
+        "encrypted_message": b64(body),
+        "kem_ciphertext": b64(os.urandom(1088)),
+        "pq_otp_hash": b64(os.urandom(32)),
+    }
+
+
+def post_group(messages: list[dict], status=200):
+    return post("/x3dh/post_return_messages", {
+        "sharer_username": SHARER,
+        "sharer_identity_key_public": b64(os.urandom(32)),
+        "messages": messages,
+    }, SHARER, status)
+
+
+def setup_module():
+    signer.register(SHARER, *MEMBERS, FULL)
+
+
+def test_one_insert_for_every_recipient():
+    statements = []
+
+    def record(_conn, _cursor, statement, *_):
+        statements.append(statement)
+
+    malformed = recipient_message(MEMBERS[2], b"\x02")
+    malformed["otp_hash"] = "not base64!"
+    messages = [
+        recipient_message(MEMBERS[0], b"\x00" * 16),
+        recipient_message(MEMBERS[1], b"\x01" * 16),
+        malformed,
+        recipient_message(f"group_nobody_{suffix}", b"\x03"),
+    ]
+
+    event.listen(write_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        result = post_group(messages).json()
+    finally:
+        event.remove(write_engine.sync_engine, "before_cursor_execute", record)
+
+    assert sorted(result["posted"]) == MEMBERS[:2]
+    assert sorted(result["errors"]) == sorted([MEMBERS[2], f"group_nobody_{suffix}"])
+    assert "otp_hash" in result["errors"][MEMBERS[2]]
+    inserts = [s for s in statements if s.lstrip().upper().startswith("INSERT")]
+    assert len(inserts) == 1
+
+    for i, member in enumerate(MEMBERS[:2]):
+        grabbed = post(
+            "/x3dh/grab_return_messages", {"username": member}, member
+        ).json()["messages"]
+        assert [(m["id"], m["encryptedMessage"]) for m in grabbed] == [
+            (result["posted"][member], b64(bytes([i]) * 16))
+        ]
+        assert grabbed[0]["sharerUsername"] == SHARER
+
+
+def test_full_recipients_are_reported():
+    with Session(engine) as session:
+        full_id = session.exec(select(User.id).where(User.username == FULL)).one()
+        session.exec(
+            update(MessageInventory)
+            .where(col(MessageInventory.user_id) == full_id)
+            .values(messages=config.messages.max_per_recipient)
+        )
+        session.commit()
+
+    result = post_group([
+        recipient_message(FULL, b"\x04"), recipient_message(MEMBERS[2], b"\x05"),
+    ]).json()
+    assert list(result["posted"]) == [MEMBERS[2]]
+    assert "too many undelivered messages" in result["errors"][FULL]
+
+
+def test_repeated_recipients_are_rejected():
+    post_group(
+        [
+            recipient_message(MEMBERS[0], b"\x06"),
+            recipient_message(MEMBERS[0], b"\x07"),
+        ],
+        status=400,
+    )
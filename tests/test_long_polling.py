@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Test grab_return_messages waiting for a message with `wait`.
+"""
+
+import os
+import threading
+import time
+import uuid as uuid_lib
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from app.core.pubsub import MessageHub, messages_hub
+from app.main import app
+from tests.conftest import Signer, b64
+
+suffix = uuid_lib.uuid4().hex[:8]
+SHARER = f"poll_sharer_{suffix}"
+RECIPIENT = f"poll_recipient_{suffix}"
+
+# Parked and waking requests must share one event loop, so the client is
+# entered for the whole module instead of starting a loop per request
+client = TestClient(app)
+signer = Signer(b"long_polling_test_key_32_bytes!!", client)
+post = signer.post
+
+
+def send_message(body: bytes):
+    post("/x3dh/post_return_message", {
+        "sharer_username": SHARER,
+        "recipient_username": RECIPIENT,
+        "sharer_identity_key_public": b64(os.urandom(32)),
+        "sharer_ephemeral_key_public": b64(os.urandom(32)),
+        "otp_hash": b64(os.urandom(32)),
+        "encrypted_message": b64(body),
+        "kem_ciphertext": b64(os.urandom(1088)),
+        "pq_otp_hash": b64(os.urandom(32)),
+    }, SHARER)
+
+
+def grab(**page):
+    return post(
+        "/x3dh/grab_return_messages", {"username": RECIPIENT, **page}, RECIPIENT
+    ).json()
+
+
+def setup_module():
+    client.__enter__()
+    signer.register(SHARER, RECIPIENT)
+
+
+def teardown_module():
+    client.__exit__(None, None, None)
+
+
+def test_parked_grab_wakes_when_a_message_is_posted():
+    result = {}
+
+    def park():
+        start = time.monotonic()
+        result["page"] = grab(wait=10)
+        result["elapsed"] = time.monotonic() - start
+
+    waiter = threading.Thread(target=park)
+    waiter.start()
+    deadline = time.monotonic() + 5
+    while messages_hub.waiting == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert messages_hub.waiting == 1
+
+    send_message(b"\x01" * 16)
+    waiter.join(timeout=10)
+
+    assert result["elapsed"] < 5
+    assert [m["encryptedMessage"] for m in result["page"]["messages"]] == [
+        b64(b"\x01" * 16)
+    ]
+    assert messages_hub.waiting == 0
+
+
+def test_wait_returns_immediately_when_messages_are_stored():
+    start = time.monotonic()
+    page = grab(wait=10)
+    assert time.monotonic() - start < 5
+    assert page["messages"]
+
+
+def test_wait_times_out_with_an_empty_page():
+    cursor = grab()["messages"][-1]["id"]
+    start = time.monotonic()
+    page = grab(after=cursor, wait=0.2)
+    assert time.monotonic() - start >= 0.2
+    assert page["messages"] == []
+
+
+def test_parked_grabs_are_capped():
+    hub = MessageHub(queue_size=1, max_parked=3, max_parked_per_user=2)
+    with hub.parked(1), hub.parked(1):
+        with pytest.raises(HTTPException) as per_user, hub.parked(1):
+            pass
+        assert per_user.value.status_code == 429
+
+        with hub.parked(2):
+            with pytest.raises(HTTPException) as per_worker, hub.parked(3):
+                pass
+            assert per_worker.value.status_code == 503
+    assert hub.waiting == 0
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Test the per-recipient message cap and the expiry sweeper.
+"""
+
+import asyncio
+import os
+import uuid as uuid_lib
+from datetime import UTC, datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+from sqlmodel import Session, col, select, update
+
+from app.core.messages import expire_messages
+from app.models.schema import MessageInventory, MessageStore, User
+from app.shared import load_config
+from app.shared.db import engine, is_sqlite, write_engine
+from tests.conftest import Signer, b64
+
+config = load_config()
+
+signer = Signer(b"message_expiry_test_key_32_byte!")
+post = signer.post
+
+suffix = uuid_lib.uuid4().hex[:8]
+SHARER = f"expiry_sharer_{suffix}"
+RECIPIENT = f"expiry_recipient_{suffix}"
+FULL = f"expiry_full_{suffix}"
+ZONED = f"expiry_zoned_{suffix}"
+
+
+def send_message(recipient: str, status=200):
+    return post("/x3dh/post_return_message", {
+        "sharer_username": SHARER,
+        "recipient_username": recipient,
+        "sharer_identity_key_public": b64(os.urandom(32)),
+        "sharer_ephemeral_key_public": b64(os.urandom(32)),
+        "otp_hash": b64(os.urandom(32)),
+        "encrypted_message": b64(os.urandom(16)),
+        "kem_ciphertext": b64(os.urandom(1088)),
+        "pq_otp_hash": b64(os.urandom(32)),
+    }, SHARER, status)
+
+
+def message_ids(recipient: str) -> list[int]:
+    page = post("/x3dh/grab_return_messages", {"username": recipient}, recipient).json()
+    return [message["id"] for message in page["messages"]]
+
+
+def user_id(username: str) -> int | None:
+    with Session(engine) as session:
+        return session.exec(select(User.id).where(User.username == username)).one()
+
+
+def stored_count(username: str) -> int:
+    with Session(engine) as session:
+        return session.exec(
+            select(MessageInventory.messages).where(
+                MessageInventory.user_id == user_id(username)
+            )
+        ).one()
+
+
+def setup_module():
+    signer.register(SHARER, RECIPIENT, FULL, ZONED)
+
+
+def test_count_follows_posts_and_acks():
+    for _ in range(3):
+        send_message(RECIPIENT)
+    assert stored_count(RECIPIENT) == 3
+
+    ids = message_ids(RECIPIENT)
+    post(
+        "/x3dh/ack_return_messages",
+        {"username": RECIPIENT, "message_ids": ids[:2]},
+        RECIPIENT,
+    )
+    assert stored_count(RECIPIENT) == 1
+
+
+def test_posts_beyond_the_cap_are_refused():
+    with Session(engine) as session:
+        session.exec(
+            update(MessageInventory)
+            .where(col(MessageInventory.user_id) == user_id(FULL))
+            .values(messages=config.messages.max_per_recipient - 1)
+        )
+        session.commit()
+
+    send_message(FULL)
+    response = send_message(FULL, status=429)
+    assert "too many undelivered messages" in response.json()["detail"]
+    assert stored_count(FULL) == config.messages.max_per_recipient
+
+
+def test_sweeper_deletes_expired_messages_in_batches():
+    for _ in range(4):
+        send_message(RECIPIENT)
+    stored = message_ids(RECIPIENT)
+    assert len(stored) == 5
+
+    expired_at = datetime.now(UTC) - timedelta(seconds=config.messages.ttl + 3600)
+    with Session(engine) as session:
+        session.exec(
+            update(MessageStore)
+            .where(col(MessageStore.id).in_(stored[:-1]))
+            .values(created_at=expired_at)
+        )
+        session.commit()
+
+    deletes = []
+
+    def record(_conn, _cursor, statement, *_):
+        if statement.lstrip().upper().startswith("DELETE"):
+            deletes.append(statement)
+
+    event.listen(write_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        expired = asyncio.run(expire_messages(batch=3))
+    finally:
+        event.remove(write_engine.sync_engine, "before_cursor_execute", record)
+
+    assert expired == 4
+    assert len(deletes) == 2
+    assert message_ids(RECIPIENT) == stored[-1:]
+    assert stored_count(RECIPIENT) == 1
+
+
+@pytest.mark.skipif(is_sqlite(config.database.path), reason="SQLite has no time zones")
+def test_sweeper_cutoff_ignores_session_time_zone():
+    """
+    created_at and the cutoff are UTC instants, so a server or session time
+    zone other than UTC must not move messages in or out of the TTL.
+    """
+    for _ in range(2):
+        send_message(ZONED)
+    recent, old = message_ids(ZONED)
+
+    now = datetime.now(UTC)
+    with Session(engine) as session:
+        for message_id, age in ((recent, 1), (old, 3)):
+            session.exec(
+                update(MessageStore)
+                .where(col(MessageStore.id) == message_id)
+                .values(created_at=now - timedelta(hours=age))
+            )
+        session.commit()
+
+    def set_time_zone(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SET TIME ZONE 'Asia/Tokyo'")
+        cursor.close()
+
+    event.listen(write_engine.sync_engine, "connect", set_time_zone)
+    try:
+        asyncio.run(expire_messages(ttl=2 * 3600))
+    finally:
+        event.remove(write_engine.sync_engine, "connect", set_time_zone)
+
+    assert message_ids(ZONED) == [recent]
+    assert stored_count(ZONED) == 1
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Test the plain ASGI middleware: oversized bodies are refused whether or not
+they declare their length, and responses carry their timing.
+"""
+
+from fastapi.testclient import TestClient
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+from app.core.rate_limits import USERNAME_HEADER
+from app.main import app
+from app.middleware import SERVER_TIMING_HEADER, BodyLimit, Timing
+from app.shared import load_config
+
+config = load_config()
+
+client = TestClient(app)
+
+
+async def echo(request: Request) -> Response:
+    return Response(await request.body())
+
+
+limited = TestClient(
+    BodyLimit(Starlette(routes=[Route("/echo", echo, methods=["POST"])]), max_size=10)
+)
+
+
+def test_body_within_the_limit_passes():
+    response = limited.post("/echo", content=b"0123456789")
+    assert response.status_code == 200
+    assert response.content == b"0123456789"
+
+
+def test_declared_length_over_the_limit_is_refused():
+    assert limited.post("/echo", content=b"0123456789!").status_code == 413
+
+
+def test_streamed_body_over_the_limit_is_refused():
+    def chunks():
+        for _ in range(4):
+            yield b"01234"
+
+    # A generator is sent chunked, with no Content-Length to check up front
+    assert limited.post("/echo", content=chunks()).status_code == 413
+
+
+def test_app_refuses_bodies_over_max_body_size():
+    response = client.post(
+        "/x3dh/prekey_inventory",
+        content=b"{}",
+        headers={
+            USERNAME_HEADER: "someone",
+            "Content-Length": str(config.network.max_body_size + 1),
+        },
+    )
+    assert response.status_code == 413
+
+
+def test_responses_carry_server_timing():
+    # Timed whether or not [logging] server_timing adds the middleware to the app
+    timed = TestClient(Timing(app))
+    response = timed.post("/x3dh/prekey_inventory", content=b"not even JSON")
+    assert response.status_code == 400
+    assert response.headers[SERVER_TIMING_HEADER].startswith("app;dur=")
@@ -0,0 +1,96 @@
+"""
+Test the alembic migrations against a scratch SQLite database.
+"""
+
+import hashlib
+
+from alembic import command
+from sqlalchemy import create_engine, inspect
+
+from app.shared.db import alembic_config
+
+
+def upgrade(engine, revision):
+    with engine.begin() as connection:
+        command.upgrade(alembic_config(connection), revision)
+
+
+def test_username_keys_migrate_to_user_ids(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    upgrade(engine, "0002")
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "INSERT INTO user (id, username, public_key) VALUES "
+            "(7, 'alice', x'00'), (9, 'bob', x'01')"
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO otp (f_username, otp_val, used) VALUES "
+            "('bob', x'02', 0), ('bob', x'03', 1)"
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO messagestore (recipient_username, sharer_username, "
+            "sharer_identity_key_public, eph_key, e_message, otp_hash, pq_ct, "
+            "pq_otp_hash) VALUES ('bob', 'alice', x'', x'', x'', x'', x'', x'')"
+        )
+
+    upgrade(engine, "head")
+
+    with engine.connect() as connection:
+        otp_columns = {c["name"] for c in inspect(connection).get_columns("otp")}
+        otp_rows = connection.exec_driver_sql("SELECT user_id, otp_val FROM otp").all()
+        inventory = connection.exec_driver_sql(
+            "SELECT user_id, otps, pq_otps FROM prekeyinventory ORDER BY user_id"
+        ).all()
+        message = connection.exec_driver_sql(
+            "SELECT recipient_id, sharer_id, created_at IS NOT NULL FROM messagestore"
+        ).one()
+        stored = connection.exec_driver_sql(
+            "SELECT user_id, messages FROM messageinventory ORDER BY user_id"
+        ).all()
+
+    assert "f_username" not in otp_columns
+    assert "used" not in otp_columns
+    # Claimed prekeys are dropped, unclaimed ones moved to the owner's id
+    assert [tuple(row) for row in otp_rows] == [(9, b"\x02")]
+    assert tuple(message) == (9, 7, 1)
+    assert [tuple(row) for row in stored] == [(7, 0), (9, 1)]
+    assert [tuple(row) for row in inventory] == [(7, 0, 0), (9, 1, 0)]
+
+
+def test_duplicate_one_time_prekeys_are_removed(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'duplicates.db'}")
+    upgrade(engine, "0006")
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "INSERT INTO user (id, username, public_key) VALUES (1, 'bob', x'00')"
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO prekeyinventory (user_id, otps, pq_otps) VALUES (1, 3, 2)"
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO otp (user_id, otp_val) "
+            "VALUES (1, x'01'), (1, x'02'), (1, x'01')"
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO pqonetimeprekey (user_id, pqotp, pqotp_sig) "
+            "VALUES (1, x'03', x''), (1, x'03', x'')"
+        )
+
+    upgrade(engine, "head")
+
+    with engine.connect() as connection:
+        otp_ids = (
+            connection.exec_driver_sql("SELECT id FROM otp ORDER BY id").scalars().all()
+        )
+        pq_digests = connection.exec_driver_sql(
+            "SELECT pqotp_digest FROM pqonetimeprekey"
+        ).scalars().all()
+        inventory = connection.exec_driver_sql(
+            "SELECT otps, pq_otps FROM prekeyinventory"
+        ).one()
+
+    assert otp_ids == [1, 2]
+    assert pq_digests == [hashlib.sha256(b"\x03").digest()]
+    assert tuple(inventory) == (2, 1)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Test msgpack content negotiation for signed requests and x3dh responses.
+"""
+
+import base64
+import uuid as uuid_lib
+
+import msgpack
+import pytest
+from fastapi.testclient import TestClient
+
+from app.core.rate_limits import USERNAME_HEADER
+from app.main import app
+from app.models.requests import MSGPACK_MEDIA_TYPE
+from tests.conftest import Signer
+
+client = TestClient(app)
+
+signer = Signer(b"msgpack_test_key_32_bytes_long!!", client)
+public_key_bytes = signer.private_key.public_key().public_bytes_raw()
+
+TARGET_USERNAME = f"msgpack_target_{uuid_lib.uuid4().hex[:8]}"
+REQUESTER_USERNAME = f"msgpack_requester_{uuid_lib.uuid4().hex[:8]}"
+
+
+def pack(obj) -> bytes:
+    return msgpack.packb(obj, use_bin_type=True) or b""
+
+
+def post_msgpack(url, payload_dict, username, accept_msgpack=True):
+    """Sign a msgpack payload and post it inside a msgpack envelope."""
+    payload_bytes = pack(payload_dict)
+    envelope = {
+        "payload": payload_bytes,
+        "signature": signer.private_key.sign(payload_bytes),
+        "username": username,
+    }
+    headers = {USERNAME_HEADER: username, "Content-Type": MSGPACK_MEDIA_TYPE}
+    if accept_msgpack:
+        headers["Accept"] = MSGPACK_MEDIA_TYPE
+    return client.post(url, content=pack(envelope), headers=headers)
+
+
+def post_json(url, payload_dict, username):
+    return signer.post(url, payload_dict, username, status=None)
+
+
+@pytest.fixture(scope="module", autouse=True)
+def target_with_prekeys():
+    for username in (TARGET_USERNAME, REQUESTER_USERNAME):
+        response = post_msgpack(
+            "/auth/register",
+            {"username": username, "public_key": public_key_bytes},
+            username,
+        )
+        assert response.status_code == 200
+
+    pushes = [
+        (
+            "/x3dh/signed_prekey_push",
+            {
+                "username": TARGET_USERNAME,
+                "signed_prekey_public": b"\x01" * 32,
+                "signed_prekey_signature": b"\x02" * 64,
+            },
+        ),
+        (
+            "/x3dh/pq_signed_prekey_push",
+            {
+                "username": TARGET_USERNAME,
+                "pq_signed_prekey_public": b"\x03" * 1184,
+                "pq_signed_prekey_signature": b"\x04" * 64,
+            },
+        ),
+        (
+            "/x3dh/otp_prekey_push",
+            {"username": TARGET_USERNAME, "pub_otps": [b"\x05" * 32, b"\x06" * 32]},
+        ),
+        (
+            "/x3dh/pq_otp_prekey_push",
+            {
+                "username": TARGET_USERNAME,
+                "pub_pq_otps": [
+                    {"public_key": b"\x07" * 1184, "signature": b"\x08" * 64},
+                    {"public_key": b"\x09" * 1184, "signature": b"\x0a" * 64},
+                ],
+            },
+        ),
+    ]
+    for url, payload in pushes:
+        response = post_msgpack(url, payload, TARGET_USERNAME, accept_msgpack=False)
+        assert response.status_code == 200, response.text
+
+
+def test_prekey_bundle_msgpack_response_has_native_bytes():
+    response = post_msgpack(
+        "/x3dh/prekey_bundle",
+        {"username": REQUESTER_USERNAME, "target_username": TARGET_USERNAME},
+        REQUESTER_USERNAME,
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == MSGPACK_MEDIA_TYPE
+
+    bundle = msgpack.unpackb(response.content)
+    assert bundle["identityKey"] == public_key_bytes
+    assert bundle["signedPrekey"] == b"\x01" * 32
+    assert bundle["pqSignedPrekey"] == b"\x03" * 1184
+    assert isinstance(bundle["oneTimePqPrekey"], bytes)
+
+
+def test_prekey_bundle_json_response_stays_base64():
+    response = post_json(
+        "/x3dh/prekey_bundle",
+        {"username": REQUESTER_USERNAME, "target_username": TARGET_USERNAME},
+        REQUESTER_USERNAME,
+    )
+
+    assert response.status_code == 200
+    bundle = response.json()
+    assert base64.b64decode(bundle["identityKey"]) == public_key_bytes
+    assert base64.b64decode(bundle["signedPrekey"]) == b"\x01" * 32
+
+
+def test_msgpack_bad_signature_rejected():
+    payload_bytes = pack(
+        {"username": REQUESTER_USERNAME, "target_username": TARGET_USERNAME}
+    )
+    envelope = {
+        "payload": payload_bytes,
+        "signature": b"\x00" * 64,
+        "username": REQUESTER_USERNAME,
+    }
+    response = client.post(
+        "/x3dh/prekey_bundle",
+        content=pack(envelope),
+        headers={"Content-Type": MSGPACK_MEDIA_TYPE},
+    )
+
+    assert response.status_code == 400
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Test that unknown usernames and file UUIDs are rejected without touching the
+database once the negative cache knows them, and that a key inserted by
+another worker is found once the cache has caught up with it.
+"""
+
+import asyncio
+import os
+import subprocess
+import sys
+import uuid as uuid_lib
+from pathlib import Path
+
+import pytest
+from sqlalchemy import event
+from sqlmodel import col
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.negative_cache import (
+    BloomFilter,
+    NegativeCache,
+    missing_files,
+    missing_usernames,
+)
+from app.models.schema import User
+from app.shared.db import async_engine
+from tests.conftest import Signer
+
+SEED = b"negative_cache_test_key_32_byte!"
+signer = Signer(SEED)
+
+suffix = uuid_lib.uuid4().hex[:8]
+PROBER = f"probe_{suffix}"
+
+REPO_ROOT = Path(__file__).parent.parent
+
+
+def post_recording_queries(url, payload_dict, username) -> tuple[int, list[str]]:
+    """The response status and the statements the request ran."""
+    statements = []
+
+    def record(_conn, _cursor, statement, *_):
+        if not statement.startswith("BEGIN"):
+            statements.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        response = signer.post(url, payload_dict, username, status=None)
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+    return response.status_code, statements
+
+
+def only_marks(statements: list[str]) -> bool:
+    return all("max(" in statement.lower() for statement in statements)
+
+
+def register_in_another_worker(*usernames: str):
+    """Register `usernames` from a separate process on the same database."""
+    script = (
+        "import sys\n"
+        "from tests.conftest import Signer\n"
+        f"Signer({SEED!r}).register(*sys.argv[1:])\n"
+    )
+    subprocess.run(
+        [sys.executable, "-c", script, *usernames],
+        cwd=REPO_ROOT,
+        env={**os.environ, "PYTHONPATH": str(REPO_ROOT / "src")},
+        check=True,
+        capture_output=True,
+    )
+
+
+def catch_up(*caches: NegativeCache):
+    async def run():
+        async with AsyncSession(async_engine) as session:
+            for cache in caches:
+                await cache.catch_up(session)
+
+    asyncio.run(run())
+
+
+def setup_module():
+    signer.register(PROBER)
+    # A loaded filter, whether or not another module loaded it already
+    asyncio.run(missing_usernames.refresh())
+    asyncio.run(missing_files.refresh())
+
+
+def teardown_module():
+    missing_usernames.clear()
+    missing_files.clear()
+
+
+@pytest.fixture
+def trusted_for_a_minute(monkeypatch):
+    """No reads of the newest id during the test, once caught up."""
+    for cache in (missing_usernames, missing_files):
+        monkeypatch.setattr(cache, "max_staleness", 60)
+    catch_up(missing_usernames, missing_files)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(capacity=5000, false_positive_rate=0.01)
+    added = [f"user_{i}" for i in range(5000)]
+    for key in added:
+        bloom.add(key)
+
+    assert all(key in bloom for key in added)
+    false_positives = sum(f"other_{i}" in bloom for i in range(20_000))
+    assert false_positives < 20_000 * 0.02
+
+
+def test_miss_expires_and_insert_forgets_it():
+    cache = NegativeCache(
+        "test", col(User.username), col(User.id), capacity=10,
+        false_positive_rate=0.01, miss_ttl=60, miss_cache_size=2, max_staleness=60,
+    )
+
+    async def absent(*keys):
+        async with AsyncSession(async_engine) as session:
+            return await cache.absent(session, keys)
+
+    catch_up(cache)
+    cache.miss("a", cache.generation)
+    assert asyncio.run(absent("a")) == {"a"}
+    cache.add("a")
+    assert asyncio.run(absent("a")) == set()
+
+    cache.miss("b", cache.generation)
+    cache.miss("c", cache.generation)
+    cache.miss("d", cache.generation)  # "b" falls out past miss_cache_size
+    assert asyncio.run(absent("b", "d")) == {"d"}
+
+    cache.miss("e", cache.generation - 1)  # looked up before the last catch-up
+    cache.miss_ttl = 0
+    cache.miss("f", cache.generation)
+    assert asyncio.run(absent("e", "f")) == set()
+
+
+def test_repeated_unknown_signer_skips_the_lookup(trusted_for_a_minute):
+    stranger = f"stranger_{uuid_lib.uuid4().hex[:8]}"
+    payload = {"username": stranger}
+
+    for _ in range(2):
+        status, statements = post_recording_queries(
+            "/x3dh/prekey_inventory", payload, stranger
+        )
+        assert status == 404
+        assert statements == []
+
+
+def test_repeated_unknown_file_and_target_skip_their_lookups(trusted_for_a_minute):
+    download = {"uuid": str(uuid_lib.uuid4()), "username": PROBER}
+    status, statements = post_recording_queries("/files/download", download, PROBER)
+    assert status == 404
+    assert len(statements) == 1  # the signer, and no file lookup
+
+    target = {"username": PROBER, "target_username": f"nobody_{suffix}"}
+    status, statements = post_recording_queries("/x3dh/prekey_bundle", target, PROBER)
+    assert status == 404
+    assert len(statements) == 1
+
+
+def test_registering_after_a_miss_works_at_once(trusted_for_a_minute):
+    latecomer = f"latecomer_{suffix}"
+    payload = {"username": latecomer}
+    signer.post("/x3dh/prekey_inventory", payload, latecomer, status=404)
+
+    signer.register(latecomer)
+    signer.post("/x3dh/prekey_inventory", payload, latecomer)
+
+
+def test_user_registered_by_another_worker_is_found_after_a_catch_up(monkeypatch):
+    missed = f"missed_{suffix}"
+    unseen = f"unseen_{suffix}"
+    monkeypatch.setattr(missing_usernames, "max_staleness", 60)
+    # This worker has looked `missed` up and loaded a filter without either
+    signer.post("/x3dh/prekey_inventory", {"username": missed}, missed, status=404)
+
+    register_in_another_worker(missed, unseen)
+    # Still answered from the cache until it reads the newest id again
+    signer.post("/x3dh/prekey_inventory", {"username": unseen}, unseen, status=404)
+
+    monkeypatch.setattr(missing_usernames, "max_staleness", 0)
+    status, statements = post_recording_queries(
+        "/x3dh/prekey_inventory", {"username": missed}, missed
+    )
+    assert status == 200
+    # The newest id and the keys after the old mark, then the request itself
+    assert only_marks(statements[:1])
+    signer.post("/x3dh/prekey_inventory", {"username": unseen}, unseen)
+
+    # The filter was kept, with both of them in it
+    monkeypatch.setattr(missing_usernames, "max_staleness", 60)
+    stranger = f"stranger_{uuid_lib.uuid4().hex[:8]}"
+    status, statements = post_recording_queries(
+        "/x3dh/prekey_inventory", {"username": stranger}, stranger
+    )
+    assert status == 404
+    assert len(statements) <= 1 and only_marks(statements)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Test bulk OTP and PQ OTP prekey pushes: deduplication and the batch cap.
+"""
+
+import uuid as uuid_lib
+
+from app.shared.db import config
+from tests.conftest import Signer, b64
+
+signer = Signer(b"otp_push_test_key_32_bytes_long!")
+
+OWNER = f"push_owner_{uuid_lib.uuid4().hex[:8]}"
+
+
+def post(url, payload_dict, username=OWNER):
+    return signer.post(url, payload_dict, username, status=None)
+
+
+def push_otps(keys):
+    return post("/x3dh/otp_prekey_push", {"username": OWNER, "pub_otps": keys})
+
+
+def push_pq_otps(keys):
+    return post("/x3dh/pq_otp_prekey_push", {
+        "username": OWNER,
+        "pub_pq_otps": [
+            {"public_key": key, "signature": b64(b"\x08" * 64)} for key in keys
+        ],
+    })
+
+
+def inventory():
+    return post("/x3dh/prekey_inventory", {"username": OWNER}).json()
+
+
+def setup_module():
+    signer.register(OWNER)
+
+
+def test_duplicate_otps_are_stored_once():
+    keys = [b64(bytes([i]) * 32) for i in range(3)]
+
+    first = push_otps([*keys, keys[0], "not base64!"])
+    again = push_otps([*keys[1:], b64(b"\x09" * 32)])
+
+    assert first.status_code == again.status_code == 200
+    assert first.json()["stored"] == 3 and first.json()["duplicates"] == 2
+    assert again.json()["stored"] == 1 and again.json()["duplicates"] == 2
+    assert inventory()["otps"] == 4
+
+
+def test_duplicate_pq_otps_are_stored_once():
+    keys = [b64(bytes([i]) * 1184) for i in range(2)]
+
+    first = push_pq_otps(keys + keys)
+    again = push_pq_otps(keys)
+
+    assert first.json()["stored"] == 2
+    assert again.json()["stored"] == 0
+    assert inventory()["pqOtps"] == 2
+
+
+def test_push_over_the_batch_cap_is_rejected():
+    keys = [b64(i.to_bytes(32)) for i in range(config.prekeys.max_push_batch + 1)]
+
+    response = push_otps(keys)
+
+    assert response.status_code == 413
@@ -13,11 +13,10 @@ from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 from fastapi.testclient import TestClient
 from fastapi import HTTPException
 
+from app.core.rate_limits import USERNAME_HEADER
 from app.main import app
 import app.routers.files as files_module
 
-client = TestClient(app)
-
 # Use a fixed private key for signing
 private_bytes = b"0" * 32
 private_key = Ed25519PrivateKey.from_private_bytes(private_bytes)
@@ -27,6 +26,8 @@ public_key_b64 = base64.b64encode(public_key_bytes).decode()
 
 TEST_USERNAME = "path_test_user"
 
+client = TestClient(app, headers={USERNAME_HEADER: TEST_USERNAME})
+
 def sign_payload(payload_dict, private_key, username):
     payload_json = json.dumps(payload_dict, separators=(",", ":"))
     payload_bytes = payload_json.encode()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Test the in-memory cache of the static part of prekey bundles.
+"""
+
+import uuid as uuid_lib
+from time import monotonic
+
+from sqlalchemy import event
+from sqlmodel import Session, col, select, update
+
+from app.core import prekeys
+from app.core.prekeys import StaticBundle, StaticBundleCache, static_bundles
+from app.models.schema import PrekeyBundle, User
+from app.shared.db import async_engine, engine
+from tests.conftest import Signer, b64
+
+signer = Signer(b"bundle_cache_test_key_32_bytes!!")
+post = signer.post
+
+TARGET = f"cache_target_{uuid_lib.uuid4().hex[:8]}"
+REQUESTER = f"cache_requester_{uuid_lib.uuid4().hex[:8]}"
+
+
+def push_signed_prekey(prekey: bytes):
+    post("/x3dh/signed_prekey_push", {
+        "username": TARGET,
+        "signed_prekey_public": b64(prekey),
+        "signed_prekey_signature": b64(b"\x02" * 64),
+    }, TARGET)
+
+
+def fetch_bundle_recording_queries():
+    queries = []
+
+    def record(_conn, _cursor, statement, *_):
+        queries.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        bundle = post(
+            "/x3dh/prekey_bundle",
+            {"username": REQUESTER, "target_username": TARGET},
+            REQUESTER,
+        ).json()
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+    return bundle, queries
+
+
+def setup_module():
+    signer.register(TARGET, REQUESTER)
+    push_signed_prekey(b"\x01" * 32)
+    post("/x3dh/pq_signed_prekey_push", {
+        "username": TARGET,
+        "pq_signed_prekey_public": b64(b"\x03" * 1184),
+        "pq_signed_prekey_signature": b64(b"\x04" * 64),
+    }, TARGET)
+    post("/x3dh/otp_prekey_push", {
+        "username": TARGET, "pub_otps": [b64(bytes([i]) * 32) for i in range(10)],
+    }, TARGET)
+    post("/x3dh/pq_otp_prekey_push", {
+        "username": TARGET,
+        "pub_pq_otps": [
+            {"public_key": b64(bytes([i]) * 1184), "signature": b64(b"\x08" * 64)}
+            for i in range(10)
+        ],
+    }, TARGET)
+
+
+def test_cached_bundle_only_claims_one_time_prekeys():
+    first, _ = fetch_bundle_recording_queries()
+    second, queries = fetch_bundle_recording_queries()
+
+    assert not any("prekeybundle" in statement for statement in queries)
+    assert second["signedPrekey"] == first["signedPrekey"] == b64(b"\x01" * 32)
+    assert second["oneTimePrekey"] != first["oneTimePrekey"]
+
+
+def test_signed_prekey_push_invalidates_cached_bundle():
+    fetch_bundle_recording_queries()
+    assert static_bundles.get(TARGET) is not None
+
+    push_signed_prekey(b"\x11" * 32)
+    assert static_bundles.get(TARGET) is None
+
+    bundle, _ = fetch_bundle_recording_queries()
+    assert bundle["signedPrekey"] == b64(b"\x11" * 32)
+
+
+def test_rotation_by_another_worker_shows_after_the_ttl(monkeypatch):
+    fetch_bundle_recording_queries()
+    assert static_bundles.get(TARGET) is not None
+
+    # Another worker's push commits without invalidating this worker's cache
+    with Session(engine) as session:
+        user_id = session.exec(select(User.id).where(User.username == TARGET)).one()
+        session.exec(
+            update(PrekeyBundle)
+            .where(col(PrekeyBundle.user_id) == user_id)
+            .values(prekey=b"\x21" * 32)
+        )
+        session.commit()
+
+    later = monotonic() + static_bundles.ttl
+    monkeypatch.setattr(prekeys, "monotonic", lambda: later)
+    assert static_bundles.get(TARGET) is None
+    bundle, _ = fetch_bundle_recording_queries()
+    assert bundle["signedPrekey"] == b64(b"\x21" * 32)
+
+
+def test_put_after_invalidation_is_dropped():
+    cache = StaticBundleCache(max_size=1, ttl=60)
+    bundle = StaticBundle(user_id=1, raw={"identity_key": b"\x00"})
+
+    generation = cache.generation
+    cache.invalidate("alice")  # a push commits while the fetch is reading
+    cache.put("alice", bundle, generation)
+    assert cache.get("alice") is None
+
+    cache.put("alice", bundle, cache.generation)
+    cache.put("bob", bundle, cache.generation)
+    assert cache.get("alice") is None  # evicted past max_size
+    assert cache.get("bob") is bundle
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Test the batch prekey bundle fetch used for group sharing.
+"""
+
+import uuid as uuid_lib
+
+from sqlalchemy import event
+
+from app.shared.db import async_engine
+from tests.conftest import Signer, b64
+
+signer = Signer(b"bundles_test_key_32_bytes_long!!")
+post = signer.post
+
+suffix = uuid_lib.uuid4().hex[:8]
+REQUESTER = f"group_requester_{suffix}"
+MEMBERS = [f"group_member{i}_{suffix}" for i in range(3)]
+NO_PQ_OTP = f"group_no_pq_otp_{suffix}"
+NO_SIGNED_PREKEY = f"group_no_signed_{suffix}"
+UNKNOWN = f"group_unknown_{suffix}"
+
+
+def push_keys(username, signed=True, otps=2, pq_otps=2):
+    if signed:
+        post("/x3dh/signed_prekey_push", {
+            "username": username,
+            "signed_prekey_public": b64(b"\x01" * 32),
+            "signed_prekey_signature": b64(b"\x02" * 64),
+        }, username)
+        post("/x3dh/pq_signed_prekey_push", {
+            "username": username,
+            "pq_signed_prekey_public": b64(b"\x03" * 1184),
+            "pq_signed_prekey_signature": b64(b"\x04" * 64),
+        }, username)
+    post("/x3dh/otp_prekey_push", {
+        "username": username, "pub_otps": [b64(bytes([i]) * 32) for i in range(otps)],
+    }, username)
+    if pq_otps:
+        post("/x3dh/pq_otp_prekey_push", {
+            "username": username,
+            "pub_pq_otps": [
+                {"public_key": b64(bytes([i]) * 1184), "signature": b64(b"\x08" * 64)}
+                for i in range(pq_otps)
+            ],
+        }, username)
+
+
+def fetch(targets):
+    queries = []
+
+    def record(_conn, _cursor, statement, *_):
+        queries.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        response = post(
+            "/x3dh/prekey_bundles",
+            {"username": REQUESTER, "target_usernames": targets},
+            REQUESTER,
+        )
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+    return response.json(), queries
+
+
+def setup_module():
+    signer.register(REQUESTER, *MEMBERS, NO_PQ_OTP, NO_SIGNED_PREKEY)
+    for username in MEMBERS:
+        push_keys(username)
+    push_keys(NO_PQ_OTP, pq_otps=0)
+    push_keys(NO_SIGNED_PREKEY, signed=False)
+
+
+def test_bundles_and_errors_per_target():
+    result, _ = fetch([MEMBERS[0], NO_PQ_OTP, NO_SIGNED_PREKEY, UNKNOWN, MEMBERS[0]])
+
+    assert list(result["bundles"]) == [MEMBERS[0]]
+    assert result["bundles"][MEMBERS[0]]["signedPrekey"] == b64(b"\x01" * 32)
+    assert result["errors"] == {
+        NO_PQ_OTP: f"Mandatory PQ OTP not available for user: {NO_PQ_OTP}",
+        NO_SIGNED_PREKEY: "Prekey bundle not found for user",
+        UNKNOWN: "Target user not found",
+    }
+
+    # The classical key claimed for the target without PQ keys was put back
+    inventory = post(
+        "/x3dh/prekey_inventory", {"username": NO_PQ_OTP}, NO_PQ_OTP
+    ).json()
+    assert inventory["otps"] == 2
+
+
+def test_query_count_does_not_grow_with_targets():
+    _, one = fetch(MEMBERS[1:2])
+    _, many = fetch(MEMBERS)
+
+    assert len(many) == len(one)
@@ -0,0 +1,78 @@
+"""
+Test that concurrent one-time prekey claims never hand out the same key.
+
+The SKIP LOCKED test needs row locks, so it only runs against Postgres:
+    BENJI_CONFIG=tests/postgres.toml pytest tests/test_prekey_claims.py
+"""
+
+import asyncio
+import uuid as uuid_lib
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.prekeys import claim_one_time_prekey, next_one_time_prekey
+from app.models.schema import Otp, User
+from app.shared.db import async_engine, config, engine, is_sqlite, write_engine
+
+CLAIMERS = 8
+
+
+async def create_user_with_otps(count: int) -> int:
+    async with AsyncSession(write_engine, expire_on_commit=False) as session:
+        user = User(
+            username=f"claim_{uuid_lib.uuid4().hex[:8]}", public_key=b"\x00" * 32
+        )
+        session.add(user)
+        await session.flush()
+        assert user.id is not None
+        for i in range(count):
+            session.add(Otp(user_id=user.id, otp_val=bytes([i]) * 32))
+        await session.commit()
+        return user.id
+
+
+async def claim_while_first_is_held(user_id: int) -> tuple[int | None, int | None]:
+    async with (
+        AsyncSession(async_engine) as first,
+        AsyncSession(async_engine) as second,
+    ):
+        held = (await first.exec(next_one_time_prekey(Otp, user_id))).one()
+        # Without SKIP LOCKED this waits on the first transaction's lock
+        skipped = (
+            await asyncio.wait_for(
+                second.exec(next_one_time_prekey(Otp, user_id)), timeout=5
+            )
+        ).first()
+        return held.id, skipped.id if skipped else None
+
+
+def claim_until_empty(user_id: int) -> list[int]:
+    claimed = []
+    while True:
+        with engine.begin() as connection:
+            row = connection.execute(claim_one_time_prekey(Otp, user_id)).first()
+        if row is None:
+            return claimed
+        claimed.append(row.id)
+
+
+@pytest.mark.skipif(is_sqlite(config.database.path), reason="SQLite has no row locks")
+def test_concurrent_claims_skip_locked_rows():
+    user_id = asyncio.run(create_user_with_otps(2))
+
+    held_id, skipped_id = asyncio.run(claim_while_first_is_held(user_id))
+
+    assert skipped_id is not None
+    assert skipped_id != held_id
+
+
+def test_no_one_time_prekey_is_claimed_twice():
+    user_id = asyncio.run(create_user_with_otps(200))
+
+    with ThreadPoolExecutor(CLAIMERS) as pool:
+        results = list(pool.map(claim_until_empty, [user_id] * CLAIMERS))
+
+    claimed = [otp_id for result in results for otp_id in result]
+    assert len(claimed) == len(set(claimed)) == 200
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Test the one-time prekey inventory endpoint and the low-watermark header.
+"""
+
+import uuid as uuid_lib
+
+from app.core.prekeys import PREKEYS_LOW_HEADER
+from app.shared.db import config
+from tests.conftest import Signer, b64
+
+signer = Signer(b"inventory_test_key_32_bytes_ok!!")
+post = signer.post
+
+OWNER = f"inventory_owner_{uuid_lib.uuid4().hex[:8]}"
+SENDER = f"inventory_sender_{uuid_lib.uuid4().hex[:8]}"
+WATERMARK = config.prekeys.low_watermark
+
+
+def push_otps(count: int):
+    return post("/x3dh/otp_prekey_push", {
+        "username": OWNER,
+        "pub_otps": [b64(bytes([i % 256]) * 32) for i in range(count)],
+    }, OWNER)
+
+
+def push_pq_otps(count: int):
+    return post("/x3dh/pq_otp_prekey_push", {
+        "username": OWNER,
+        "pub_pq_otps": [
+            {"public_key": b64(bytes([i % 256]) * 1184), "signature": b64(b"\x08" * 64)}
+            for i in range(count)
+        ],
+    }, OWNER)
+
+
+def inventory():
+    return post("/x3dh/prekey_inventory", {"username": OWNER}, OWNER)
+
+
+def setup_module():
+    signer.register(OWNER, SENDER)
+    post("/x3dh/signed_prekey_push", {
+        "username": OWNER,
+        "signed_prekey_public": b64(b"\x01" * 32),
+        "signed_prekey_signature": b64(b"\x02" * 64),
+    }, OWNER)
+    post("/x3dh/pq_signed_prekey_push", {
+        "username": OWNER,
+        "pq_signed_prekey_public": b64(b"\x03" * 1184),
+        "pq_signed_prekey_signature": b64(b"\x04" * 64),
+    }, OWNER)
+
+
+def test_new_user_has_an_empty_inventory():
+    response = inventory()
+
+    assert response.json() == {"otps": 0, "pqOtps": 0, "lowWatermark": WATERMARK}
+    assert response.headers[PREKEYS_LOW_HEADER] == "otp=0, pq_otp=0"
+
+
+def test_counts_follow_pushes_and_claims():
+    push_otps(WATERMARK + 1)
+    response = push_pq_otps(WATERMARK + 1)
+    assert PREKEYS_LOW_HEADER not in response.headers
+
+    post("/x3dh/prekey_bundle", {"username": SENDER, "target_username": OWNER}, SENDER)
+    response = post("/x3dh/grab_return_messages", {"username": OWNER}, OWNER)
+    assert PREKEYS_LOW_HEADER not in response.headers
+
+    post("/x3dh/prekey_bundle", {"username": SENDER, "target_username": OWNER}, SENDER)
+    response = inventory()
+    assert response.json()["otps"] == response.json()["pqOtps"] == WATERMARK - 1
+
+    # The owner finds out when polling, before senders start failing
+    response = post("/x3dh/grab_return_messages", {"username": OWNER}, OWNER)
+    low = f"otp={WATERMARK - 1}, pq_otp={WATERMARK - 1}"
+    assert response.headers[PREKEYS_LOW_HEADER] == low
+
+
+def test_only_the_owner_reads_their_inventory():
+    response = post("/x3dh/prekey_inventory", {"username": OWNER}, SENDER, status=403)
+    assert PREKEYS_LOW_HEADER not in response.headers
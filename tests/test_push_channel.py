@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Test pushing posted messages over the WebSocket channel and its SSE fallback.
+"""
+
+import asyncio
+import json
+import os
+import uuid as uuid_lib
+
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from app.core.pubsub import RESYNC_EVENT, SUBSCRIBED_EVENT, MessageHub, messages_hub
+from app.routers.push import sse_events
+from app.shared import load_config
+from tests.conftest import Signer, b64
+
+config = load_config()
+WS_PATH = config.endpoint.ws_client or "/client_endpoint"
+
+signer = Signer(b"push_channel_test_key_32_bytes!!")
+signed = signer.signed
+post = signer.post
+
+suffix = uuid_lib.uuid4().hex[:8]
+SHARER = f"push_sharer_{suffix}"
+RECIPIENT = f"push_recipient_{suffix}"
+
+def send_message(body: bytes):
+    post("/x3dh/post_return_message", {
+        "sharer_username": SHARER,
+        "recipient_username": RECIPIENT,
+        "sharer_identity_key_public": b64(os.urandom(32)),
+        "sharer_ephemeral_key_public": b64(os.urandom(32)),
+        "otp_hash": b64(os.urandom(32)),
+        "encrypted_message": b64(body),
+        "kem_ciphertext": b64(os.urandom(1088)),
+        "pq_otp_hash": b64(os.urandom(32)),
+    }, SHARER)
+
+
+def setup_module():
+    signer.register(SHARER, RECIPIENT)
+
+
+def test_websocket_pushes_posted_messages():
+    with signer.client(RECIPIENT).websocket_connect(WS_PATH) as ws:
+        ws.send_text(json.dumps(signed({"username": RECIPIENT}, RECIPIENT)))
+        assert ws.receive_text() == SUBSCRIBED_EVENT
+
+        send_message(b"\x01" * 16)
+        event = json.loads(ws.receive_text())
+
+    assert event["type"] == "message"
+    assert event["message"]["encryptedMessage"] == b64(b"\x01" * 16)
+    assert event["message"]["sharerUsername"] == SHARER
+    assert messages_hub.connections == 0
+
+    # Pushed messages are still stored until acknowledged
+    grabbed = post(
+        "/x3dh/grab_return_messages", {"username": RECIPIENT}, RECIPIENT
+    ).json()["messages"]
+    assert event["message"]["id"] in [message["id"] for message in grabbed]
+
+
+def test_websocket_rejects_bad_signature():
+    envelope = signed({"username": RECIPIENT}, RECIPIENT)
+    envelope["signature"] = b64(b"\x00" * 64)
+    with signer.client(RECIPIENT).websocket_connect(WS_PATH) as ws:
+        ws.send_text(json.dumps(envelope))
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_text()
+    assert closed.value.code == 1008
+
+
+def test_websocket_rejects_subscribing_for_another_user():
+    with signer.client(SHARER).websocket_connect(WS_PATH) as ws:
+        ws.send_text(json.dumps(signed({"username": RECIPIENT}, SHARER)))
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_text()
+    assert closed.value.code == 1008
+
+
+def test_sse_rejects_subscribing_for_another_user():
+    response = post(f"{WS_PATH}/sse", {"username": RECIPIENT}, SHARER, status=403)
+    assert "text/event-stream" not in response.headers["content-type"]
+
+
+def test_sse_stream_sends_events_and_keepalives():
+    async def read_stream():
+        hub_user = 10_000_000
+        stream = sse_events(hub_user, keepalive=0.05)
+        first = await anext(stream)
+        messages_hub.publish(hub_user, '{"type":"message"}')
+        second = await anext(stream)
+        third = await anext(stream)
+        await stream.aclose()
+        return first, second, third
+
+    first, second, third = asyncio.run(read_stream())
+    assert first == f"data: {SUBSCRIBED_EVENT}\n\n"
+    assert second == 'data: {"type":"message"}\n\n'
+    assert third == ": keepalive\n\n"
+    assert messages_hub.connections == 0
+
+
+def test_slow_connection_is_told_to_resync():
+    async def overflow():
+        hub = MessageHub(queue_size=2, max_parked=1, max_parked_per_user=1)
+        subscription = hub.subscribe(1)
+        for i in range(5):
+            hub.publish(1, f"event {i}")
+        first = await subscription.get()
+        hub.publish(1, "after resync")
+        return first, await subscription.get()
+
+    assert asyncio.run(overflow()) == (RESYNC_EVENT, "after resync")
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Test how many SQL statements requests run, read from the X-Query-Count header.
+
+The signer is loaded once while the payload is unwrapped and reused by the
+handler, each other username costs one query, and the file is read with its
+share. A handler that goes back to querying the same rows fails here.
+"""
+
+import os
+import uuid as uuid_lib
+
+from app.core.users import usernames
+from app.main import app
+from app.middleware import QUERY_COUNT_HEADER, QueryCount
+from tests.conftest import Signer, b64
+
+# Counted whether or not [logging] query_counts adds the middleware to the app
+signer = Signer(b"query_counts_test_key_32_bytes!!", asgi=QueryCount(app))
+post = signer.post
+
+suffix = uuid_lib.uuid4().hex[:8]
+OWNER = f"count_owner_{suffix}"
+FRIEND = f"count_friend_{suffix}"
+FILE_UUID = str(uuid_lib.uuid4())
+
+
+def queries(url, payload_dict, username, status=200) -> int:
+    # A cold username cache, so every lookup the handler needs is counted
+    usernames.clear()
+    return int(post(url, payload_dict, username, status).headers[QUERY_COUNT_HEADER])
+
+
+def setup_module():
+    signer.register(OWNER, FRIEND)
+    post("/files/upload", {
+        "uuid": FILE_UUID,
+        "username": OWNER,
+        "file_name": "counted.bin",
+        "file_content_b64": b64(b"counted"),
+    }, OWNER)
+
+
+def test_share_and_revoke_file():
+    share = {
+        "sharer_username": OWNER, "recipient_username": FRIEND, "file_uuid": FILE_UUID
+    }
+    # signer, recipient, file with share, insert share
+    assert queries("/files/share_file", share, OWNER) == 4
+
+    revoke = {
+        "sharer_username": OWNER,
+        "revoked_username": FRIEND,
+        "file_uuid": FILE_UUID,
+        "file_content_b64": b64(b"re-encrypted"),
+    }
+    # signer, revoked user, file with share, update share
+    assert queries("/files/revoke_file", revoke, OWNER) == 4
+
+
+def test_post_return_message():
+    message = {
+        "sharer_username": OWNER,
+        "recipient_username": FRIEND,
+        "sharer_identity_key_public": b64(os.urandom(32)),
+        "sharer_ephemeral_key_public": b64(os.urandom(32)),
+        "otp_hash": b64(os.urandom(32)),
+        "encrypted_message": b64(b"hello"),
+        "kem_ciphertext": b64(os.urandom(1088)),
+        "pq_otp_hash": b64(os.urandom(32)),
+    }
+    # signer, recipient, reserve a slot, insert message
+    assert queries("/x3dh/post_return_message", message, OWNER) == 4
+
+
+def test_signer_is_not_looked_up_again():
+    # signer, inventory row
+    assert queries("/x3dh/prekey_inventory", {"username": FRIEND}, FRIEND) == 2
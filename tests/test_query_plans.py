@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Check that every query the routers run is served by an index.
+
+Drives each endpoint once through the app, plus the message expiry sweep,
+records the SQL the read and write engines execute, then asks SQLite for the
+`EXPLAIN QUERY PLAN` of every SELECT, UPDATE and DELETE. A plain
+`SCAN <table>` means a full table scan.
+"""
+
+import asyncio
+import json
+import os
+import uuid as uuid_lib
+
+import pytest
+from sqlalchemy import event
+
+from app.core.messages import expire_messages
+from app.shared.db import async_engine, config, engine, is_sqlite, write_engine
+from tests.conftest import Signer, b64
+
+pytestmark = pytest.mark.skipif(
+    not is_sqlite(config.database.path), reason="EXPLAIN QUERY PLAN is SQLite syntax"
+)
+
+
+signer = Signer(b"query_plan_test_key_32_bytes_ok!")
+post = signer.post
+
+ALICE = f"plan_alice_{uuid_lib.uuid4().hex[:8]}"
+BOB = f"plan_bob_{uuid_lib.uuid4().hex[:8]}"
+FILE_UUID = str(uuid_lib.uuid4())
+
+
+def exercise_every_endpoint():
+    signer.register(ALICE, BOB)
+
+    post("/x3dh/signed_prekey_push", {
+        "username": BOB,
+        "signed_prekey_public": b64(os.urandom(32)),
+        "signed_prekey_signature": b64(os.urandom(64)),
+    }, BOB)
+    post("/x3dh/pq_signed_prekey_push", {
+        "username": BOB,
+        "pq_signed_prekey_public": b64(os.urandom(1184)),
+        "pq_signed_prekey_signature": b64(os.urandom(64)),
+    }, BOB)
+    post("/x3dh/otp_prekey_push", {
+        "username": BOB, "pub_otps": [b64(os.urandom(32)), b64(os.urandom(32))],
+    }, BOB)
+    post("/x3dh/pq_otp_prekey_push", {
+        "username": BOB,
+        "pub_pq_otps": [
+            {"public_key": b64(os.urandom(1184)), "signature": b64(os.urandom(64))}
+            for _ in range(2)
+        ],
+    }, BOB)
+    post("/x3dh/prekey_inventory", {"username": BOB}, BOB)
+    post("/x3dh/prekey_bundle", {"username": ALICE, "target_username": BOB}, ALICE)
+    post("/x3dh/prekey_bundles", {"username": ALICE, "target_usernames": [BOB]}, ALICE)
+    post("/x3dh/post_return_message", {
+        "sharer_username": ALICE,
+        "recipient_username": BOB,
+        "sharer_identity_key_public": b64(os.urandom(32)),
+        "sharer_ephemeral_key_public": b64(os.urandom(32)),
+        "otp_hash": b64(os.urandom(32)),
+        "encrypted_message": b64(os.urandom(64)),
+        "kem_ciphertext": b64(os.urandom(1088)),
+        "pq_otp_hash": b64(os.urandom(32)),
+    }, ALICE)
+    post("/x3dh/post_return_messages", {
+        "sharer_username": ALICE,
+        "sharer_identity_key_public": b64(os.urandom(32)),
+        "messages": [{
+            "recipient_username": BOB,
+            "sharer_ephemeral_key_public": b64(os.urandom(32)),
+            "otp_hash": b64(os.urandom(32)),
+            "encrypted_message": b64(os.urandom(64)),
+            "kem_ciphertext": b64(os.urandom(1088)),
+            "pq_otp_hash": b64(os.urandom(32)),
+        }],
+    }, ALICE)
+    messages = post("/x3dh/grab_return_messages", {"username": BOB}, BOB).json()
+    post("/x3dh/ack_return_messages", {
+        "username": BOB, "message_ids": [m["id"] for m in messages["messages"]],
+    }, BOB)
+
+    post("/files/upload", {
+        "uuid": FILE_UUID,
+        "username": ALICE,
+        "file_name": "plan.bin",
+        "file_content_b64": b64(b"query plan"),
+    }, ALICE)
+    post("/files/share_file", {
+        "sharer_username": ALICE, "recipient_username": BOB, "file_uuid": FILE_UUID,
+    }, ALICE)
+    post("/files/download", {"uuid": FILE_UUID, "username": BOB}, BOB)
+    post("/files/revoke_file", {
+        "sharer_username": ALICE,
+        "revoked_username": BOB,
+        "file_uuid": FILE_UUID,
+        "file_content_b64": b64(b"re-encrypted"),
+    }, ALICE)
+    post("/files/delete", {"uuid": FILE_UUID, "username": ALICE}, ALICE)
+
+    asyncio.run(expire_messages())
+
+
+@pytest.fixture(scope="module")
+def router_queries():
+    queries = []
+
+    def record(_conn, _cursor, statement, parameters, _context, _executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            queries.append((statement, parameters))
+
+    # Reads and writes go through different engines, unless they are one
+    engines = {async_engine.sync_engine, write_engine.sync_engine}
+    for recorded in engines:
+        event.listen(recorded, "before_cursor_execute", record)
+    try:
+        exercise_every_endpoint()
+    finally:
+        for recorded in engines:
+            event.remove(recorded, "before_cursor_execute", record)
+    return queries
+
+
+def full_scans(statement, parameters):
+    with engine.connect() as connection:
+        plan = connection.exec_driver_sql(
+            f"EXPLAIN QUERY PLAN {statement}", tuple(parameters)
+        ).all()
+    return [
+        detail
+        for *_, detail in plan
+        if detail.startswith("SCAN") and "USING" not in detail
+    ]
+
+
+def test_router_queries_were_recorded(router_queries):
+    assert len(router_queries) > 20
+    # The writes as well, or a full scan in one would go unnoticed
+    verbs = {statement.split(None, 1)[0].upper() for statement, _ in router_queries}
+    assert {"UPDATE", "DELETE"} <= verbs
+
+
+def test_every_router_query_uses_an_index(router_queries):
+    unindexed = {
+        statement: scans
+        for statement, parameters in router_queries
+        if (scans := full_scans(statement, parameters))
+    }
+    assert not unindexed, json.dumps(unindexed, indent=2)
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Test the token-bucket rate limiter, that its memory stays bounded, that
+throttled users are turned away before their body is read, that the shared
+stores give several workers one budget, and that costly routes and large
+bodies are paced.
+"""
+
+import asyncio
+import base64
+import fcntl
+import json
+import threading
+import uuid as uuid_lib
+from time import perf_counter
+
+import fakeredis
+import pytest
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+from app.core.rate_limit_stores import RedisWindows, SharedMemoryWindows, SharedWindows
+from app.core.rate_limits import (
+    USERNAME_HEADER,
+    ByteShaper,
+    RateLimiter,
+    TokenBuckets,
+    rate_limiter,
+)
+from app.main import app
+from app.middleware import RATE_LIMIT_KEYS_HEADER, RateLimit, Throttle
+from app.shared import load_config
+
+config = load_config()
+
+private_key = Ed25519PrivateKey.from_private_bytes(b"rate_limit_test_key_32_bytes!!!!")
+
+
+def test_burst_then_refill():
+    buckets = TokenBuckets(rate=10, burst=10, block_for=60, max_keys=4)
+    assert all(buckets.allow("a", 0.0) for _ in range(10))
+    assert buckets.allow("b", 0.0)  # keys are independent
+
+    # Out of tokens: refused, and blocked even once tokens are back
+    assert not buckets.allow("a", 0.05)
+    assert not buckets.allow("a", 5.0)
+    assert buckets.allow("a", 60.1)
+
+
+def test_steady_rate_is_never_blocked():
+    buckets = TokenBuckets(rate=10, burst=10, block_for=60, max_keys=4)
+    assert all(buckets.allow("a", i * 0.1) for i in range(100))
+
+
+def test_least_recently_used_key_makes_room():
+    buckets = TokenBuckets(rate=1, burst=1, block_for=60, max_keys=2)
+    buckets.allow("a", 0.0)
+    buckets.allow("b", 0.0)
+    buckets.allow("a", 0.0)  # refused, but touches "a"
+    buckets.allow("c", 0.0)  # evicts "b"
+
+    assert len(buckets) == 2
+    assert buckets.allow("b", 0.0)  # a fresh bucket again
+    assert not buckets.allow("c", 0.0)
+
+
+def test_sweep_drops_only_idle_keys():
+    buckets = TokenBuckets(rate=10, burst=10, block_for=60, max_keys=8)
+    for _ in range(11):
+        buckets.allow("blocked", 0.0)
+    buckets.allow("idle", 0.5)
+    buckets.allow("busy", 1.8)
+
+    assert buckets.sweep(2.0) == 0  # "blocked" is first in line and still blocked
+    assert buckets.sweep(61.0) == 3
+    assert len(buckets) == 0
+
+
+def test_costly_requests_spend_more():
+    buckets = TokenBuckets(rate=10, burst=10, block_for=60, max_keys=4)
+    assert buckets.allow("a", 0.0, cost=5)
+    assert buckets.allow("a", 0.0, cost=5)
+    assert not buckets.allow("a", 0.0)
+
+
+def test_byte_delay_pays_off_debt():
+    buckets = TokenBuckets(rate=100, burst=100, block_for=0, max_keys=4)
+    assert buckets.delay("a", 100, 0.0) == 0  # the burst goes at once
+    assert buckets.delay("a", 50, 0.0) == pytest.approx(0.5)
+    # Half a second later the first debt is paid, the next one waits as long
+    assert buckets.delay("a", 50, 0.5) == pytest.approx(0.5)
+
+    assert buckets.sweep(1.5) == 0  # still refilling
+    assert buckets.sweep(2.0) == 1
+
+
+def test_tracked_keys_are_capped():
+    limiter = RateLimiter(
+        TokenBuckets(rate=5, burst=5, block_for=60, max_keys=100),
+        TokenBuckets(rate=5, burst=5, block_for=60, max_keys=100),
+        sweep_interval=1,
+    )
+    for i in range(1000):
+        limiter.check_ip(f"10.1.{i // 256}.{i % 256}", 0.0)
+        limiter.check_user(f"user_{i}", 0.0)
+    assert limiter.tracked_keys == 200
+
+    # Everything is idle once the buckets refill; the next check sweeps it
+    limiter.check_ip("10.2.0.1", 5.0)
+    assert limiter.tracked_keys == 1
+
+    for _ in range(4):  # the rest of the burst of 5
+        limiter.check_ip("10.2.0.1", 5.0)
+    with pytest.raises(HTTPException) as e:
+        limiter.check_ip("10.2.0.1", 5.0)
+    assert e.value.status_code == 429
+
+
+def test_tracked_keys_are_reported_when_asked():
+    limiter = RateLimiter(
+        TokenBuckets(rate=5, burst=5, block_for=60, max_keys=100),
+        TokenBuckets(rate=5, burst=5, block_for=60, max_keys=100),
+        sweep_interval=60,
+    )
+
+    async def ok(_request: Request) -> Response:
+        return Response()
+
+    inner = Starlette(routes=[Route("/ok", ok, methods=["POST"])])
+    reporting = TestClient(
+        RateLimit(inner, limiter, report_keys=True), client=("10.0.50.1", 50000)
+    )
+    response = reporting.post("/ok", headers={USERNAME_HEADER: "alice"})
+    assert response.headers[RATE_LIMIT_KEYS_HEADER] == "2"
+    # Refused requests report them as well
+    response = reporting.post("/ok")
+    assert response.status_code == 400
+    assert response.headers[RATE_LIMIT_KEYS_HEADER] == "2"
+
+    silent = TestClient(RateLimit(inner, limiter), client=("10.0.50.2", 50000))
+    response = silent.post("/ok", headers={USERNAME_HEADER: "alice"})
+    assert RATE_LIMIT_KEYS_HEADER not in response.headers
+    assert limiter.tracked_keys == 3
+
+
+def test_username_is_limited_across_addresses():
+    username = f"spread_{uuid_lib.uuid4().hex[:8]}"
+    payload_json = json.dumps({"username": username}, separators=(",", ":"))
+    envelope = {
+        "payload": payload_json,
+        "signature": base64.b64encode(private_key.sign(payload_json.encode())).decode(),
+        "username": username,
+    }
+    limit = config.network.rate_limit.requests_per_second
+    statuses = [
+        TestClient(app, client=(f"10.0.46.{i}", 50000))
+        .post(
+            "/x3dh/prekey_inventory", json=envelope, headers={USERNAME_HEADER: username}
+        )
+        .status_code
+        for i in range(1, limit + 6)
+    ]
+    # Unknown user, so 404 until the username runs out of requests
+    assert statuses[0] == 404
+    assert statuses[-1] == 429
+
+
+def test_username_header_is_checked_before_the_body():
+    username = f"header_{uuid_lib.uuid4().hex[:8]}"
+    limit = config.network.rate_limit.requests_per_second
+    statuses = [
+        TestClient(app, client=(f"10.0.47.{i}", 50000))
+        .post(
+            "/x3dh/prekey_inventory",
+            content=b"not even JSON",
+            headers={USERNAME_HEADER: username, "Content-Type": "application/json"},
+        )
+        .status_code
+        for i in range(1, limit + 3)
+    ]
+    # Rejected as unparsable until the user is out of requests, then before parsing
+    assert statuses[0] == 400
+    assert statuses[-1] == 429
+
+
+def test_requests_without_a_username_header_are_refused_before_the_body():
+    username = f"anonymous_{uuid_lib.uuid4().hex[:8]}"
+    payload_json = json.dumps({"username": username}, separators=(",", ":"))
+    envelope = {
+        "payload": payload_json,
+        "signature": base64.b64encode(private_key.sign(payload_json.encode())).decode(),
+        "username": username,
+    }
+    client = TestClient(app, client=("10.0.47.101", 50000))
+    for body in (json.dumps(envelope).encode(), b"not even JSON"):
+        response = client.post(
+            "/x3dh/prekey_inventory",
+            content=body,
+            headers={"Content-Type": "application/json"},
+        )
+        assert response.status_code == 400
+        assert USERNAME_HEADER in response.json()["detail"]
+
+
+def test_username_header_must_name_the_signer():
+    signer = f"signer_{uuid_lib.uuid4().hex[:8]}"
+    payload_json = json.dumps({"username": signer}, separators=(",", ":"))
+    envelope = {
+        "payload": payload_json,
+        "signature": base64.b64encode(private_key.sign(payload_json.encode())).decode(),
+        "username": signer,
+    }
+    response = TestClient(app, client=("10.0.47.100", 50000)).post(
+        "/x3dh/prekey_inventory",
+        json=envelope,
+        headers={USERNAME_HEADER: "someone_else"},
+    )
+    assert response.status_code == 400
+    assert USERNAME_HEADER in response.json()["detail"]
+
+
+async def share_one_budget(first, second) -> int:
+    """Hits allowed when two workers with a limit of 10 take turns."""
+    now = 1000.0  # the start of a window
+    allowed = sum(first.allow("10.3.0.1", now) for _ in range(8))
+    await first.sync()
+    # The second worker learns of the first's hits with its first sync
+    allowed += second.allow("10.3.0.1", now)
+    await second.sync()
+    allowed += sum(second.allow("10.3.0.1", now) for _ in range(5))
+    await second.sync()
+    # The first worker allows what it sends before it syncs, then no more
+    allowed += sum(first.allow("10.3.0.1", now) for _ in range(2))
+    await first.sync()
+    allowed += sum(first.allow("10.3.0.1", now + 5) for _ in range(5))
+    return allowed
+
+
+def test_shared_memory_workers_share_one_budget(tmp_path):
+    path = str(tmp_path / "rate-limits")
+    workers = [
+        SharedMemoryWindows(
+            "ip", limit=10, block_for=60, max_keys=8, path=path, slots=64
+        )
+        for _ in range(2)
+    ]
+    assert asyncio.run(share_one_budget(*workers)) == 12
+    assert workers[1].allow("10.3.0.2", 1000.0)
+
+
+def test_shared_memory_previous_window_slides_out(tmp_path):
+    windows = SharedMemoryWindows(
+        "ip", limit=10, block_for=0, max_keys=8, path=str(tmp_path / "rl"), slots=64
+    )
+    assert sum(windows.allow("a", 1000.0) for _ in range(10)) == 10
+    asyncio.run(windows.sync())
+    # A quarter into the next window, three quarters of the last one still count
+    assert sum(windows.allow("a", 1001.25) for _ in range(10)) == 2
+    assert windows.sweep(1010.0) == 1
+
+
+def test_shared_memory_sync_waits_for_the_lock_off_the_loop(tmp_path):
+    path = tmp_path / "rl"
+    windows = SharedMemoryWindows(
+        "ip", limit=10, block_for=0, max_keys=8, path=str(path), slots=64
+    )
+    windows.allow("a", 1000.0)
+
+    async def sync_while_another_worker_holds_the_lock() -> bool:
+        with path.open("r+b") as other_worker:
+            fcntl.flock(other_worker, fcntl.LOCK_EX)
+            # Let go after a while even if the loop is stuck, so a regression fails
+            release = threading.Timer(0.5, fcntl.flock, (other_worker, fcntl.LOCK_UN))
+            release.start()
+            sync = asyncio.create_task(windows.sync())
+            for _ in range(5):
+                await asyncio.sleep(0.01)
+            waiting = not sync.done()
+            fcntl.flock(other_worker, fcntl.LOCK_UN)
+            await sync
+            release.cancel()
+        return waiting
+
+    assert asyncio.run(sync_while_another_worker_holds_the_lock())
+    assert sum(windows.allow("a", 1000.0) for _ in range(10)) == 9
+
+
+def test_shared_windows_need_an_exchange():
+    with pytest.raises(TypeError):
+        SharedWindows("ip", limit=10, block_for=0, max_keys=8)  # type: ignore[abstract]
+
+
+def test_redis_workers_share_one_budget():
+    server = fakeredis.FakeServer()
+    workers = [
+        RedisWindows(
+            "user", limit=10, block_for=60, max_keys=8, url="redis://", timeout=1
+        )
+        for _ in range(2)
+    ]
+    for worker in workers:
+        worker.client = fakeredis.FakeAsyncRedis(server=server)
+
+    assert asyncio.run(share_one_budget(*workers)) == 12
+    assert all(worker.available for worker in workers)
+
+
+def test_unreachable_redis_fails_open_to_local_limits():
+    windows = RedisWindows(
+        "user", limit=10, block_for=60, max_keys=8,
+        url="redis://127.0.0.1:1/0", timeout=0.1,
+    )
+    assert sum(windows.allow("bob", 1000.0) for _ in range(6)) == 6
+    asyncio.run(windows.sync())
+    assert not windows.available
+
+    # The hits it could not write still count here
+    assert sum(windows.allow("bob", 1000.0) for _ in range(6)) == 4
+
+
+def test_route_cost_is_charged_to_ip_and_user(monkeypatch):
+    path = "/x3dh/prekey_inventory"
+    monkeypatch.setitem(
+        rate_limiter.costs, path, config.network.rate_limit.requests_per_second
+    )
+    client = TestClient(app, client=("10.0.49.1", 50000))
+    headers = {USERNAME_HEADER: f"costly_{uuid_lib.uuid4().hex[:8]}"}
+    assert client.post(path, content=b"{}", headers=headers).status_code == 400
+    assert client.post(path, content=b"{}", headers=headers).status_code == 429
+
+    # The user's budget is gone as well, whatever address it comes from
+    other = TestClient(app, client=("10.0.49.2", 50000))
+    assert other.post(path, content=b"{}", headers=headers).status_code == 429
+
+
+def shaped(incoming: ByteShaper | None, outgoing: ByteShaper | None) -> TestClient:
+    async def echo(request: Request) -> Response:
+        body = await request.body()
+
+        async def chunks():
+            for start in range(0, len(body), 65536):
+                yield body[start : start + 65536]
+
+        return StreamingResponse(chunks())
+
+    inner = Starlette(routes=[Route("/echo", echo, methods=["POST"])])
+    return TestClient(Throttle(inner, incoming, outgoing), client=("10.0.49.3", 50000))
+
+
+def byte_shaper(rate: int, burst: int) -> ByteShaper:
+    return ByteShaper(
+        TokenBuckets(rate, burst, block_for=0, max_keys=4),
+        TokenBuckets(rate, burst, block_for=0, max_keys=4),
+        sweep_interval=60,
+    )
+
+
+@pytest.mark.parametrize("direction", ["incoming", "outgoing"])
+def test_large_bodies_are_paced_not_refused(direction):
+    # 256 KiB at 512 KiB/s after a 64 KiB burst: about 0.375 s
+    shaper = byte_shaper(rate=512 * 1024, burst=64 * 1024)
+    client = shaped(*((shaper, None) if direction == "incoming" else (None, shaper)))
+    body = bytes(256 * 1024)
+
+    started = perf_counter()
+    response = client.post("/echo", content=body)
+    elapsed = perf_counter() - started
+
+    assert response.status_code == 200
+    assert response.content == body
+    assert 0.3 < elapsed < 2
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Test paginated, streamed and acknowledged delivery of X3DH initial messages.
+"""
+
+import json
+import os
+import uuid as uuid_lib
+
+from app.models.requests.serde_base import NDJSON_MEDIA_TYPE
+from tests.conftest import Signer, b64
+
+signer = Signer(b"messages_test_key_32_bytes_long!")
+post = signer.post
+
+suffix = uuid_lib.uuid4().hex[:8]
+SHARER = f"messages_sharer_{suffix}"
+RECIPIENT = f"messages_recipient_{suffix}"
+OTHER = f"messages_other_{suffix}"
+
+
+def send_message(recipient: str, body: bytes):
+    post("/x3dh/post_return_message", {
+        "sharer_username": SHARER,
+        "recipient_username": recipient,
+        "sharer_identity_key_public": b64(os.urandom(32)),
+        "sharer_ephemeral_key_public": b64(os.urandom(32)),
+        "otp_hash": b64(os.urandom(32)),
+        "encrypted_message": b64(body),
+        "kem_ciphertext": b64(os.urandom(1088)),
+        "pq_otp_hash": b64(os.urandom(32)),
+    }, SHARER)
+
+
+def grab(**page):
+    return post(
+        "/x3dh/grab_return_messages", {"username": RECIPIENT, **page}, RECIPIENT
+    ).json()
+
+
+def setup_module():
+    signer.register(SHARER, RECIPIENT, OTHER)
+    for i in range(5):
+        send_message(RECIPIENT, bytes([i]) * 16)
+    send_message(OTHER, b"\xff" * 16)
+
+
+def test_pages_follow_the_cursor():
+    bodies = []
+    page = grab(limit=2)
+    pages = 1
+    while page["nextCursor"] is not None:
+        bodies += [m["encryptedMessage"] for m in page["messages"]]
+        page = grab(limit=2, after=page["nextCursor"])
+        pages += 1
+    bodies += [m["encryptedMessage"] for m in page["messages"]]
+
+    assert pages == 3
+    assert bodies == [b64(bytes([i]) * 16) for i in range(5)]
+
+
+def test_ndjson_stream_has_one_message_per_line():
+    response = post(
+        "/x3dh/grab_return_messages",
+        {"username": RECIPIENT, "limit": 2},
+        RECIPIENT,
+        headers={"Accept": NDJSON_MEDIA_TYPE},
+    )
+
+    assert response.headers["content-type"].startswith(NDJSON_MEDIA_TYPE)
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["encryptedMessage"] for line in lines] == [
+        b64(bytes([i]) * 16) for i in range(5)
+    ]
+
+
+def test_only_acknowledged_messages_are_deleted():
+    ids = [message["id"] for message in grab()["messages"]]
+    other_id = post(
+        "/x3dh/grab_return_messages", {"username": OTHER}, OTHER
+    ).json()["messages"][0]["id"]
+
+    response = post("/x3dh/ack_return_messages", {
+        "username": RECIPIENT, "message_ids": [*ids[:3], other_id],
+    }, RECIPIENT)
+
+    assert response.json() == {"deleted": 3}
+    assert [message["id"] for message in grab()["messages"]] == ids[3:]
+    # Another user's message id is not the recipient's to acknowledge
+    other = post("/x3dh/grab_return_messages", {"username": OTHER}, OTHER).json()
+    assert [message["id"] for message in other["messages"]] == [other_id]
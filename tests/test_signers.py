@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Test that a request only acts as the user who signed it.
+
+Every user here is registered with the same key, so each request below has a
+valid signature; it is refused only because the signer is not the user the
+payload names as its owner.
+"""
+
+import os
+import uuid as uuid_lib
+
+import pytest
+
+from tests.conftest import Signer, b64
+
+signer = Signer(b"signers_test_key_32_bytes_long!!")
+post = signer.post
+
+suffix = uuid_lib.uuid4().hex[:8]
+OWNER = f"signer_owner_{suffix}"
+MALLORY = f"signer_mallory_{suffix}"
+FILE_UUID = str(uuid_lib.uuid4())
+
+
+def message(sharer: str, recipient: str) -> dict:
+    return {
+        "sharer_username": sharer,
+        "recipient_username": recipient,
+        "sharer_identity_key_public": b64(os.urandom(32)),
+        "sharer_ephemeral_key_public": b64(os.urandom(32)),
+        "otp_hash": b64(os.urandom(32)),
+        "encrypted_message": b64(b"hello"),
+        "kem_ciphertext": b64(os.urandom(1088)),
+        "pq_otp_hash": b64(os.urandom(32)),
+    }
+
+
+def setup_module():
+    signer.register(OWNER, MALLORY)
+    post("/files/upload", {
+        "uuid": FILE_UUID,
+        "username": OWNER,
+        "file_name": "owned.bin",
+        "file_content_b64": b64(b"owned"),
+    }, OWNER)
+
+
+@pytest.mark.parametrize("url, payload", [
+    ("/x3dh/signed_prekey_push", {
+        "username": OWNER,
+        "signed_prekey_public": b64(b"\x01" * 32),
+        "signed_prekey_signature": b64(b"\x02" * 64),
+    }),
+    ("/x3dh/otp_prekey_push", {"username": OWNER, "pub_otps": [b64(b"\x05" * 32)]}),
+    ("/x3dh/grab_return_messages", {"username": OWNER}),
+    ("/x3dh/ack_return_messages", {"username": OWNER, "message_ids": [1]}),
+    ("/x3dh/post_return_message", message(OWNER, MALLORY)),
+    ("/files/download", {"uuid": FILE_UUID, "username": OWNER}),
+    ("/files/share_file", {
+        "sharer_username": OWNER, "recipient_username": MALLORY, "file_uuid": FILE_UUID,
+    }),
+    ("/files/delete", {"uuid": FILE_UUID, "username": OWNER}),
+])
+def test_owner_fields_must_name_the_signer(url, payload):
+    response = post(url, payload, MALLORY, status=403)
+    assert OWNER in response.json()["detail"]
+
+
+def test_counterparts_may_be_anyone():
+    post("/x3dh/post_return_message", message(MALLORY, OWNER), MALLORY)
+
+
+def test_only_the_recipient_acks_their_messages():
+    post("/x3dh/post_return_message", message(MALLORY, OWNER), MALLORY)
+    page = post("/x3dh/grab_return_messages", {"username": OWNER}, OWNER).json()
+    ids = [m["id"] for m in page["messages"]]
+
+    ack = {"username": OWNER, "message_ids": ids}
+    post("/x3dh/ack_return_messages", ack, MALLORY, status=403)
+    again = post("/x3dh/grab_return_messages", {"username": OWNER}, OWNER).json()
+    assert [m["id"] for m in again["messages"]] == ids
@@ -12,12 +12,13 @@ import pytest
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 from fastapi.testclient import TestClient
 
+from app.core.rate_limits import USERNAME_HEADER
 from app.main import app
 
-client = TestClient(app)
-
 # Configuration
 TEST_USERNAME = "testuser"
+
+client = TestClient(app, headers={USERNAME_HEADER: TEST_USERNAME})
 TEST_FILE_PATH = Path("test_file.txt")
 
 